@@ -1,7 +1,13 @@
 import configparser
-from flask import Flask, render_template, request
+import json
+import os
+import secrets
+import threading
+import uuid
+from flask import Flask, Response, render_template, request, session, stream_with_context
 from rag.functions.vector_indexing import get_vectordb
 from rag.pipeline import Pipeline
+from rag.models.conversation_store import Turn, get_conversation_store, to_sources
 from rag.models.dataloader import DataLoader
 import markdown
 
@@ -9,31 +15,63 @@ import markdown
 config = configparser.ConfigParser(interpolation=None)
 config.read('config.ini')
 
-# Clear the logs
-with open(config["logging"]["filename"], 'w') as file:
-    pass 
-
-# Create a flask app instance
+# Create a flask app instance, the session cookie only holds the id of the conversation and is signed with this key
 app = Flask(__name__)
+app.secret_key = os.environ.get("FLASK_SECRET_KEY")
+if not app.secret_key:
+    if config["conversation"]["backend"] == "redis":
+        # every process would sign the cookies with its own key and reject the sessions of the others
+        print("[ERROR] The redis conversation backend requires the FLASK_SECRET_KEY environment variable.")
+        exit()
+    app.secret_key = secrets.token_hex(32)
+
+# Conversations of all sessions
+conversations = get_conversation_store(config)
+source_preview_length = int(config["conversation"]["source_preview_length"])
+
+# Built on the first request, also when the app is served by a WSGI server or flask run
+pipeline = None
+pipeline_lock = threading.Lock()
+
+
+def get_pipeline() -> Pipeline:
+    """
+    Returns the pipeline of this process, the vector database and the pipeline are built on the first call
 
-# Initial conversation
-conversation = []
+    Returns:
+        the pipeline
+    """
+    global pipeline
+    with pipeline_lock:
+        if pipeline is None:
+            data_loader = DataLoader(config["ingestion"])
+            vectordb = get_vectordb(config, data_loader)
+            pipeline = Pipeline(vectordb=vectordb, config=config)
+        return pipeline
 
-data_loader = DataLoader(config["ingestion"])
-# Build database and initialize pipeline
-vectordb = get_vectordb(config, data_loader)
-pipeline = Pipeline(vectordb=vectordb, config=config)
 
+def session_id():
+    """
+    Returns the id of the conversation of the current user, a new one is created on the first request
+
+    Returns:
+        the session id
+    """
+    if "id" not in session:
+        session["id"] = uuid.uuid4().hex
+    return session["id"]
 
 
 @app.route('/')
 def home():
     """
-    The frontend ui with a persistent conversation
+    The frontend ui with the conversation of the session
 
     Returns:
          frontend HTML
     """
+    conversation = [(turn.question, markdown.markdown(turn.answer), turn.sources)
+                    for turn in conversations.get(session_id())]
     return render_template('index.html', conversation=conversation)
 
 
@@ -63,22 +101,60 @@ def ask():
     """
     if request.method == 'POST':
         question = request.form['question']
+        conversation_id = session_id()
+
+        answer, documents = get_pipeline().invoke(question, conversations.history(conversation_id))
 
-        flattened_conversation = [msg for pair in conversation for msg in list(pair[:2])]
-        answer, documents = pipeline.invoke(question, flattened_conversation)
-        answer = markdown.markdown(answer)
-        
-        conversation.append((question, answer, documents))
+        conversations.append(conversation_id, Turn(question, answer, to_sources(documents, source_preview_length)))
 
         return {}, 200
     else:
         return {"response": "method not allowed"}, 405
 
 
+@app.route('/ask/stream', methods=['POST'])
+def ask_stream():
+    """
+    POST Endpoint to ask a question with a streamed response. The response is sent as Server-Sent Events:
+    a "sources" event with the retrieved documents, "token" events with the pieces of the answer as they are
+    generated and a "done" event with the complete answer rendered as html. The conversation for the UI is updated.
+
+    Returns:
+        text/event-stream response
+    """
+    question = request.form['question']
+    # the session cookie has to be set before the response is streamed
+    conversation_id = session_id()
+    history = conversations.history(conversation_id)
+    # built before the response is streamed, so a failure is an error response instead of a broken stream
+    pipeline = get_pipeline()
+
+    def generate():
+        documents = []
+        for event in pipeline.stream(question, history):
+            if event["event"] == "sources":
+                documents = event["documents"]
+                data = to_sources(documents)
+            elif event["event"] == "token":
+                data = event["content"]
+            else:
+                conversations.append(conversation_id,
+                                     Turn(question, event["result"], to_sources(documents, source_preview_length)))
+                data = markdown.markdown(event["result"])
+            yield f"event: {event['event']}\ndata: {json.dumps(data)}\n\n"
+
+    return Response(stream_with_context(generate()), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
 if __name__ == '__main__':
     """
     Entry point for the web server
     """
+    # Clear the logs
+    with open(config["logging"]["filename"], 'w') as file:
+        pass
+
     host = config["web"]["host"]
     port = int(config["web"]["port"])
     app.run(debug=True, host=host, port=port)
@@ -0,0 +1,104 @@
+import argparse
+import time
+import warnings
+from typing import List
+
+import numpy as np
+from langchain_core.documents.base import Document
+from langchain_core.embeddings.embeddings import Embeddings
+
+from rag.models.databases import ChromaDB, FaissDB, NumpyDB, VectorDB
+
+"""
+### Vector database benchmark ###
+
+Compares the query latency of the vector database backends on a synthetic corpus.
+The embeddings are random unit vectors that are precomputed, so only the time spent in the vector search is measured.
+"""
+
+
+class SyntheticEmbeddings(Embeddings):
+    """
+    Embeddings returning precomputed random unit vectors for known texts
+    """
+
+    def __init__(self, texts: List[str], dimensions: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        vectors = rng.standard_normal((len(texts), dimensions)).astype(np.float32)
+        vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+        self.vectors = dict(zip(texts, vectors.tolist()))
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return [self.vectors[text] for text in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.vectors[text]
+
+
+def measure(vectordb: VectorDB, queries: List[str], k: int) -> dict:
+    """
+    Measures the latency of single queries through search_with_scores
+
+    Params:
+        vectordb: the vector database
+        queries: the queries
+        k: the number of documents per query
+    Returns:
+        mean, p50 and p95 latency in milliseconds
+    """
+    latencies = []
+    for query in queries:
+        start = time.perf_counter()
+        vectordb.search_with_scores(query, k=k)
+        latencies.append((time.perf_counter() - start) * 1000)
+    return {
+        "mean": float(np.mean(latencies)),
+        "p50": float(np.percentile(latencies, 50)),
+        "p95": float(np.percentile(latencies, 95)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of the vector database backends")
+    parser.add_argument("-n", "--documents", type=int, default=20000, help="Number of chunks in the corpus")
+    parser.add_argument("-d", "--dimensions", type=int, default=1536, help="Embedding dimensions")
+    parser.add_argument("-q", "--queries", type=int, default=200, help="Number of queries")
+    parser.add_argument("-k", type=int, default=5, help="Number of documents per query")
+    parser.add_argument("-b", "--backends", nargs="+", default=["chroma", "faiss", "numpy"],
+                        help="Backends to benchmark: chroma, faiss, numpy")
+    args = parser.parse_args()
+    warnings.simplefilter("ignore")
+
+    documents = [Document(page_content=f"chunk {i}", metadata={"source": f"https://example.org/{i}", "language": "en"})
+                 for i in range(args.documents)]
+    queries = [f"query {i}" for i in range(args.queries)]
+    embeddings = SyntheticEmbeddings([doc.page_content for doc in documents] + queries, args.dimensions)
+
+    backends = {
+        "chroma": lambda: ChromaDB(embedding_function=embeddings, documents=documents),
+        "faiss": lambda: FaissDB(documents=documents, embedding_function=embeddings),
+        "numpy": lambda: NumpyDB(embedding_function=embeddings, documents=documents),
+    }
+
+    print(f"[INFO] {args.documents} chunks, {args.dimensions} dimensions, {args.queries} queries, k={args.k}")
+    for name in args.backends:
+        start = time.perf_counter()
+        vectordb = backends[name]()
+        build_seconds = time.perf_counter() - start
+
+        # warm up
+        measure(vectordb, queries[:5], args.k)
+        result = measure(vectordb, queries, args.k)
+        line = (f"{name:>7}: build {build_seconds:7.2f}s | query mean {result['mean']:7.3f}ms "
+                f"p50 {result['p50']:7.3f}ms p95 {result['p95']:7.3f}ms")
+
+        if isinstance(vectordb, NumpyDB):
+            query_vectors = embeddings.embed_documents(queries)
+            start = time.perf_counter()
+            vectordb.search_with_scores_by_vectors(query_vectors, k=args.k)
+            line += f" | batched {(time.perf_counter() - start) * 1000 / len(queries):7.3f}ms per query"
+        print(line)
+
+
+if __name__ == "__main__":
+    main()
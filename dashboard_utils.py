@@ -1,6 +1,6 @@
 import configparser
 import numpy as np
-from typing import Any, Dict
+from typing import TYPE_CHECKING, Any, Dict
 from rag.models.evaluation import Evaluation
 import warnings
 import os
@@ -10,9 +10,11 @@ from rag.functions.vector_indexing import get_vectordb
 from rag.pipeline import Pipeline
 import requests
 from pymongo import MongoClient
-from ragas.evaluation import Result
 from rag.models.dataloader import DataLoader
 
+if TYPE_CHECKING:
+    from ragas.evaluation import Result
+
 
 # ----------------- Initializations -----------------
 # load environment variables
@@ -105,7 +107,7 @@ def close_mongodb_client(mongodb_client):
     mongodb_client.close()
     print("[INFO] MongoDB client closed.")
     
-def insert_document(test_name: str, timestamp: Any, config: Dict[str, Any], results: Result) -> bool:
+def insert_document(test_name: str, timestamp: Any, config: Dict[str, Any], results: "Result") -> bool:
     average_score_per_metric = results
     average_score = sum(average_score_per_metric.values()) / len(average_score_per_metric)
     results_df = results.to_pandas()
@@ -59,4 +59,5 @@ def main():
         eval.log_on_mlflow(results=results)
 
 
-main()
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+import argparse
+import re
+import subprocess
+import sys
+from typing import List, Tuple
+
+"""
+### Import time profile ###
+
+Reports how long importing the entry point modules takes, based on `python -X importtime`.
+Every module is imported in a fresh interpreter, so the numbers include all transitive imports.
+"""
+
+DEFAULT_MODULES = ["rag.pipeline", "rag.functions.vector_indexing", "rag.models.evaluation", "dashboard_utils"]
+
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|(\s*)(\S+)\s*$")
+
+
+def profile_module(module: str) -> List[Tuple[str, int, int]]:
+    """
+    Imports a module in a new interpreter and parses its import time report
+
+    Params:
+        module: the module to import
+    Returns:
+        (imported module, self time, cumulative time) per import, times in microseconds
+    """
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"],
+                            capture_output=True, text=True)
+    if result.returncode != 0:
+        print(f"[ERROR] Importing {module} failed:\n{result.stderr.splitlines()[-1] if result.stderr else ''}")
+        exit(1)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if match:
+            imports.append((match.group(4), int(match.group(1)), int(match.group(2))))
+    return imports
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import time profile of the pipeline modules")
+    parser.add_argument("-m", "--modules", nargs="+", default=DEFAULT_MODULES, help="Modules to profile")
+    parser.add_argument("-t", "--top", type=int, default=15, help="Number of slowest imports to list per module")
+    parser.add_argument("--max-seconds", type=float, default=None,
+                        help="Fail with exit code 1 if importing a module takes longer")
+    args = parser.parse_args()
+
+    over_budget = []
+    for module in args.modules:
+        imports = profile_module(module)
+        total = next((cumulative for name, _, cumulative in reversed(imports) if name == module),
+                     sum(self_time for _, self_time, _ in imports))
+        print(f"{module}: {total / 1e6:.3f}s")
+        slowest = sorted(imports, key=lambda entry: entry[2], reverse=True)
+        for name, self_time, cumulative in slowest[:args.top]:
+            print(f"  {cumulative / 1e3:9.1f}ms cumulative {self_time / 1e3:9.1f}ms self  {name}")
+        if args.max_seconds is not None and total / 1e6 > args.max_seconds:
+            over_budget.append(module)
+
+    if over_budget:
+        print(f"[ERROR] Import time above {args.max_seconds}s: {', '.join(over_budget)}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -52,7 +52,12 @@ These projects have the following impacts on healthcare:
 The goal is to ensure accurate, helpful, and well-referenced responses based on the provided documents, synthesizing information from multiple relevant sources while disregarding unrelated content.
 This is your knowledge base: $documents"""),
         
-        "rag_no_docs" : Template("""You're only allowed to respond with: "I'm sorry, but there were no documents found that match your query. Please consider reformulating your question or feel free to ask about a different topic.""")
+        "rag_no_docs" : Template("""You're only allowed to respond with: "I'm sorry, but there were no documents found that match your query. Please consider reformulating your question or feel free to ask about a different topic."""),
+
+        "conversation" : Template("""$system_prompt
+
+This is the conversation with the employee so far, use it to understand follow-up questions:
+$conversation""")
     },
 
     "routing": {
@@ -297,7 +302,17 @@ Answer in valid JSON. Assign a fake but realistic value to replace the original
 """
     },
 
-    "summary": """Summarize the following document:"""
+    "summary": """Summarize the following document:""",
+
+    "conversation_summary": """You are an expert at summarizing conversations between an employee and an assistant.
+You will receive the summary of the conversation so far and the turns that followed it. Write an updated summary in a few sentences.
+Keep the topics, names, numbers and open questions the employee may refer to later, leave out greetings and details of the answers.
+Respond only with the summary.""",
+
+    "compression": """You are an expert at extracting the parts of a document that are relevant to a question.
+You will receive a question and a context. Extract AS IS any part of the context that is relevant to answer the question.
+Do not edit, rephrase or add anything to the extracted parts.
+If none of the context is relevant, respond only with NO_OUTPUT."""
 }
 
 user_prompt_templates = {
@@ -332,6 +347,20 @@ RESPONSE:
 
 },
 
+    "conversation_summary": Template("""SUMMARY:
+$summary
+NEW TURNS:
+$turns
+UPDATED SUMMARY:
+"""),
+
+    "compression": Template("""QUESTION:
+$question
+CONTEXT:
+$context
+EXTRACTED RELEVANT PARTS:
+"""),
+
     "testing": {
         "document_relevance": Template("""Question: $question
 Documents: $document_string"""),
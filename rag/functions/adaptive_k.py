@@ -0,0 +1,87 @@
+from typing import List
+
+"""
+Adaptive top-k: instead of always returning k_chunks documents, the number of documents is chosen from the
+relevance scores of a candidate pool. Easy questions with one clearly relevant chunk then only put that chunk into
+the generation prompt.
+"""
+
+
+def cut_by_score_gap(scores: List[float], min_k: int, max_k: int, min_gap: float) -> int:
+    """
+    Knee detection: cuts the candidates at the largest drop between two neighbouring relevance scores
+
+    Params:
+        scores: relevance scores, sorted descending
+        min_k: minimum number of documents to keep
+        max_k: maximum number of documents to keep
+        min_gap: minimum drop to be considered a knee, otherwise all candidates up to max_k are kept
+    Returns:
+        the number of documents to keep
+    """
+    n = min(len(scores), max_k)
+    if n <= min_k:
+        return n
+
+    best_k, best_gap = n, 0.0
+    for k in range(max(min_k, 1), n):
+        gap = scores[k - 1] - scores[k]
+        if gap > best_gap:
+            best_k, best_gap = k, gap
+
+    return best_k if best_gap >= min_gap else n
+
+
+def cut_by_cumulative_relevance(scores: List[float], min_k: int, max_k: int, threshold: float,
+                                score_floor: float = 0.0) -> int:
+    """
+    Keeps the smallest number of documents that together cover the given share of the total relevance.
+    The relevance of a document is its score above the score floor.
+
+    Params:
+        scores: relevance scores, sorted descending
+        min_k: minimum number of documents to keep
+        max_k: maximum number of documents to keep
+        threshold: share of the total relevance to cover, between 0 and 1
+        score_floor: score that counts as no relevance at all, usually the retrieval score threshold
+    Returns:
+        the number of documents to keep
+    """
+    n = min(len(scores), max_k)
+    if n <= min_k:
+        return n
+
+    weights = [max(score - score_floor, 0.0) for score in scores[:n]]
+    total = sum(weights)
+    if total <= 0:
+        return min_k
+
+    cumulative = 0.0
+    for k, weight in enumerate(weights, start=1):
+        cumulative += weight
+        if cumulative / total >= threshold:
+            return max(k, min_k)
+    return n
+
+
+def choose_k(scores: List[float], mode: str, min_k: int, max_k: int, min_gap: float = 0.05,
+             cumulative_threshold: float = 0.8, score_floor: float = 0.0) -> int:
+    """
+    Chooses the number of documents to keep according to the adaptive k mode
+
+    Params:
+        scores: relevance scores, sorted descending
+        mode: "gap" or "cumulative"
+        min_k: minimum number of documents to keep
+        max_k: maximum number of documents to keep
+        min_gap: see cut_by_score_gap
+        cumulative_threshold: see cut_by_cumulative_relevance
+        score_floor: see cut_by_cumulative_relevance
+    Returns:
+        the number of documents to keep
+    """
+    if mode == "gap":
+        return cut_by_score_gap(scores, min_k, max_k, min_gap)
+    elif mode == "cumulative":
+        return cut_by_cumulative_relevance(scores, min_k, max_k, cumulative_threshold, score_floor)
+    raise ValueError(f"Adaptive k mode {mode} not available.")
@@ -0,0 +1,164 @@
+import re
+from typing import List, Tuple
+
+from langchain_core.documents import Document
+
+from rag.functions.tokens import count_tokens, truncate_to_tokens
+
+"""
+Context packing: the retrieved chunks are put into the generation prompt without duplicate text and within a token
+budget. Neighbouring chunks of a page share the overlap of the text splitter and the same chunk can be retrieved
+twice, e.g. by the multi query or ensemble retrievers.
+"""
+
+# overlaps shorter than this are not removed, they are likely a coincidence
+MIN_OVERLAP = 10
+# the text splitters of the indexing and of the parent document retriever use an overlap of 20 characters
+MAX_OVERLAP = 200
+# a truncated chunk is only added if this many tokens are left for it
+MIN_TRUNCATED_TOKENS = 20
+
+SENTENCE_END = re.compile(r"[.!?](?=\s|$)")
+
+
+def _overlap(first: str, second: str) -> int:
+    """
+    Returns the length of the longest end of the first text that is the beginning of the second text
+    """
+    for length in range(min(MAX_OVERLAP, len(first), len(second)), MIN_OVERLAP - 1, -1):
+        if first.endswith(second[:length]):
+            return length
+    return 0
+
+
+def by_relevance(documents: List[Document]) -> List[Document]:
+    """
+    Orders documents by the relevance score of a reranker or by the rank the retrieval gave them before they were
+    reordered, if all of them have one
+
+    Params:
+        documents: the documents in retrieval order
+    Returns:
+        the documents, most relevant first
+    """
+    for key, sign in [("relevance_score", -1), ("retrieval_rank", 1)]:
+        if documents and all(key in document.metadata for document in documents):
+            return sorted(documents, key=lambda document: sign * document.metadata[key])
+    return list(documents)
+
+
+def deduplicate(documents: List[Document]) -> Tuple[List[Tuple[Document, str]], int, int]:
+    """
+    Removes duplicate chunks and the text that neighbouring chunks of a source share
+
+    Params:
+        documents: the documents, most relevant first
+    Returns:
+        the kept documents with their remaining text, the number of removed duplicates and of trimmed overlaps
+    """
+    kept = []
+    duplicates = overlaps = 0
+    for document in documents:
+        text = document.page_content.strip()
+        source = document.metadata.get("source")
+        if not text or any(text in other for _, other in kept):
+            duplicates += 1
+            continue
+        for other_document, other in kept:
+            if other_document.metadata.get("source") != source:
+                continue
+            # the chunk continues a kept chunk, or is continued by it
+            overlap = _overlap(other, text)
+            if overlap:
+                text = text[overlap:].lstrip()
+                overlaps += 1
+            overlap = _overlap(text, other)
+            if overlap:
+                text = text[:-overlap].rstrip()
+                overlaps += 1
+        if text:
+            kept.append((document, text))
+        else:
+            duplicates += 1
+    return kept, duplicates, overlaps
+
+
+def truncate_at_sentence(text: str, max_tokens: int, model: str) -> str:
+    """
+    Cuts a text to a number of tokens at the end of its last complete sentence
+
+    Params:
+        text: the text
+        max_tokens: the maximum number of tokens
+        model: the model the text is sent to
+    Returns:
+        the complete sentences within max_tokens, or the text cut at a word boundary if there is no sentence end
+    """
+    truncated = truncate_to_tokens(text, max_tokens, model)
+    if truncated == text:
+        return text
+    ends = [match.end() for match in SENTENCE_END.finditer(truncated)]
+    if ends:
+        return truncated[:ends[-1]]
+    return truncated.rsplit(" ", 1)[0]
+
+
+def format_document(document: Document, text: str) -> str:
+    return f"{text}\nSource: {document.metadata.get('source')}"
+
+
+def pack_documents(documents: List[Document], max_tokens: int, model: str) -> Tuple[str, dict]:
+    """
+    Puts the retrieved documents into one string for the generation prompt. Duplicate and overlapping text is
+    removed and the documents are added by relevance until max_tokens is reached, the document that does not fit
+    anymore is truncated at a sentence boundary. The packed documents keep the order they were given in, e.g. the
+    order of the long context reorder.
+
+    Params:
+        documents: the retrieved documents in retrieval order
+        max_tokens: the token budget of the documents, 0 for no limit
+        model: the model the documents are sent to
+    Returns:
+        the documents string and the packing statistics
+    """
+    original_tokens = sum(count_tokens(format_document(document, document.page_content), model)
+                          for document in documents)
+    kept, duplicates, overlaps = deduplicate(by_relevance(documents))
+    positions = {}
+    for position, document in enumerate(documents):
+        positions.setdefault(id(document), position)
+
+    parts = []
+    tokens = truncated = dropped = 0
+    for document, text in kept:
+        part = format_document(document, text)
+        part_tokens = count_tokens(part, model)
+        # the separator between two documents
+        separator_tokens = 1 if parts else 0
+        if max_tokens <= 0 or tokens + separator_tokens + part_tokens <= max_tokens:
+            parts.append((positions[id(document)], part))
+            tokens += separator_tokens + part_tokens
+            continue
+
+        source_tokens = count_tokens(format_document(document, ""), model)
+        remaining = max_tokens - tokens - separator_tokens - source_tokens
+        text = truncate_at_sentence(text, remaining, model) if remaining >= MIN_TRUNCATED_TOKENS else ""
+        if text:
+            part = format_document(document, text)
+            parts.append((positions[id(document)], part))
+            tokens += separator_tokens + count_tokens(part, model)
+            truncated += 1
+        dropped = len(kept) - len(parts)
+        break
+
+    return "\n\n".join(part for _, part in sorted(parts, key=lambda entry: entry[0])), {
+        "documents": len(documents),
+        "packed": len(parts),
+        "duplicates": duplicates,
+        "overlaps": overlaps,
+        "truncated": truncated,
+        "dropped": dropped,
+        "original_tokens": original_tokens,
+        "tokens": tokens,
+        "saved_tokens": original_tokens - tokens,
+    }
@@ -0,0 +1,154 @@
+from datetime import datetime
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
+
+"""
+Metadata filters restrict a retrieval to a subset of the index, e.g. one language, only pdfs or only recent documents.
+
+A filter is a plain dict:
+    {
+        "language": ["en", "de"],       # any of the given values
+        "type": "pdf",
+        "domain": "www.tum.de",
+        "date_from": "2024-01-01",      # ISO date, compared against the retrieval time of the document
+        "date_to": "2024-06-30"
+    }
+All given conditions must hold. Values may be a single string or a list of strings.
+"""
+
+VALUE_KEYS = ["language", "type", "domain", "title", "source"]
+DATE_KEYS = ["date_from", "date_to"]
+
+
+def get_domain(url: Optional[str]) -> Optional[str]:
+    """
+    Returns the domain of a url
+
+    Params:
+        url: the url
+    Returns:
+        the domain or None if the url is empty
+    """
+    if not url:
+        return None
+    return urlparse(url).netloc or None
+
+
+def to_timestamp(date) -> Optional[float]:
+    """
+    Converts an ISO date string to a unix timestamp
+
+    Params:
+        date: the ISO date string
+    Returns:
+        the timestamp or None if the date can't be parsed
+    """
+    if date is None:
+        return None
+    if isinstance(date, (int, float)):
+        return float(date)
+    try:
+        return datetime.fromisoformat(date).timestamp()
+    except (TypeError, ValueError):
+        return None
+
+
+def normalize_filter(metadata_filter: Optional[Dict]) -> Optional[Dict]:
+    """
+    Normalizes a filter so that all values are lists and all dates are timestamps
+
+    Params:
+        metadata_filter: the filter
+    Returns:
+        the normalized filter or None if it has no conditions
+    """
+    if not metadata_filter:
+        return None
+
+    normalized = {}
+    for key, value in metadata_filter.items():
+        if key in VALUE_KEYS:
+            values = [value] if isinstance(value, str) else list(value)
+            values = [v for v in values if v]
+            if values:
+                normalized[key] = values
+        elif key in DATE_KEYS:
+            timestamp = to_timestamp(value)
+            if timestamp is not None:
+                normalized[key] = timestamp
+        else:
+            raise ValueError(f"Unknown metadata filter key {key}. Options: {', '.join(VALUE_KEYS + DATE_KEYS)}")
+
+    return normalized or None
+
+
+def filter_from_config(retrieval_config) -> Optional[Dict]:
+    """
+    Builds the default filter from the filter_* options of the retrieval config
+
+    Params:
+        retrieval_config: the retrieval section of the config
+    Returns:
+        the normalized filter or None if no filter is configured
+    """
+    metadata_filter = {}
+    for key in ["language", "type", "domain"]:
+        value = retrieval_config[f"filter_{key}"].strip()
+        if value:
+            metadata_filter[key] = [v.strip() for v in value.split(",")]
+    for key in DATE_KEYS:
+        value = retrieval_config[f"filter_{key}"].strip()
+        if value:
+            metadata_filter[key] = value
+    return normalize_filter(metadata_filter)
+
+
+def matches(metadata: Dict, metadata_filter: Optional[Dict]) -> bool:
+    """
+    Checks whether a document's metadata satisfies a normalized filter
+
+    Params:
+        metadata: the document metadata
+        metadata_filter: the normalized filter
+    Returns:
+        whether all conditions hold
+    """
+    if not metadata_filter:
+        return True
+
+    for key, value in metadata_filter.items():
+        if key in VALUE_KEYS and metadata.get(key) not in value:
+            return False
+
+    timestamp = metadata.get("timestamp")
+    if "date_from" in metadata_filter and (timestamp is None or timestamp < metadata_filter["date_from"]):
+        return False
+    if "date_to" in metadata_filter and (timestamp is None or timestamp > metadata_filter["date_to"]):
+        return False
+    return True
+
+
+def to_chroma_where(metadata_filter: Optional[Dict]) -> Optional[Dict]:
+    """
+    Translates a normalized filter to a chroma where clause
+
+    Params:
+        metadata_filter: the normalized filter
+    Returns:
+        the where clause or None if the filter is empty
+    """
+    if not metadata_filter:
+        return None
+
+    conditions: List[Dict] = []
+    for key, value in metadata_filter.items():
+        if key in VALUE_KEYS:
+            conditions.append({key: {"$in": value}})
+    if "date_from" in metadata_filter:
+        conditions.append({"timestamp": {"$gte": metadata_filter["date_from"]}})
+    if "date_to" in metadata_filter:
+        conditions.append({"timestamp": {"$lte": metadata_filter["date_to"]}})
+
+    if len(conditions) == 1:
+        return conditions[0]
+    return {"$and": conditions}
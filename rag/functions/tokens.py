@@ -0,0 +1,61 @@
+from functools import lru_cache
+
+# used if the tiktoken encoding of a model cannot be loaded, e.g. for ollama models or without internet access
+CHARACTERS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = "gpt-3.5-turbo"):
+    """
+    Returns the tiktoken encoding of a model, loaded once per process
+
+    Params:
+        model: the model name
+    Returns:
+        the encoding, the cl100k_base encoding for unknown models, or None if tiktoken cannot load it
+    """
+    try:
+        import tiktoken
+        try:
+            return tiktoken.encoding_for_model(model)
+        except KeyError:
+            return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"[WARNING] No tiktoken encoding for {model}, tokens are estimated from the text length: {e}")
+        return None
+
+
+def count_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """
+    Counts the tokens of a text
+
+    Params:
+        text: the text
+        model: the model the text is sent to
+    Returns:
+        the number of tokens, estimated from the number of characters if there is no encoding for the model
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return -(-len(text) // CHARACTERS_PER_TOKEN)
+    return len(encoding.encode(text, disallowed_special=()))
+
+
+def truncate_to_tokens(text: str, max_tokens: int, model: str = "gpt-3.5-turbo") -> str:
+    """
+    Cuts a text to a number of tokens
+
+    Params:
+        text: the text
+        max_tokens: the maximum number of tokens
+        model: the model the text is sent to
+    Returns:
+        the text, or its beginning with at most max_tokens tokens
+    """
+    encoding = get_encoding(model)
+    if encoding is None:
+        return text[:max_tokens * CHARACTERS_PER_TOKEN]
+    tokens = encoding.encode(text, disallowed_special=())
+    if len(tokens) <= max_tokens:
+        return text
+    return encoding.decode(tokens[:max_tokens])
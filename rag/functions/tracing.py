@@ -0,0 +1,287 @@
+import contextvars
+import functools
+import inspect
+import json
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, List, Optional
+
+"""
+Tracing of the pipeline. A trace holds one span per graph node and per LLM call with its wall time and, for LLM
+calls, the model and the prompt and completion tokens. The active trace and span are kept in context variables, so
+spans opened anywhere below Pipeline are attached to the request that is being processed. Code that runs work in
+other threads has to pass the context on, see wrap.
+"""
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+_current_span = contextvars.ContextVar("current_span", default=None)
+
+
+class Span:
+    """
+    A timed operation within a trace
+    """
+
+    def __init__(self, name: str, parent_id: Optional[str], attributes: Dict[str, Any]):
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent_id
+        self.name = name
+        self.attributes = dict(attributes)
+        self.start_time = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+
+    def end(self) -> None:
+        self.duration = time.perf_counter() - self._start
+
+    def to_dict(self) -> dict:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_time": self.start_time,
+            "duration": self.duration,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """
+    All spans of one request
+    """
+
+    def __init__(self, name: str):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.start_time = time.time()
+        self.spans: List[Span] = []
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    def to_dict(self) -> dict:
+        with self._lock:
+            spans = [span.to_dict() for span in self.spans]
+        return {"trace_id": self.trace_id, "name": self.name, "start_time": self.start_time, "spans": spans}
+
+
+def current_trace() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextmanager
+def activate(trace: Optional[Trace]):
+    """
+    Makes the given trace the active trace of the enclosed code
+
+    Params:
+        trace: the trace, None disables tracing in the enclosed code
+    """
+    trace_token = _current_trace.set(trace)
+    span_token = _current_span.set(None)
+    try:
+        yield trace
+    finally:
+        _current_span.reset(span_token)
+        _current_trace.reset(trace_token)
+
+
+def context_with_trace(trace: Optional[Trace]) -> contextvars.Context:
+    """
+    Returns a copy of the current context in which the given trace is active
+
+    Params:
+        trace: the trace, None disables tracing in the context
+    Returns:
+        the context, run code in it with context.run
+    """
+    context = contextvars.copy_context()
+    context.run(_current_trace.set, trace)
+    context.run(_current_span.set, None)
+    return context
+
+
+def start_span(name: str, **attributes) -> Optional[Span]:
+    """
+    Starts a span below the current span without making it the current span. Used for operations that are resumed
+    in other contexts, like generators. The span has to be ended with end_span.
+
+    Params:
+        name: the span name
+        attributes: span attributes
+    Returns:
+        the span, None if there is no active trace
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        return None
+    parent = _current_span.get()
+    return Span(name, parent.span_id if parent else None, attributes)
+
+
+def end_span(span: Optional[Span]) -> None:
+    if span is None:
+        return
+    span.end()
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.add(span)
+
+
+@contextmanager
+def span(name: str, **attributes):
+    """
+    Records the enclosed code as a span of the active trace. Does nothing if no trace is active.
+
+    Params:
+        name: the span name
+        attributes: span attributes
+    Returns:
+        the span, None if there is no active trace
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield None
+        return
+
+    new_span = start_span(name, **attributes)
+    token = _current_span.set(new_span)
+    try:
+        yield new_span
+    except Exception as e:
+        new_span.attributes["error"] = repr(e)
+        raise
+    finally:
+        _current_span.reset(token)
+        new_span.end()
+        trace.add(new_span)
+
+
+def record_usage(span: Optional[Span], prompt_tokens: Optional[int], completion_tokens: Optional[int]) -> None:
+    """
+    Adds the token usage of a LLM call to its span
+
+    Params:
+        span: the span of the LLM call
+        prompt_tokens: the number of prompt tokens
+        completion_tokens: the number of completion tokens
+    """
+    if span is None:
+        return
+    span.attributes["prompt_tokens"] = prompt_tokens
+    span.attributes["completion_tokens"] = completion_tokens
+
+
+def traced(name: str, function: Callable) -> Callable:
+    """
+    Wraps a sync or async function, e.g. a graph node, so every call is recorded as a span
+
+    Params:
+        name: the span name
+        function: the function
+    Returns:
+        the wrapped function
+    """
+    if inspect.iscoroutinefunction(function):
+        @functools.wraps(function)
+        async def async_wrapper(*args, **kwargs):
+            with span(name):
+                return await function(*args, **kwargs)
+        return async_wrapper
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        with span(name):
+            return function(*args, **kwargs)
+    return wrapper
+
+
+def wrap(function: Callable) -> Callable:
+    """
+    Binds a function to the current context, so spans it opens in a worker thread belong to the current trace.
+    Use it for functions that are submitted to an executor.
+
+    Params:
+        function: the function
+    Returns:
+        the function running in a copy of the current context
+    """
+    context = contextvars.copy_context()
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        return context.copy().run(function, *args, **kwargs)
+    return wrapper
+
+
+class JsonLinesExporter:
+    """
+    Appends finished traces as JSON lines to a file
+    """
+
+    def __init__(self, filename: str):
+        self.filename = filename
+        self._lock = threading.Lock()
+
+    def export(self, trace: Trace) -> None:
+        line = json.dumps(trace.to_dict(), default=str)
+        with self._lock:
+            with open(self.filename, "a") as file:
+                file.write(line + "\n")
+
+
+class OpenTelemetryExporter:
+    """
+    Replays finished traces as OpenTelemetry spans. Requires the opentelemetry-api package, where the spans are sent
+    is configured with the OpenTelemetry SDK.
+    """
+
+    def __init__(self):
+        from opentelemetry import trace as otel_trace
+        self._otel_trace = otel_trace
+        self.tracer = otel_trace.get_tracer("rag.pipeline")
+
+    def export(self, trace: Trace) -> None:
+        spans = trace.to_dict()["spans"]
+        children = {}
+        for span_dict in spans:
+            children.setdefault(span_dict["parent_id"], []).append(span_dict)
+
+        def replay(span_dict, context):
+            start = int(span_dict["start_time"] * 1e9)
+            otel_span = self.tracer.start_span(span_dict["name"], context=context, start_time=start,
+                                               attributes={key: value for key, value in
+                                                           span_dict["attributes"].items() if value is not None})
+            child_context = self._otel_trace.set_span_in_context(otel_span)
+            for child in children.get(span_dict["span_id"], []):
+                replay(child, child_context)
+            otel_span.end(end_time=start + int((span_dict["duration"] or 0) * 1e9))
+
+        for root in children.get(None, []):
+            replay(root, None)
+
+
+def get_exporter(tracing_config):
+    """
+    Returns the trace exporter configured in the [tracing] section
+
+    Params:
+        tracing_config: the [tracing] config section
+    Returns:
+        the exporter
+    """
+    if tracing_config["export"] == "jsonl":
+        return JsonLinesExporter(tracing_config["filename"])
+    elif tracing_config["export"] == "opentelemetry":
+        try:
+            return OpenTelemetryExporter()
+        except ImportError:
+            print("[ERROR] Exporting traces to OpenTelemetry requires the opentelemetry-api package.")
+            exit()
+    else:
+        print(f"[ERROR] Trace export {tracing_config['export']} not available.")
+        exit()
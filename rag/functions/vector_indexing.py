@@ -5,20 +5,18 @@ import dotenv
 import tiktoken
 import tqdm
 from langchain.retrievers import MultiVectorRetriever
-from langchain_chroma import Chroma
 from langchain_core.documents.base import Document
 from langchain_core.embeddings.embeddings import Embeddings
 from langchain_core.stores import InMemoryByteStore
-from langchain_experimental.text_splitter import SemanticChunker
-from langchain_huggingface import HuggingFaceEmbeddings
 from langchain_openai.embeddings import OpenAIEmbeddings
 from langchain_text_splitters import RecursiveCharacterTextSplitter
 from langchain_text_splitters import TextSplitter
 
 from rag.fixtures.prompts import system_prompt_templates
 from rag.models.chatbot import Chatbot, get_chatbot
-from rag.models.databases import ChromaDB, VectorDB
+from rag.models.databases import ChromaDB, FaissDB, NumpyDB, ShardedDB, VectorDB
 from rag.models.dataloader import DataLoader
+from rag.models.embedding_cache import CachedEmbeddings
 
 dotenv.load_dotenv()
 
@@ -67,26 +65,41 @@ def split_documents(documents: List[Document], splitter: TextSplitter) -> List[D
 
 def index_documents(splitter: TextSplitter, embeddings: Embeddings, embeddings_model: str,
                     data_loader: DataLoader, persist_current_vectordb: bool=False,
-                    use_persist_directory: bool=False, persist_directory: str=None) -> ChromaDB:
-    """Indexes documents and puts them into a chroma vector database
+                    use_persist_directory: bool=False, persist_directory: str=None,
+                    vector_store: str="chroma", shards: int=4, shard_by: str="hash") -> VectorDB:
+    """Indexes documents and puts them into a vector database
 
-    Therefore, it loads json files, split them into chunks and embeds them into a chroma vector database
+    Therefore, it loads json files, split them into chunks and embeds them into a vector database
 
     Args:
         splitter: the langchain textsplitter to use
         embeddings: the embeddings to use for the vector database
         embeddings_model: used for calculating the tokens and cost
         data_loader: used to load the data
+        vector_store: the vector database backend: chroma, numpy, faiss or sharded
+        shards: number of shard worker processes of the sharded backend
+        shard_by: partitioning of the sharded backend: hash or domain
     Returns:
-        the chroma database
+        the vector database
     """
     documents = data_loader.load_data()
 
     calculate_embedding_cost(documents=documents, model=embeddings_model)
     split_docs = split_documents(documents, splitter)
-    print("[INFO] Creating database...")
-    return ChromaDB(embedding_function=embeddings, documents=split_docs, persist_current_vectordb=persist_current_vectordb,
-                    use_persist_directory=use_persist_directory, persist_directory=persist_directory)
+    print(f"[INFO] Creating {vector_store} database...")
+    if vector_store == "chroma":
+        return ChromaDB(embedding_function=embeddings, documents=split_docs, persist_current_vectordb=persist_current_vectordb,
+                        use_persist_directory=use_persist_directory, persist_directory=persist_directory)
+    elif vector_store == "numpy":
+        return NumpyDB(embedding_function=embeddings, documents=split_docs, persist_current_vectordb=persist_current_vectordb,
+                       use_persist_directory=use_persist_directory, persist_directory=persist_directory)
+    elif vector_store == "faiss":
+        return FaissDB(documents=split_docs, embedding_function=embeddings)
+    elif vector_store == "sharded":
+        return ShardedDB(documents=split_docs, embedding_function=embeddings, shards=shards, shard_by=shard_by)
+    else:
+        print(f"[Error] Vector store {vector_store} not available.")
+        exit()
 
 
 def index_documents_with_summaries(splitter: TextSplitter, embeddings: Embeddings, embeddings_model: str,
@@ -112,6 +125,7 @@ def index_documents_with_summaries(splitter: TextSplitter, embeddings: Embedding
     summaries = []
     for doc in split_docs:
         summaries.append(chatbot.custom_prompt(system_prompt_templates["summary"], doc.page_content))
+    from langchain_chroma import Chroma
     vectorstore = Chroma(collection_name="summaries", embedding_function=embeddings)
     store = InMemoryByteStore()
     id_key = "document_id"
@@ -138,6 +152,8 @@ def get_embeddings_and_text_splitter(index_config, openai_api_key: str) -> (Embe
     """
     print("[INFO] Creating database.")
     if index_config["embeddings"] == "HuggingFaceEmbeddings":
+        # sentence-transformers and torch are only loaded if local embeddings are used
+        from langchain_huggingface import HuggingFaceEmbeddings
         embeddings = HuggingFaceEmbeddings()
         print(f"[CONFIG] Embedding model {index_config['embeddings']}.")
 
@@ -165,6 +181,7 @@ def get_embeddings_and_text_splitter(index_config, openai_api_key: str) -> (Embe
             is_separator_regex=False
         )
     elif index_config["textsplitter"] == "SemanticTextSplitter":
+        from langchain_experimental.text_splitter import SemanticChunker
         text_splitter = SemanticChunker(OpenAIEmbeddings(openai_api_key=openai_api_key),
                                         breakpoint_threshold_type=index_config["textsplitter_semantic_breakpoint_type"])
     else:
@@ -185,7 +202,12 @@ def get_vectordb(config, data_loader: DataLoader) -> VectorDB:
     """
     index_config = config["indexing"]
     embeddings, text_splitter = get_embeddings_and_text_splitter(index_config, config["chatbot"]["openai_api_key"])
-    
+    # query embeddings are cached and shared by all retrievers built on top of this database
+    embeddings = CachedEmbeddings(embeddings,
+                                  model_name=index_config["embeddings"],
+                                  max_size=int(config["retrieval"]["query_embedding_cache_size"]),
+                                  ttl=float(config["retrieval"]["query_embedding_cache_ttl"]))
+
     if index_config["use_summaries"] == "True":
         summary_chatbot = get_chatbot(config, config["indexing"]["provider"], config["indexing"]["model"], None)
         vectordb = index_documents_with_summaries(
@@ -203,7 +225,10 @@ def get_vectordb(config, data_loader: DataLoader) -> VectorDB:
             data_loader=data_loader,
             persist_current_vectordb=index_config["persist_current_vectordb"] == "True",
             use_persist_directory=index_config["use_persist_directory"] == "True",
-            persist_directory=index_config["persist_directory"]
+            persist_directory=index_config["persist_directory"],
+            vector_store=index_config["vector_store"],
+            shards=int(index_config["shards"]),
+            shard_by=index_config["shard_by"]
         )
 
     print("[INFO] Vector Database created.")
@@ -1,11 +1,21 @@
+import asyncio
+import json
 import re
 import sys
+import threading
+import weakref
 from abc import ABC, abstractmethod
+from dataclasses import dataclass
 from string import Template
-from typing import List
+from typing import Any, Callable, Hashable, Iterator, List, Optional
+from urllib.parse import urlsplit
+import httpx
 import requests
+from requests.adapters import HTTPAdapter
 from langchain_core.documents import Document
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
+
+from rag.functions import tracing
 
 
 class Chatbot(ABC):
@@ -40,6 +50,46 @@ class Chatbot(ABC):
         """
         pass
 
+    async def aanswer_question(self, query: str) -> str:
+        """
+        Async version of answer_question. Runs answer_question in a worker thread unless the chatbot
+        has a native async implementation.
+
+        Params:
+            query: the question
+        Returns:
+            the chatbot answer
+        """
+        return await asyncio.to_thread(self.answer_question, query)
+
+    async def acustom_prompt(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> str:
+        """
+        Async version of custom_prompt. Runs custom_prompt in a worker thread unless the chatbot
+        has a native async implementation.
+
+        Params:
+            system_prompt: the system prompt
+            user_prompt: the user prompt
+            temperature: the llm temperature
+        Returns:
+            the chatbot answer
+        """
+        return await asyncio.to_thread(self.custom_prompt, system_prompt, user_prompt, temperature)
+
+    def stream(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> Iterator[str]:
+        """
+        Streaming version of custom_prompt. Yields the answer in pieces as they are generated, chatbots without
+        streaming support yield the whole answer at once.
+
+        Params:
+            system_prompt: the system prompt
+            user_prompt: the user prompt
+            temperature: the llm temperature
+        Returns:
+            iterator over the pieces of the chatbot answer
+        """
+        yield self.custom_prompt(system_prompt, user_prompt, temperature)
+
     @property
     @abstractmethod
     def model_name(self) -> str:
@@ -66,6 +116,9 @@ class TestChatbot(Chatbot):
     def custom_prompt(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> str:
         return self.fake_response
 
+    async def acustom_prompt(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> str:
+        return self.fake_response
+
     @property
     def model_name(self) -> str:
         return self.fake_model_name
@@ -113,9 +166,115 @@ def calculate_cost(completion_tokens: int, prompt_tokens: int, model: str) -> No
     print(f"[COST] Total cost for {model}: ${total_cost:.4f}")
 
 
+@dataclass(frozen=True)
+class ClientSettings:
+    """
+    Connection pool and timeout settings of the HTTP clients used by the chatbots
+    """
+    max_connections: int = 20
+    max_keepalive_connections: int = 10
+    keepalive_expiry: float = 30.0
+    timeout: float = 120.0
+    connect_timeout: float = 5.0
+    max_retries: int = 2
+
+    @classmethod
+    def from_config(cls, chatbot_config) -> "ClientSettings":
+        return cls(
+            max_connections=int(chatbot_config["max_connections"]),
+            max_keepalive_connections=int(chatbot_config["max_keepalive_connections"]),
+            keepalive_expiry=float(chatbot_config["keepalive_expiry"]),
+            timeout=float(chatbot_config["timeout"]),
+            connect_timeout=float(chatbot_config["connect_timeout"]),
+            max_retries=int(chatbot_config["max_retries"])
+        )
+
+    def httpx_limits(self) -> httpx.Limits:
+        return httpx.Limits(max_connections=self.max_connections,
+                            max_keepalive_connections=self.max_keepalive_connections,
+                            keepalive_expiry=self.keepalive_expiry)
+
+    def httpx_timeout(self) -> httpx.Timeout:
+        return httpx.Timeout(self.timeout, connect=self.connect_timeout)
+
+
+# Process wide registry of chatbots and HTTP clients. Async clients are kept per event loop, since their connections
+# are bound to the loop they were created in.
+_clients = {}
+_async_clients = weakref.WeakKeyDictionary()
+_clients_lock = threading.RLock()
+
+
+def shared_client(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """
+    Returns the shared object registered under the key, creating it on first use
+
+    Params:
+        key: the registry key, e.g. (provider, model, endpoint)
+        factory: creates the object
+    Returns:
+        the shared object
+    """
+    with _clients_lock:
+        client = _clients.get(key)
+        if client is None:
+            client = factory()
+            _clients[key] = client
+        return client
+
+
+def shared_async_client(key: Hashable, factory: Callable[[], Any]) -> Any:
+    """
+    Returns the shared async client of the running event loop registered under the key, creating it on first use
+
+    Params:
+        key: the registry key
+        factory: creates the client
+    Returns:
+        the shared async client
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = factory()
+            clients[key] = client
+        return client
+
+
+async def aclose_clients() -> None:
+    """
+    Closes and removes the shared async clients of the running event loop. Their connections are bound to the loop,
+    so this is awaited before the loop ends, e.g. at the end of the coroutine passed to asyncio.run.
+    """
+    loop = asyncio.get_running_loop()
+    with _clients_lock:
+        clients = _async_clients.pop(loop, {})
+    for client in clients.values():
+        # httpx clients are closed with aclose, the openai clients with an async close
+        close = getattr(client, "aclose", None) or getattr(client, "close", None)
+        if close is not None:
+            result = close()
+            if asyncio.iscoroutine(result):
+                await result
+
+
+def endpoint_of(url: str) -> str:
+    parts = urlsplit(url)
+    return f"{parts.scheme}://{parts.netloc}"
+
+
 class OpenAIChatbot(Chatbot):
-    def __init__(self, api_key, model, default_system_prompt=None):
-        self.openai_client = OpenAI(api_key=api_key)
+    def __init__(self, api_key, model, default_system_prompt=None, settings: Optional[ClientSettings] = None):
+        self.api_key = api_key
+        self.settings = settings or ClientSettings()
+        self.openai_client = shared_client(
+            ("openai", api_key, self.settings),
+            lambda: OpenAI(api_key=api_key, max_retries=self.settings.max_retries,
+                           http_client=httpx.Client(limits=self.settings.httpx_limits(),
+                                                    timeout=self.settings.httpx_timeout()))
+        )
         self.model = model
         self.default_system_prompt = default_system_prompt
 
@@ -126,15 +285,74 @@ class OpenAIChatbot(Chatbot):
         return formatted_answer
 
     def custom_prompt(self, system_prompt: str, user_prompt: str, temperature: float = 0.4):
+        with tracing.span("llm", provider="openai", model=self.model) as span:
+            completion = self.openai_client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=temperature
+            )
+            if completion.usage:
+                tracing.record_usage(span, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+
+        return completion.choices[0].message.content
+
+    def stream(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> Iterator[str]:
+        # the generator is resumed by the consumer, the span is not made the current span
+        span = tracing.start_span("llm", provider="openai", model=self.model, stream=True)
         completion = self.openai_client.chat.completions.create(
             model=self.model,
             messages=[
                 {"role": "system", "content": system_prompt},
                 {"role": "user", "content": user_prompt}
             ],
-            temperature=temperature
+            temperature=temperature,
+            stream=True,
+            stream_options={"include_usage": True}
+        )
+
+        try:
+            for chunk in completion:
+                if chunk.usage:
+                    tracing.record_usage(span, chunk.usage.prompt_tokens, chunk.usage.completion_tokens)
+                if chunk.choices and chunk.choices[0].delta.content:
+                    yield chunk.choices[0].delta.content
+        finally:
+            tracing.end_span(span)
+
+    def async_openai_client(self) -> AsyncOpenAI:
+        """
+        Returns the async OpenAI client of the running event loop
+
+        Returns:
+            the async client
+        """
+        return shared_async_client(
+            ("openai", self.api_key, self.settings),
+            lambda: AsyncOpenAI(api_key=self.api_key, max_retries=self.settings.max_retries,
+                                http_client=httpx.AsyncClient(limits=self.settings.httpx_limits(),
+                                                              timeout=self.settings.httpx_timeout()))
         )
 
+    async def aanswer_question(self, question):
+        answer = await self.acustom_prompt(self.default_system_prompt, question)
+        return format_source(answer)
+
+    async def acustom_prompt(self, system_prompt: str, user_prompt: str, temperature: float = 0.4):
+        with tracing.span("llm", provider="openai", model=self.model) as span:
+            completion = await self.async_openai_client().chat.completions.create(
+                model=self.model,
+                messages=[
+                    {"role": "system", "content": system_prompt},
+                    {"role": "user", "content": user_prompt}
+                ],
+                temperature=temperature
+            )
+            if completion.usage:
+                tracing.record_usage(span, completion.usage.prompt_tokens, completion.usage.completion_tokens)
+
         return completion.choices[0].message.content
 
     @property
@@ -146,11 +364,27 @@ class OllamaChatbot(Chatbot):
     """
     Ollama chatbot
     """
-    def __init__(self, url, model, default_system_prompt=None):
+    def __init__(self, url, model, default_system_prompt=None, settings: Optional[ClientSettings] = None):
         self.url = url
         self.model = model
         self.default_system_prompt = default_system_prompt
+        self.settings = settings or ClientSettings()
+        self.timeout = (self.settings.connect_timeout, self.settings.timeout)
+        self.session = shared_client(("ollama", endpoint_of(url), self.settings), self._create_session)
 
+    def _create_session(self) -> requests.Session:
+        """
+        Creates a session with a connection pool sized for concurrent requests to the Ollama server
+
+        Returns:
+            the session
+        """
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.settings.max_connections,
+                              max_retries=self.settings.max_retries)
+        session.mount("http://", adapter)
+        session.mount("https://", adapter)
+        return session
 
     def answer_question(self, question):
         answer = self.custom_prompt(self.default_system_prompt, question)
@@ -174,8 +408,83 @@ class OllamaChatbot(Chatbot):
             "prompt": system_prompt + user_prompt,
             "stream": False
         }
-        response = requests.post(self.url, json=payload)
-        return response.json()["response"]
+        with tracing.span("llm", provider="ollama", model=self.model) as span:
+            response = self.session.post(self.url, json=payload, timeout=self.timeout).json()
+            tracing.record_usage(span, response.get("prompt_eval_count"), response.get("eval_count"))
+        return response["response"]
+
+    def stream(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> Iterator[str]:
+        """
+        Streaming version of custom_prompt. Ollama streams one JSON object per line.
+
+        Args:
+            system_prompt: the system prompt
+            user_prompt: the user prompt
+            temperature: the temperature. Currently not implemented in this chatbot.
+        Returns:
+            iterator over the pieces of the llm response
+        """
+        payload = {
+            "model": self.model,
+            "prompt": system_prompt + user_prompt,
+            "stream": True
+        }
+        # the generator is resumed by the consumer, the span is not made the current span
+        span = tracing.start_span("llm", provider="ollama", model=self.model, stream=True)
+        try:
+            with self.session.post(self.url, json=payload, stream=True, timeout=self.timeout) as response:
+                response.raise_for_status()
+                for line in response.iter_lines():
+                    if not line:
+                        continue
+                    chunk = json.loads(line)
+                    # errors after the response has started, e.g. an unknown model, are sent as a chunk
+                    if "error" in chunk:
+                        raise RuntimeError(f"Ollama streaming failed: {chunk['error']}")
+                    if chunk.get("response"):
+                        yield chunk["response"]
+                    if chunk.get("done"):
+                        tracing.record_usage(span, chunk.get("prompt_eval_count"), chunk.get("eval_count"))
+                        break
+        finally:
+            tracing.end_span(span)
+
+    def async_client(self) -> httpx.AsyncClient:
+        """
+        Returns the async http client of the running event loop
+
+        Returns:
+            the async client
+        """
+        return shared_async_client(
+            ("ollama", endpoint_of(self.url), self.settings),
+            lambda: httpx.AsyncClient(limits=self.settings.httpx_limits(), timeout=self.settings.httpx_timeout())
+        )
+
+    async def aanswer_question(self, question):
+        answer = await self.acustom_prompt(self.default_system_prompt, question)
+        return format_source(answer)
+
+    async def acustom_prompt(self, system_prompt: str, user_prompt: str, temperature: float = 0.4) -> str:
+        """
+        Async version of custom_prompt
+
+        Args:
+            system_prompt: the system prompt
+            user_prompt: the user prompt
+            temperature: the temperature. Currently not implemented in this chatbot.
+        Returns:
+            the llm response
+        """
+        payload = {
+            "model": self.model,
+            "prompt": system_prompt + user_prompt,
+            "stream": False
+        }
+        with tracing.span("llm", provider="ollama", model=self.model) as span:
+            response = (await self.async_client().post(self.url, json=payload)).json()
+            tracing.record_usage(span, response.get("prompt_eval_count"), response.get("eval_count"))
+        return response["response"]
 
     @property
     def model_name(self) -> str:
@@ -184,21 +493,27 @@ class OllamaChatbot(Chatbot):
 
 def get_chatbot(config, provider, model, default_system_prompt=None) -> "Chatbot":
     """
-    Returns a chatbot configured according to the given parameters
+    Returns a chatbot configured according to the given parameters. Chatbots are shared process wide per provider,
+    model, endpoint and default system prompt, and all chatbots of one endpoint share a pooled HTTP client.
 
     Params:
         config: the config file
         provider: the model provider
         model: the specific model
-        prompt_template_name: the prompt template
+        default_system_prompt: the system prompt used by answer_question
     Returns:
         the configured chatbot
     """
-    
+    settings = ClientSettings.from_config(config["chatbot"])
+
     if provider == "openai":
-        return OpenAIChatbot(config["chatbot"]["openai_api_key"], model, default_system_prompt)
+        api_key = config["chatbot"]["openai_api_key"]
+        return shared_client(("chatbot", provider, model, api_key, default_system_prompt, settings),
+                             lambda: OpenAIChatbot(api_key, model, default_system_prompt, settings))
     elif provider == "ollama":
-        return OllamaChatbot(config["chatbot"]["ollama_url"], model, default_system_prompt)
+        url = config["chatbot"]["ollama_url"]
+        return shared_client(("chatbot", provider, model, url, default_system_prompt, settings),
+                             lambda: OllamaChatbot(url, model, default_system_prompt, settings))
     else:
         print(f"[ERROR] Chatbot Model {model} from {provider} not available.")
         sys.exit(0)
\ No newline at end of file
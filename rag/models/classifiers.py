@@ -0,0 +1,252 @@
+import json
+import os
+import threading
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+
+import numpy as np
+from langchain_core.embeddings.embeddings import Embeddings
+
+
+_decision_log_lock = threading.Lock()
+
+
+def load_labeled_queries(test_case_files: List[str], decision_log: Optional[str] = None) -> Tuple[List[str], List[int]]:
+    """
+    Loads labeled queries from test case files and from a log of earlier LLM decisions
+
+    Params:
+        test_case_files: routing test case files with "question" and a "True"/"False" "answer" per test case, or
+            guardrail test case files with "test" and a boolean "correct" per test case
+        decision_log: JSON lines file with a "query" and a boolean "label" per line, ignored if it does not exist
+    Returns:
+        the queries and their labels (1 for true, 0 for false)
+    """
+    queries, labels = [], []
+    for path in test_case_files:
+        with open(path) as file:
+            test_cases = json.load(file)
+        if isinstance(test_cases, dict):
+            for test_case in test_cases["test_cases"]:
+                queries.append(test_case["question"])
+                labels.append(1 if test_case["answer"].strip().lower() == "true" else 0)
+        else:
+            for test_case in test_cases:
+                queries.append(test_case["test"])
+                labels.append(1 if test_case["correct"] else 0)
+
+    if decision_log and os.path.exists(decision_log):
+        with open(decision_log) as file:
+            for line in file:
+                if line.strip():
+                    entry = json.loads(line)
+                    queries.append(entry["query"])
+                    labels.append(1 if entry["label"] else 0)
+    return queries, labels
+
+
+def log_labeled_query(decision_log: str, query: str, label: bool) -> None:
+    """
+    Appends a LLM decision to a decision log, so it is used as training data on the next start
+
+    Params:
+        decision_log: the JSON lines file
+        query: the query
+        label: the decision of the LLM
+    """
+    with _decision_log_lock, open(decision_log, "a") as file:
+        file.write(json.dumps({"query": query, "label": label}) + "\n")
+
+
+class PendingDecisions:
+    """
+    LLM decisions that are held back until the guardrails have checked their query. The decision logs are training
+    data that is kept on disk, so a query is only written once it is known not to contain pii.
+    """
+
+    def __init__(self, decision_log: str, max_pending: int = 1000):
+        self.decision_log = decision_log
+        self.max_pending = max_pending
+
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+
+    def add(self, query: str, label: bool) -> None:
+        with self._lock:
+            self._pending[query] = label
+            while len(self._pending) > self.max_pending:
+                self._pending.popitem(last=False)
+
+    def commit(self, query: str) -> None:
+        """
+        Writes the pending decision of a query to the decision log
+
+        Params:
+            query: the query, as checked by the guardrails
+        """
+        with self._lock:
+            label = self._pending.pop(query, None)
+        if label is not None:
+            log_labeled_query(self.decision_log, query, label)
+
+    def discard(self, query: str) -> None:
+        with self._lock:
+            self._pending.pop(query, None)
+
+
+class QueryClassifier(ABC):
+    """
+    Base class of binary classifiers over normalized query embeddings.
+
+    The query embedding is taken from the (cached) embedding function of the vector database, so it is shared with
+    retrieval, routing and the semantic cache and a prediction costs little more than a dot product. Queries with a
+    score between the two thresholds are not decided, the caller is expected to ask a LLM instead.
+    """
+
+    def __init__(self, embedding_function: Embeddings, threshold_low: float, threshold_high: float):
+        self.embedding_function = embedding_function
+        self.threshold_low = threshold_low
+        self.threshold_high = threshold_high
+        self.training_size = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _normalize(vectors: np.ndarray) -> np.ndarray:
+        norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+        return vectors / np.where(norms > 0, norms, 1.0)
+
+    def _embed(self, query: str) -> np.ndarray:
+        return self._normalize(np.asarray(self.embedding_function.embed_query(query), dtype=np.float32))
+
+    def _embed_training_queries(self, queries: List[str], labels: List[int]) -> Tuple[np.ndarray, np.ndarray]:
+        y = np.asarray(labels, dtype=np.float32)
+        if len(y) == 0 or y.min() == y.max():
+            print("[ERROR] A query classifier needs training queries of both classes.")
+            exit()
+        return self._normalize(np.asarray(self.embedding_function.embed_documents(queries), dtype=np.float32)), y
+
+    @abstractmethod
+    def fit(self, queries: List[str], labels: List[int]) -> None:
+        """
+        Trains the classifier
+
+        Params:
+            queries: the training queries
+            labels: 1 or 0 per query
+        """
+        pass
+
+    @abstractmethod
+    def score(self, query: str) -> float:
+        """
+        Scores a query, compared with threshold_low and threshold_high by decide
+
+        Params:
+            query: the query
+        Returns:
+            the score, higher for the positive class
+        """
+        pass
+
+    def decide(self, query: str) -> Tuple[Optional[bool], float]:
+        """
+        Decides a query if the classifier is confident enough
+
+        Params:
+            query: the query
+        Returns:
+            the decision, None between the thresholds, and the score of the query
+        """
+        score = self.score(query)
+        if score >= self.threshold_high:
+            return True, score
+        if score <= self.threshold_low:
+            return False, score
+        return None, score
+
+
+class EmbeddingClassifier(QueryClassifier):
+    """
+    Binary logistic regression over normalized query embeddings. The score is the probability of the positive class.
+    """
+
+    def __init__(self, embedding_function: Embeddings, uncertainty_low: float = 0.2, uncertainty_high: float = 0.8,
+                 regularization: float = 0.01, epochs: int = 500, learning_rate: float = 0.5):
+        super().__init__(embedding_function, uncertainty_low, uncertainty_high)
+        self.regularization = regularization
+        self.epochs = epochs
+        self.learning_rate = learning_rate
+
+        self.weights = None
+        self.bias = 0.0
+
+    def fit(self, queries: List[str], labels: List[int]) -> None:
+        """
+        Trains the classifier with full batch gradient descent. Both classes are weighted equally, so a few logged
+        decisions of one class do not shift the decision boundary.
+
+        Params:
+            queries: the training queries
+            labels: 1 or 0 per query
+        """
+        x, y = self._embed_training_queries(queries, labels)
+        sample_weights = np.where(y == 1, 0.5 / y.mean(), 0.5 / (1 - y.mean()))
+
+        weights = np.zeros(x.shape[1], dtype=np.float32)
+        bias = 0.0
+        for _ in range(self.epochs):
+            probabilities = 1 / (1 + np.exp(-(x @ weights + bias)))
+            error = (probabilities - y) * sample_weights
+            weights -= self.learning_rate * (x.T @ error / len(y) + self.regularization * weights)
+            bias -= self.learning_rate * float(error.mean())
+
+        with self._lock:
+            self.weights = weights
+            self.bias = bias
+            self.training_size = len(y)
+
+    def score(self, query: str) -> float:
+        """
+        Returns the probability of the positive class
+
+        Params:
+            query: the query
+        Returns:
+            the probability between 0 and 1
+        """
+        with self._lock:
+            weights, bias = self.weights, self.bias
+        return float(1 / (1 + np.exp(-(self._embed(query) @ weights + bias))))
+
+
+class NearestCentroidClassifier(QueryClassifier):
+    """
+    Nearest centroid classifier over normalized query embeddings. The score is the cosine similarity to the centroid
+    of the positive queries minus the similarity to the centroid of the negative queries, so 0 is the decision
+    boundary.
+    """
+
+    def __init__(self, embedding_function: Embeddings, threshold_low: float = -0.05, threshold_high: float = 0.05):
+        super().__init__(embedding_function, threshold_low, threshold_high)
+        self.centroids = None
+
+    def fit(self, queries: List[str], labels: List[int]) -> None:
+        """
+        Computes the normalized centroid of both classes
+
+        Params:
+            queries: the training queries
+            labels: 1 or 0 per query
+        """
+        x, y = self._embed_training_queries(queries, labels)
+        centroids = self._normalize(np.stack([x[y == 1].mean(axis=0), x[y == 0].mean(axis=0)]))
+        with self._lock:
+            self.centroids = centroids
+            self.training_size = len(y)
+
+    def score(self, query: str) -> float:
+        with self._lock:
+            centroids = self.centroids
+        similarities = centroids @ self._embed(query)
+        return float(similarities[0] - similarities[1])
@@ -0,0 +1,119 @@
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.callbacks import Callbacks
+from langchain_core.documents import Document
+from langchain_core.documents.compressor import BaseDocumentCompressor
+
+from rag.fixtures.prompts import system_prompt_templates, user_prompt_templates
+from rag.functions import tracing
+
+SENTENCE_PATTERN = re.compile(r"(?<=[.!?])\s+|\n+")
+
+
+def split_sentences(text: str) -> List[str]:
+    """
+    Splits a text into sentences at sentence punctuation and line breaks
+
+    Params:
+        text: the text
+    Returns:
+        the non-empty sentences
+    """
+    return [sentence.strip() for sentence in SENTENCE_PATTERN.split(text) if sentence.strip()]
+
+
+class TimedCompressor(BaseDocumentCompressor):
+    """
+    Base class of the compressors that keeps latency statistics
+    """
+    calls: int = 0
+    total_seconds: float = 0.0
+    last_seconds: float = 0.0
+
+    def _record(self, start: float) -> None:
+        self.last_seconds = time.perf_counter() - start
+        self.total_seconds += self.last_seconds
+        self.calls += 1
+
+    def stats(self) -> dict:
+        return {
+            "calls": self.calls,
+            "last_seconds": self.last_seconds,
+            "mean_seconds": self.total_seconds / self.calls if self.calls else 0.0,
+        }
+
+
+class EmbeddingsSentenceFilter(TimedCompressor):
+    """
+    Compressor that keeps only the sentences of each document that are similar enough to the query.
+
+    All sentences of all documents are embedded in a single batched embedding call, so the compression costs
+    one round trip to the embedding provider instead of one LLM call per document.
+    """
+    embeddings: Any
+    similarity_threshold: float = 0.5
+
+    def compress_documents(self, documents: Sequence[Document], query: str,
+                           callbacks: Optional[Callbacks] = None) -> Sequence[Document]:
+        start = time.perf_counter()
+        sentences_per_document = [split_sentences(doc.page_content) for doc in documents]
+        sentences = [sentence for doc_sentences in sentences_per_document for sentence in doc_sentences]
+        if not sentences:
+            self._record(start)
+            return []
+
+        sentence_vectors = np.asarray(self.embeddings.embed_documents(sentences), dtype=np.float32)
+        query_vector = np.asarray(self.embeddings.embed_query(query), dtype=np.float32)
+        sentence_vectors /= np.linalg.norm(sentence_vectors, axis=1, keepdims=True) + 1e-12
+        query_vector /= np.linalg.norm(query_vector) + 1e-12
+        similarities = sentence_vectors @ query_vector
+
+        compressed_documents = []
+        offset = 0
+        for doc, doc_sentences in zip(documents, sentences_per_document):
+            doc_similarities = similarities[offset:offset + len(doc_sentences)]
+            offset += len(doc_sentences)
+            kept = [sentence for sentence, similarity in zip(doc_sentences, doc_similarities)
+                    if similarity >= self.similarity_threshold]
+            if kept:
+                compressed_documents.append(Document(page_content=" ".join(kept), metadata=doc.metadata))
+
+        self._record(start)
+        return compressed_documents
+
+
+class ParallelLLMExtractor(TimedCompressor):
+    """
+    Compressor that lets a LLM extract the relevant parts of each document, like LLMChainExtractor,
+    but sends the requests for all documents concurrently with a bounded number of workers.
+    """
+    chatbot: Any
+    max_concurrency: int = 5
+    temperature: float = 0.0
+
+    def _extract(self, document: Document, query: str) -> Optional[Document]:
+        answer = self.chatbot.custom_prompt(
+            system_prompt_templates["compression"],
+            user_prompt_templates["compression"].substitute(question=query, context=document.page_content),
+            temperature=self.temperature
+        ).strip()
+        if not answer or "NO_OUTPUT" in answer:
+            return None
+        return Document(page_content=answer, metadata=document.metadata)
+
+    def compress_documents(self, documents: Sequence[Document], query: str,
+                           callbacks: Optional[Callbacks] = None) -> Sequence[Document]:
+        start = time.perf_counter()
+        if not documents:
+            self._record(start)
+            return []
+
+        with ThreadPoolExecutor(max_workers=max(1, min(self.max_concurrency, len(documents)))) as executor:
+            extracted = list(executor.map(tracing.wrap(lambda doc: self._extract(doc, query)), documents))
+
+        self._record(start)
+        return [doc for doc in extracted if doc is not None]
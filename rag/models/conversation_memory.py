@@ -0,0 +1,208 @@
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import List, Optional, Tuple
+
+from rag.fixtures.prompts import system_prompt_templates, user_prompt_templates
+from rag.functions.logger import CustomLogger
+from rag.functions.tokens import count_tokens, truncate_to_tokens
+
+
+@dataclass
+class ConversationContext:
+    """
+    The part of a conversation that is sent with a request, and how it was selected
+    """
+    text: str
+    turns: int
+    verbatim_turns: int
+    summarized_turns: int
+    dropped_turns: int
+    summary_tokens: int
+    tokens: int
+
+
+def _format_turn(turn: Tuple[str, str]) -> str:
+    return f"Employee: {turn[0]}\nAssistant: {turn[1]}"
+
+
+class ConversationMemory:
+    """
+    Fits the conversation of a request into a token budget.
+
+    The last turns are sent verbatim, at most max_turns and max_tokens - summary_max_tokens tokens of them. The older
+    turns are folded into a rolling summary of at most summary_max_tokens tokens. The pipeline receives the whole
+    conversation with every request, so the summaries are cached by a hash of the summarized turns: when a turn is
+    evicted, only this turn is summarized together with the cached summary of the turns before it. With background,
+    the summary is updated in a worker thread after the request, which is then answered with the previous summary.
+    """
+
+    def __init__(self, chatbot, model: str, max_tokens: int = 1000, max_turns: int = 4, summary: bool = True,
+                 summary_max_tokens: int = 200, background: bool = True, max_summaries: int = 1024,
+                 exclude_answers: Optional[List[str]] = None, logger: Optional[CustomLogger] = None):
+        self.chatbot = chatbot
+        self.model = model
+        self.max_tokens = max_tokens
+        self.max_turns = max_turns
+        self.summary = summary
+        self.summary_max_tokens = summary_max_tokens if summary else 0
+        self.max_summaries = max_summaries
+        self.exclude_answers = set(exclude_answers or [])
+        self.logger = logger
+
+        self.executor = ThreadPoolExecutor(max_workers=2) if summary and background else None
+        self._summaries = OrderedDict()
+        self._in_flight = set()
+        self._lock = threading.Lock()
+
+        self.summary_calls = 0
+        self.summarized_turns = 0
+        self.stale_summaries = 0
+
+    def turns(self, conversation: List[str]) -> List[Tuple[str, str]]:
+        """
+        Pairs the alternating questions and answers of a conversation. Turns answered by a guardrail are left out,
+        their questions may contain pii.
+
+        Params:
+            conversation: the questions and answers, alternating
+        Returns:
+            the (question, answer) turns
+        """
+        pairs = zip(conversation[0::2], conversation[1::2])
+        return [(question, answer) for question, answer in pairs if answer not in self.exclude_answers]
+
+    @staticmethod
+    def _prefix_keys(turns: List[Tuple[str, str]]) -> List[str]:
+        # keys[i] identifies the turns up to and including turn i
+        keys = []
+        digest = ""
+        for question, answer in turns:
+            digest = hashlib.sha1(f"{digest}\0{question}\0{answer}".encode()).hexdigest()
+            keys.append(digest)
+        return keys
+
+    def build(self, conversation: List[str]) -> ConversationContext:
+        """
+        Selects the part of a conversation that is sent with a request
+
+        Params:
+            conversation: the questions and answers, alternating
+        Returns:
+            the conversation text for the prompt and the token accounting
+        """
+        turns = self.turns(conversation)
+        budget = self.max_tokens - self.summary_max_tokens
+        verbatim, verbatim_tokens = [], 0
+        for turn in reversed(turns[-self.max_turns:] if self.max_turns > 0 else []):
+            text = _format_turn(turn)
+            tokens = count_tokens(text, self.model)
+            if verbatim_tokens + tokens > budget:
+                break
+            verbatim.insert(0, text)
+            verbatim_tokens += tokens
+        evicted = len(turns) - len(verbatim)
+
+        summary, summarized = "", 0
+        if self.summary and evicted:
+            summary, summarized = self._summary(turns, evicted)
+        summary_tokens = count_tokens(summary, self.model) if summary else 0
+
+        parts = [f"Summary of the earlier conversation: {summary}"] if summary else []
+        text = "\n\n".join(parts + verbatim)
+        return ConversationContext(text=text, turns=len(turns), verbatim_turns=len(verbatim),
+                                   summarized_turns=summarized, dropped_turns=evicted - summarized,
+                                   summary_tokens=summary_tokens, tokens=verbatim_tokens + summary_tokens)
+
+    def _cached_prefix(self, keys: List[str], end: int) -> Tuple[int, str]:
+        # the longest summarized prefix of the first end turns
+        with self._lock:
+            for length in range(end, 0, -1):
+                if keys[length - 1] in self._summaries:
+                    self._summaries.move_to_end(keys[length - 1])
+                    return length, self._summaries[keys[length - 1]]
+        return 0, ""
+
+    def _summary(self, turns: List[Tuple[str, str]], evicted: int) -> Tuple[str, int]:
+        """
+        Returns the summary of the evicted turns
+
+        Params:
+            turns: all turns
+            evicted: the number of turns at the beginning that are not sent verbatim
+        Returns:
+            the summary and the number of turns it covers, fewer than evicted if a background update is pending
+        """
+        keys = self._prefix_keys(turns[:evicted])
+        length, summary = self._cached_prefix(keys, evicted)
+        if length == evicted:
+            return summary, length
+
+        if self.executor is None:
+            return self._summarize(turns, keys, evicted), evicted
+
+        with self._lock:
+            self.stale_summaries += 1
+            schedule = keys[-1] not in self._in_flight
+            self._in_flight.add(keys[-1])
+        if schedule:
+            self.executor.submit(self._summarize_in_background, turns[:evicted], keys)
+        return summary, length
+
+    def _summarize_in_background(self, turns: List[Tuple[str, str]], keys: List[str]) -> None:
+        try:
+            self._summarize(turns, keys, len(turns))
+        except Exception as e:
+            if self.logger is not None:
+                self.logger.log(f"[CONVERSATION] Summary update failed: {e}")
+        finally:
+            with self._lock:
+                self._in_flight.discard(keys[-1])
+
+    def _summarize(self, turns: List[Tuple[str, str]], keys: List[str], end: int) -> str:
+        """
+        Folds the turns after the longest summarized prefix into its summary and caches the new summary
+
+        Params:
+            turns: the turns
+            keys: the prefix keys of the turns
+            end: the number of turns to summarize
+        Returns:
+            the summary of the first end turns
+        """
+        length, summary = self._cached_prefix(keys, end)
+        if length == end:
+            return summary
+        new_turns = "\n\n".join(_format_turn(turn) for turn in turns[length:end])
+        summary = self.chatbot.custom_prompt(
+            system_prompt_templates["conversation_summary"],
+            user_prompt_templates["conversation_summary"].substitute(summary=summary or "-", turns=new_turns)
+        ).strip()
+        summary = truncate_to_tokens(summary, self.summary_max_tokens, self.model)
+
+        with self._lock:
+            self.summary_calls += 1
+            self.summarized_turns += end - length
+            self._summaries[keys[end - 1]] = summary
+            self._summaries.move_to_end(keys[end - 1])
+            while len(self._summaries) > self.max_summaries:
+                self._summaries.popitem(last=False)
+        return summary
+
+    def stats(self) -> dict:
+        """
+        Returns the summary counters
+
+        Returns:
+            the number of summary calls, summarized turns, requests answered with an outdated summary and cached
+            summaries
+        """
+        with self._lock:
+            return {
+                "summary_calls": self.summary_calls,
+                "summarized_turns": self.summarized_turns,
+                "stale_summaries": self.stale_summaries,
+                "cached_summaries": len(self._summaries),
+            }
@@ -0,0 +1,234 @@
+import json
+from abc import ABC, abstractmethod
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import asdict, dataclass, field
+from typing import List, Optional
+
+from langchain_core.documents import Document
+
+
+@dataclass
+class Turn:
+    """
+    One question and answer of a conversation. Only the metadata and a preview of the retrieved documents are kept,
+    which is all the UI shows.
+    """
+    question: str
+    answer: str
+    sources: List[dict] = field(default_factory=list)
+
+
+def to_sources(documents: List[Document], preview_length: Optional[int] = None) -> List[dict]:
+    """
+    Reduces retrieved documents to what the UI shows of them
+
+    Params:
+        documents: the documents
+        preview_length: the number of characters of the content that are kept, None for the whole content
+    Returns:
+        the source, title, date and content preview per document
+    """
+    return [{"source": document.metadata.get("source"),
+             "title": document.metadata.get("title"),
+             "date": document.metadata.get("date"),
+             "content": document.page_content[:preview_length]} for document in documents]
+
+
+class ConversationStore(ABC):
+    """
+    Base class of the conversation stores, which keep the conversation of every session of the web app.
+
+    A conversation is bounded to the last max_turns turns and is dropped once it was not used for ttl seconds, so the
+    memory needed per session is constant. All methods are thread safe.
+    """
+
+    def __init__(self, max_turns: int = 10, ttl: float = 3600):
+        self.max_turns = max_turns
+        self.ttl = ttl
+
+    @abstractmethod
+    def get(self, session_id: str) -> List[Turn]:
+        """
+        Returns the conversation of a session and renews its ttl
+
+        Params:
+            session_id: the session
+        Returns:
+            the turns, oldest first, empty for an unknown or expired session
+        """
+        pass
+
+    @abstractmethod
+    def append(self, session_id: str, turn: Turn) -> None:
+        """
+        Appends a turn to the conversation of a session, dropping the turns beyond max_turns
+
+        Params:
+            session_id: the session
+            turn: the new turn
+        """
+        pass
+
+    @abstractmethod
+    def clear(self, session_id: str) -> None:
+        """
+        Drops the conversation of a session
+
+        Params:
+            session_id: the session
+        """
+        pass
+
+    @abstractmethod
+    def stats(self) -> dict:
+        """
+        Returns the store counters, used for sizing the store
+
+        Returns:
+            the backend and the number of sessions, and further counters of the backend
+        """
+        pass
+
+    def history(self, session_id: str) -> List[str]:
+        """
+        Returns the conversation of a session in the form expected by the pipeline
+
+        Params:
+            session_id: the session
+        Returns:
+            the questions and answers, alternating
+        """
+        return [message for turn in self.get(session_id) for message in (turn.question, turn.answer)]
+
+
+class InMemoryConversationStore(ConversationStore):
+    """
+    Conversation store in the memory of the process with LRU eviction of whole sessions and a TTL per session.
+    """
+
+    def __init__(self, max_sessions: int = 1000, max_turns: int = 10, ttl: float = 3600):
+        super().__init__(max_turns, ttl)
+        self.max_sessions = max_sessions
+
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.evictions = 0
+        self.expirations = 0
+
+    def _session(self, session_id: str, create: bool = False):
+        entry = self._sessions.get(session_id)
+        if entry is not None and self.ttl > 0 and time.monotonic() - entry[1] > self.ttl:
+            del self._sessions[session_id]
+            self.expirations += 1
+            entry = None
+        if entry is None:
+            if not create:
+                return None
+            entry = ([], time.monotonic())
+        self._sessions[session_id] = (entry[0], time.monotonic())
+        self._sessions.move_to_end(session_id)
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evictions += 1
+        return entry[0]
+
+    def get(self, session_id: str) -> List[Turn]:
+        with self._lock:
+            turns = self._session(session_id)
+            return list(turns) if turns is not None else []
+
+    def append(self, session_id: str, turn: Turn) -> None:
+        with self._lock:
+            turns = self._session(session_id, create=True)
+            turns.append(turn)
+            del turns[:-self.max_turns]
+
+    def clear(self, session_id: str) -> None:
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+    def stats(self) -> dict:
+        """
+        Returns the store counters, used for sizing the store
+
+        Returns:
+            the number of sessions and turns, evictions and expirations
+        """
+        with self._lock:
+            return {
+                "backend": "memory",
+                "sessions": len(self._sessions),
+                "max_sessions": self.max_sessions,
+                "turns": sum(len(turns) for turns, _ in self._sessions.values()),
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+            }
+
+
+class RedisConversationStore(ConversationStore):
+    """
+    Conversation store in Redis, shared by several processes or servers of the web app. Every session is a Redis list
+    of JSON encoded turns, which is trimmed to max_turns and expires ttl seconds after its last use.
+    """
+
+    def __init__(self, url: str = "redis://localhost:6379/0", max_turns: int = 10, ttl: float = 3600,
+                 prefix: str = "conversation:"):
+        super().__init__(max_turns, ttl)
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.prefix = prefix
+
+    def _key(self, session_id: str) -> str:
+        return self.prefix + session_id
+
+    def get(self, session_id: str) -> List[Turn]:
+        key = self._key(session_id)
+        with self.client.pipeline() as pipe:
+            pipe.lrange(key, 0, -1)
+            if self.ttl > 0:
+                pipe.expire(key, int(self.ttl))
+            entries = pipe.execute()[0]
+        return [Turn(**json.loads(entry)) for entry in entries]
+
+    def append(self, session_id: str, turn: Turn) -> None:
+        key = self._key(session_id)
+        with self.client.pipeline() as pipe:
+            pipe.rpush(key, json.dumps(asdict(turn)))
+            pipe.ltrim(key, -self.max_turns, -1)
+            if self.ttl > 0:
+                pipe.expire(key, int(self.ttl))
+            pipe.execute()
+
+    def clear(self, session_id: str) -> None:
+        self.client.delete(self._key(session_id))
+
+    def stats(self) -> dict:
+        return {
+            "backend": "redis",
+            "sessions": sum(1 for _ in self.client.scan_iter(match=self.prefix + "*")),
+        }
+
+
+def get_conversation_store(config) -> ConversationStore:
+    """
+    Creates the conversation store configured in the conversation section
+
+    Params:
+        config: the configuration
+    Returns:
+        the conversation store
+    """
+    backend = config["conversation"]["backend"]
+    max_turns = int(config["conversation"]["max_turns"])
+    ttl = float(config["conversation"]["ttl"])
+    if backend == "memory":
+        return InMemoryConversationStore(int(config["conversation"]["max_sessions"]), max_turns, ttl)
+    elif backend == "redis":
+        return RedisConversationStore(config["conversation"]["redis_url"], max_turns, ttl)
+    else:
+        print(f"[ERROR] Conversation store backend {backend} not available.")
+        exit()
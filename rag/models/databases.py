@@ -1,15 +1,168 @@
+import atexit
+import hashlib
+import heapq
+import json
+import multiprocessing
+import os
+import threading
+import zlib
 from abc import ABC
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Tuple
 
+import numpy as np
 from langchain.retrievers import ContextualCompressionRetriever, ParentDocumentRetriever, EnsembleRetriever
 from langchain.retrievers.document_compressors import LLMChainExtractor
 from langchain.retrievers.multi_query import MultiQueryRetriever
 from langchain.storage import InMemoryStore
-from langchain_cohere import CohereRerank
 from langchain_community.retrievers import BM25Retriever, SVMRetriever
 from langchain_community.vectorstores import Chroma, FAISS
 from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain.retrievers.document_compressors import CrossEncoderReranker
-from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag.functions.metadata_filter import VALUE_KEYS, get_domain, matches, normalize_filter, to_chroma_where
+
+# minimum relevance score of a retrieved chunk
+SCORE_THRESHOLD = 0.4
+
+
+def cosine_to_relevance(similarities: np.ndarray) -> np.ndarray:
+    """
+    Converts cosine similarities of normalized vectors to the relevance scores langchain reports for chroma and faiss.
+    Both return the squared euclidean distance (2 - 2 * cos for normalized vectors), which langchain maps to
+    1 - distance / sqrt(2). The same score threshold then means the same on every backend.
+
+    Params:
+        similarities: cosine similarities
+    Returns:
+        relevance scores
+    """
+    return 1.0 - (2.0 - 2.0 * similarities) / np.sqrt(2.0)
+
+
+def normalize_rows(vectors) -> np.ndarray:
+    """
+    Returns a contiguous float32 copy of the vectors scaled to unit length
+    """
+    vectors = np.array(vectors, dtype=np.float32)
+    if vectors.size == 0:
+        # no documents, embed_documents([]) returns an empty list
+        return vectors.reshape(0, vectors.shape[1] if vectors.ndim == 2 else 0)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True) + 1e-12
+    return vectors
+
+
+class MetadataColumns:
+    """
+    One integer code column per metadata key and a timestamp column, aligned with the ids of an index.
+    A filter is evaluated as a few vectorized comparisons of the codes instead of a scan over the documents.
+    """
+
+    def __init__(self, metadatas: List[Dict]):
+        self.size = len(metadatas)
+        # per key the code of every value and the code of every id, -1 if the id has no value
+        self.codes = {key: {} for key in VALUE_KEYS}
+        self.columns = {key: np.full(self.size, -1, dtype=np.int32) for key in VALUE_KEYS}
+        self.timestamps = np.full(self.size, np.nan)
+        for i, metadata in enumerate(metadatas):
+            for key in VALUE_KEYS:
+                value = metadata.get(key)
+                if value is not None:
+                    codes = self.codes[key]
+                    self.columns[key][i] = codes.setdefault(value, len(codes))
+            if metadata.get("timestamp") is not None:
+                self.timestamps[i] = metadata["timestamp"]
+
+    def mask(self, metadata_filter: Optional[Dict]) -> np.ndarray:
+        """
+        Returns the bitmap of the ids matching a normalized filter
+        """
+        mask = np.ones(self.size, dtype=bool)
+        if not metadata_filter:
+            return mask
+        for key, values in metadata_filter.items():
+            if key in VALUE_KEYS:
+                codes = [self.codes[key][value] for value in values if value in self.codes[key]]
+                mask &= np.isin(self.columns[key], codes)
+        with np.errstate(invalid="ignore"):
+            if "date_from" in metadata_filter:
+                mask &= self.timestamps >= metadata_filter["date_from"]
+            if "date_to" in metadata_filter:
+                mask &= self.timestamps <= metadata_filter["date_to"]
+        return mask
+
+
+class ExactIndex:
+    """
+    Exact nearest neighbour index over normalized embeddings in one contiguous float32 matrix
+    """
+
+    def __init__(self, vectors: Optional[np.ndarray], metadatas: List[Dict], normalized: bool = False):
+        if vectors is None or len(vectors) == 0:
+            vectors = np.empty((0, 0), dtype=np.float32)
+        elif not normalized:
+            vectors = normalize_rows(vectors)
+        self.vectors = vectors
+        self.columns = MetadataColumns(metadatas)
+
+    def __len__(self) -> int:
+        return self.vectors.shape[0]
+
+    def search(self, query_vectors: np.ndarray, k: int, metadata_filter: Optional[Dict] = None,
+               score_threshold: Optional[float] = None) -> List[List[Tuple[int, float]]]:
+        """
+        Searches the k nearest neighbours of a batch of query vectors with one matrix product
+
+        Params:
+            query_vectors: matrix with one query embedding per row
+            k: the number of neighbours
+            metadata_filter: normalized metadata filter
+            score_threshold: minimum relevance score
+        Returns:
+            per query the ids and relevance scores of the neighbours, most relevant first
+        """
+        query_vectors = np.asarray(query_vectors, dtype=np.float32)
+        if len(self) == 0 or k <= 0:
+            return [[] for _ in range(len(query_vectors))]
+
+        query_vectors = normalize_rows(query_vectors)
+        # rank by cosine similarity, only the top k are converted to relevance scores
+        similarities = query_vectors @ self.vectors.T
+        if metadata_filter:
+            similarities[:, ~self.columns.mask(metadata_filter)] = -np.inf
+
+        k = min(k, len(self))
+        if k < len(self):
+            top = np.argpartition(similarities, len(self) - k, axis=1)[:, len(self) - k:]
+        else:
+            top = np.tile(np.arange(len(self)), (len(similarities), 1))
+
+        minimum = -np.inf if score_threshold is None else score_threshold
+        results = []
+        for row, ids in zip(similarities, top):
+            ids = ids[np.argsort(-row[ids])]
+            ids = ids[row[ids] != -np.inf]
+            scores = cosine_to_relevance(row[ids])
+            results.append([(int(i), float(score)) for i, score in zip(ids, scores) if score >= minimum])
+        return results
+
+
+class VectorDBRetriever(BaseRetriever):
+    """
+    Retriever that delegates to VectorDB.search_with_scores, used whenever a search needs more than the plain
+    langchain vector store retriever, e.g. a metadata filter.
+    """
+    vector_db: Any
+    k: int = 5
+    filter: Optional[Dict] = None
+    score_threshold: Optional[float] = SCORE_THRESHOLD
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun) -> List[Document]:
+        return [doc for doc, _ in self.vector_db.search_with_scores(query, k=self.k, filter=self.filter,
+                                                                     score_threshold=self.score_threshold)]
+
 
 class DB(ABC):
     def __init__(self, documents):
@@ -22,26 +175,106 @@ class VectorDB(DB, ABC):
         self.embedding_function = embedding_function
         self.vector_db = None
         self.retriever = None
+        self._fingerprint = None
+        self._cross_encoder = None
+
+    def search_with_scores(self, query: str, k: int, filter: Optional[Dict] = None,
+                           score_threshold: Optional[float] = None) -> List[Tuple[Document, float]]:
+        """
+        Returns the k most similar documents together with their relevance score in [0, 1].
+
+        The base implementation over-fetches and filters the results afterwards, subclasses push the filter down
+        into the search of their vector store.
+
+        Args:
+            query: the query
+            k: the number of documents to return
+            filter: metadata filter, see rag.functions.metadata_filter
+            score_threshold: minimum relevance score
+        Returns:
+            the documents and their scores, most relevant first
+        """
+        metadata_filter = normalize_filter(filter)
+        fetch_k = k if metadata_filter is None else 4 * k
+        kwargs = {} if score_threshold is None else {"score_threshold": score_threshold}
+        try:
+            docs_and_scores = self.vector_db.similarity_search_with_relevance_scores(query, k=fetch_k, **kwargs)
+        except AttributeError:
+            raise NotImplementedError("The vector database has not been initialized for this instance of VectorDB.")
+        return [(doc, score) for doc, score in docs_and_scores if matches(doc.metadata, metadata_filter)][:k]
+
+    def embed_queries(self, queries: List[str]) -> List[List[float]]:
+        """
+        Embeds several queries with a single call to the embedding provider
+
+        Args:
+            queries: the queries
+        Returns:
+            one embedding per query
+        """
+        if hasattr(self.embedding_function, "embed_queries"):
+            return self.embedding_function.embed_queries(queries)
+        return self.embedding_function.embed_documents(queries)
+
+    def search_with_scores_batch(self, queries: List[str], k: int, filter: Optional[Dict] = None,
+                                 score_threshold: Optional[float] = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Batched version of search_with_scores. All queries are embedded in one provider call and, for backends that
+        support it, searched in one batched nearest neighbour search.
+
+        Args:
+            queries: the queries
+            k: the number of documents per query
+            filter: metadata filter
+            score_threshold: minimum relevance score
+        Returns:
+            per query the documents and their scores, most relevant first
+        """
+        if hasattr(self, "search_with_scores_by_vectors"):
+            return self.search_with_scores_by_vectors(self.embed_queries(queries), k, filter, score_threshold)
 
-    def get_base_retriever(self, k):
+        # the embeddings end up in the query embedding cache, the single searches below don't embed again
+        self.embed_queries(queries)
+        return [self.search_with_scores(query, k, filter, score_threshold) for query in queries]
+
+    def get_base_retriever(self, k, filter=None):
+        if normalize_filter(filter) is not None:
+            return VectorDBRetriever(vector_db=self, k=k, filter=normalize_filter(filter))
+        if self.vector_db is None and not self.retriever:
+            # backends without a langchain vector store implement search_with_scores themselves
+            self.retriever = VectorDBRetriever(vector_db=self, k=k)
         try:
             if not self.retriever:
                 self.retriever = self.vector_db.as_retriever(search_type="similarity_score_threshold",
-                                                             search_kwargs={"score_threshold": 0.4, "k": k})
+                                                             search_kwargs={"score_threshold": SCORE_THRESHOLD, "k": k})
             return self.retriever
         except AttributeError:
             raise NotImplementedError("The vector database has not been initialized for this instance of VectorDB.")
 
-    def get_compression_retriever(self, llm, k):
+    def get_compression_retriever(self, llm, k, filter=None, compressor=None):
+        if normalize_filter(filter) is not None:
+            return ContextualCompressionRetriever(
+                base_compressor=compressor or LLMChainExtractor.from_llm(llm),
+                base_retriever=self.get_base_retriever(k=k, filter=filter)
+            )
         if not self.retriever:
             retriever = self.get_base_retriever(k=k)
-            _filter = LLMChainExtractor.from_llm(llm)
+            _filter = compressor or LLMChainExtractor.from_llm(llm)
             self.retriever = ContextualCompressionRetriever(
                 base_compressor=_filter, base_retriever=retriever
             )
         return self.retriever
     
-    def get_parent_document_retriever(self, chunk_size, chunk_overlap):
+    def get_parent_document_retriever(self, chunk_size, chunk_overlap, filter=None):
+        if normalize_filter(filter) is not None:
+            # share the child chunk index, child chunks inherit the metadata of their parents
+            retriever = self.get_parent_document_retriever(chunk_size, chunk_overlap)
+            return ParentDocumentRetriever(
+                vectorstore=retriever.vectorstore,
+                docstore=retriever.docstore,
+                child_splitter=retriever.child_splitter,
+                search_kwargs={"filter": to_chroma_where(normalize_filter(filter))}
+            )
         if not self.retriever:
             child_splitter = RecursiveCharacterTextSplitter(chunk_size=chunk_size, chunk_overlap=chunk_overlap)
             # vector store for child chunks 
@@ -58,17 +291,29 @@ class VectorDB(DB, ABC):
             self.retriever = parent_document_retriever
         return self.retriever
     
-    def get_svm_retriever(self):
+    def get_svm_retriever(self, filter=None):
+        # the svm is trained per query over the whole corpus, so a filter can only be applied to its results
         if not self.retriever:
             self.retriever = SVMRetriever.from_documents(self.documents, self.embedding_function)
         return self.retriever
 
-    def get_multi_query_retriever(self, llm, k):
+    def get_multi_query_retriever(self, llm, k, filter=None):
+        if normalize_filter(filter) is not None:
+            return MultiQueryRetriever.from_llm(llm=llm, retriever=self.get_base_retriever(k=k, filter=filter))
         if not self.retriever:
             self.retriever = MultiQueryRetriever.from_llm(llm=llm, retriever=self.get_base_retriever(k=k))
         return self.retriever
 
-    def get_ensemble_retriever(self, weights, k):
+    def get_ensemble_retriever(self, weights, k, filter=None):
+        metadata_filter = normalize_filter(filter)
+        if metadata_filter is not None:
+            filtered_documents = [doc for doc in self.documents if matches(doc.metadata, metadata_filter)]
+            if not filtered_documents:
+                return self.get_base_retriever(k=k, filter=filter)
+            bm25_retriever = BM25Retriever.from_documents(filtered_documents)
+            bm25_retriever.k = k
+            return EnsembleRetriever(retrievers=[bm25_retriever, self.get_base_retriever(k=k, filter=filter)],
+                                     weights=weights)
         if not self.retriever:
             bm25_retriever = BM25Retriever.from_documents(self.documents)
             bm25_retriever.k = k
@@ -76,18 +321,29 @@ class VectorDB(DB, ABC):
                                                weights=weights)
         return self.retriever
 
-    def cohere_compression(self, k):
-        retriever = self.get_base_retriever(k=k)
+    def cohere_compression(self, k, filter=None):
+        from langchain_cohere import CohereRerank
+
+        retriever = self.get_base_retriever(k=k, filter=filter)
         compressor = CohereRerank()
         compression_retriever = ContextualCompressionRetriever(
             base_compressor=compressor, base_retriever=retriever
         )
         return compression_retriever
     
-    def cross_encoder_compression(self,k):
-        retriever = self.get_base_retriever(k=k)
+    def get_cross_encoder(self):
+        # the model is loaded once and shared by all requests
+        if self._cross_encoder is None:
+            from langchain_community.cross_encoders import HuggingFaceCrossEncoder
+            self._cross_encoder = HuggingFaceCrossEncoder(model_name="BAAI/bge-reranker-base")
+        return self._cross_encoder
+
+    def cross_encoder_compression(self, k, filter=None):
+        from langchain.retrievers.document_compressors import CrossEncoderReranker
+
+        retriever = self.get_base_retriever(k=k, filter=filter)
 
-        model = HuggingFaceCrossEncoder(model_name="BAAI/bge-reranker-base")
+        model = self.get_cross_encoder()
         compressor = CrossEncoderReranker(model=model)
 
         compression_retriever = ContextualCompressionRetriever(
@@ -95,6 +351,30 @@ class VectorDB(DB, ABC):
         )
         return compression_retriever
 
+    def fingerprint(self) -> str:
+        """
+        Returns a fingerprint of the indexed content and the embedding model. It changes whenever the index is rebuilt
+        with different documents, which is used to invalidate caches built on top of the database.
+
+        Returns:
+            the hex digest of the fingerprint
+        """
+        if self._fingerprint is None:
+            digest = hashlib.sha1(str(getattr(self.embedding_function, "model_name", self.embedding_function)).encode())
+            for doc in self.documents or []:
+                digest.update(str(doc.metadata.get("source")).encode())
+                digest.update(doc.page_content.encode())
+            self._fingerprint = digest.hexdigest()
+        return self._fingerprint
+
+    def embedding_cache_stats(self) -> dict:
+        """
+        Returns the hit/miss counters of the query embedding cache, or an empty dict if the embedding function is not cached
+        """
+        if hasattr(self.embedding_function, "stats"):
+            return self.embedding_function.stats()
+        return {}
+
     def __str__(self) -> str:
         return f"VectorDB with {len(self.documents)} documents and {self.embedding_function} as embedding function"
 
@@ -115,9 +395,385 @@ class ChromaDB(VectorDB):
                 print("[INFO] Persist directory created")
             else: 
                 self.vector_db = Chroma.from_documents(documents=documents, embedding=embedding_function)
+
+    def search_with_scores(self, query: str, k: int, filter: Optional[Dict] = None,
+                           score_threshold: Optional[float] = None) -> List[Tuple[Document, float]]:
+        kwargs = {} if score_threshold is None else {"score_threshold": score_threshold}
+        where = to_chroma_where(normalize_filter(filter))
+        if where is not None:
+            kwargs["filter"] = where
+        return self.vector_db.similarity_search_with_relevance_scores(query, k=k, **kwargs)
+
+    def search_with_scores_by_vectors(self, query_vectors, k: int, filter: Optional[Dict] = None,
+                                      score_threshold: Optional[float] = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches a batch of query embeddings with a single chroma query
+
+        Params:
+            query_vectors: one query embedding per query
+            k: the number of documents per query
+            filter: metadata filter
+            score_threshold: minimum relevance score
+        Returns:
+            per query the documents and their scores, most relevant first
+        """
+        if len(query_vectors) == 0:
+            return []
+        results = self.vector_db._collection.query(
+            query_embeddings=[list(vector) for vector in query_vectors],
+            n_results=k,
+            where=to_chroma_where(normalize_filter(filter)),
+            include=["documents", "metadatas", "distances"]
+        )
+        relevance_score_fn = self.vector_db._select_relevance_score_fn()
+        docs_and_scores = []
+        for texts, metadatas, distances in zip(results["documents"], results["metadatas"], results["distances"]):
+            query_results = []
+            for text, metadata, distance in zip(texts, metadatas, distances):
+                score = relevance_score_fn(distance)
+                if score_threshold is None or score >= score_threshold:
+                    query_results.append((Document(page_content=text, metadata=metadata or {}), score))
+            docs_and_scores.append(query_results)
+        return docs_and_scores
+
+    def get_base_retriever(self, k, filter=None):
+        where = to_chroma_where(normalize_filter(filter))
+        if where is None:
+            return super().get_base_retriever(k=k)
+        # chroma evaluates the where clause inside the search
+        return self.vector_db.as_retriever(search_type="similarity_score_threshold",
+                                           search_kwargs={"score_threshold": SCORE_THRESHOLD, "k": k, "filter": where})
+
+    def fingerprint(self) -> str:
+        if self._fingerprint is None and not self.documents:
+            # persisted database without the original documents, fall back to the collection itself
+            collection = self.vector_db._collection
+            digest = hashlib.sha1(f"{self.embedding_function}|{collection.name}|{collection.count()}".encode())
+            self._fingerprint = digest.hexdigest()
+        return super().fingerprint()
                 
 
 class FaissDB(VectorDB):
     def __init__(self, documents, embedding_function):
         super().__init__(documents, embedding_function)
         self.vector_db = FAISS.from_documents(documents=documents, embedding=embedding_function)
+        # metadata columns aligned with the faiss ids
+        self._columns = MetadataColumns([
+            self.vector_db.docstore.search(self.vector_db.index_to_docstore_id[i]).metadata
+            for i in range(self.vector_db.index.ntotal)
+        ])
+
+    def search_with_scores(self, query: str, k: int, filter: Optional[Dict] = None,
+                           score_threshold: Optional[float] = None) -> List[Tuple[Document, float]]:
+        return self.search_with_scores_by_vectors([self.embedding_function.embed_query(query)], k, filter,
+                                                  score_threshold)[0]
+
+    def search_with_scores_by_vectors(self, query_vectors, k: int, filter: Optional[Dict] = None,
+                                      score_threshold: Optional[float] = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches a batch of query embeddings with a single faiss search. A metadata filter is passed to faiss
+        as a bitmap of the allowed ids.
+
+        Params:
+            query_vectors: one query embedding per query
+            k: the number of documents per query
+            filter: metadata filter
+            score_threshold: minimum relevance score
+        Returns:
+            per query the documents and their scores, most relevant first
+        """
+        import faiss
+
+        vectors = np.array(query_vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+
+        params = None
+        metadata_filter = normalize_filter(filter)
+        if metadata_filter is not None:
+            mask = self._columns.mask(metadata_filter)
+            k = min(k, int(mask.sum()))
+            if k == 0:
+                return [[] for _ in vectors]
+            # the bitmap restricts the search to the allowed ids, so the filter costs nothing in the index scan
+            bitmap = np.packbits(mask, bitorder="little")
+            params = faiss.SearchParameters(sel=faiss.IDSelectorBitmap(mask.size, faiss.swig_ptr(bitmap)))
+
+        if self.vector_db._normalize_L2:
+            faiss.normalize_L2(vectors)
+        if params is None:
+            distances, indices = self.vector_db.index.search(vectors, k)
+        else:
+            distances, indices = self.vector_db.index.search(vectors, k, params=params)
+
+        relevance_score_fn = self.vector_db._select_relevance_score_fn()
+        docs_and_scores = []
+        for query_distances, query_indices in zip(distances, indices):
+            query_results = []
+            for distance, i in zip(query_distances, query_indices):
+                if i == -1:
+                    continue
+                score = relevance_score_fn(float(distance))
+                if score_threshold is None or score >= score_threshold:
+                    doc = self.vector_db.docstore.search(self.vector_db.index_to_docstore_id[int(i)])
+                    query_results.append((doc, score))
+            docs_and_scores.append(query_results)
+        return docs_and_scores
+
+
+class NumpyDB(VectorDB):
+    """
+    Exact brute-force vector database for small and medium corpora.
+
+    The normalized embeddings are stored in one contiguous float32 matrix, memory-mapped from persist_directory
+    if given. A query is a single matrix-vector product followed by argpartition, a batch of queries a single
+    matrix-matrix product. For corpora below a million chunks this avoids the overhead of an approximate index.
+    """
+
+    def __init__(self, embedding_function, documents=None, persist_current_vectordb=False, use_persist_directory=False,
+                 persist_directory=None):
+        super().__init__(documents, embedding_function)
+
+        if use_persist_directory:
+            with open(os.path.join(persist_directory, "documents.json"), "r") as file:
+                self.documents = [Document(page_content=doc["page_content"], metadata=doc["metadata"])
+                                  for doc in json.load(file)]
+            vectors = np.load(os.path.join(persist_directory, "embeddings.npy"), mmap_mode="r")
+            print("[INFO] Using persist directory")
+        else:
+            vectors = normalize_rows(self.embedding_function.embed_documents([doc.page_content for doc in documents]))
+            if persist_current_vectordb:
+                vectors = self._persist(vectors, persist_directory)
+                print("[INFO] Persist directory created")
+
+        self.index = ExactIndex(vectors, [doc.metadata for doc in self.documents], normalized=True)
+
+    def _persist(self, vectors: np.ndarray, persist_directory: str) -> np.ndarray:
+        """
+        Writes the embeddings and documents to the persist directory and returns the embeddings memory-mapped
+        """
+        os.makedirs(persist_directory, exist_ok=True)
+        path = os.path.join(persist_directory, "embeddings.npy")
+        matrix = np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=vectors.shape)
+        matrix[:] = vectors
+        matrix.flush()
+        del matrix
+        with open(os.path.join(persist_directory, "documents.json"), "w") as file:
+            json.dump([{"page_content": doc.page_content, "metadata": doc.metadata} for doc in self.documents], file)
+        return np.load(path, mmap_mode="r")
+
+    def search_with_scores(self, query: str, k: int, filter: Optional[Dict] = None,
+                           score_threshold: Optional[float] = None) -> List[Tuple[Document, float]]:
+        return self.search_with_scores_by_vectors([self.embedding_function.embed_query(query)], k, filter,
+                                                  score_threshold)[0]
+
+    def search_with_scores_by_vectors(self, query_vectors, k: int, filter: Optional[Dict] = None,
+                                      score_threshold: Optional[float] = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches a batch of query embeddings with one matrix-matrix product
+
+        Params:
+            query_vectors: one query embedding per row
+            k: the number of documents per query
+            filter: metadata filter
+            score_threshold: minimum relevance score
+        Returns:
+            per query the documents and their scores, most relevant first
+        """
+        results = self.index.search(np.asarray(query_vectors, dtype=np.float32), k, normalize_filter(filter),
+                                    score_threshold)
+        return [[(self.documents[i], score) for i, score in result] for result in results]
+
+    def __str__(self) -> str:
+        return f"NumpyDB with {len(self.documents)} documents and {self.embedding_function} as embedding function"
+
+
+class ShardedDB(VectorDB):
+    """
+    Vector database that partitions the chunks across several local worker processes.
+
+    Every shard worker holds the normalized embeddings of its chunks and answers exact nearest neighbour searches.
+    A query is sent to all shards at once, the shards search in parallel on their own cores and the top k of all
+    shards are merged by score. The documents themselves stay in this process, only ids and scores are exchanged.
+    """
+
+    def __init__(self, documents, embedding_function, shards: int = 4, shard_by: str = "hash"):
+        super().__init__(documents, embedding_function)
+        if shard_by not in ["hash", "domain"]:
+            raise ValueError(f"Sharding by {shard_by} not available. Options: hash, domain")
+        self.shard_by = shard_by
+
+        # forked workers start without importing the entry point of the application again, spawn is the fallback
+        # on platforms without fork
+        start_method = "fork" if "fork" in multiprocessing.get_all_start_methods() else "spawn"
+        context = multiprocessing.get_context(start_method)
+        self._shards = [_ShardProcess(context) for _ in range(shards)]
+        self._shard_documents = [[] for _ in range(shards)]
+        self._documents_lock = threading.Lock()
+        atexit.register(self.close)
+
+        partitions = [[] for _ in range(shards)]
+        for doc in documents:
+            partitions[self.shard_of(doc)].append(doc)
+
+        # embedding is i/o bound, the shards are embedded concurrently
+        with ThreadPoolExecutor(max_workers=shards) as executor:
+            list(executor.map(self.rebuild_shard, range(shards), partitions))
+
+    def shard_of(self, document: Document) -> int:
+        """
+        Returns the shard a document belongs to. Sharding by domain keeps all pages of a site in one shard,
+        so a site can be re-crawled and rebuilt without touching the other shards.
+
+        Params:
+            document: the document
+        Returns:
+            the shard index
+        """
+        if self.shard_by == "domain":
+            key = document.metadata.get("domain") or get_domain(document.metadata.get("source")) or ""
+        else:
+            key = f"{document.metadata.get('source')}|{document.page_content}"
+        return zlib.crc32(key.encode()) % len(self._shards)
+
+    def rebuild_shard(self, shard: int, documents: List[Document]) -> None:
+        """
+        Replaces the content of one shard
+
+        Params:
+            shard: the shard index
+            documents: the new documents of the shard
+        """
+        vectors = np.asarray(self.embedding_function.embed_documents([doc.page_content for doc in documents]),
+                             dtype=np.float32) if documents else None
+        metadatas = [doc.metadata for doc in documents]
+        # the ids of the worker and the documents of the shard are swapped together, a concurrent search sees
+        # either the old or the new shard
+        with self._shards[shard].lock:
+            self._shards[shard].send("build", vectors, metadatas)
+            self._shards[shard].receive()
+            self._shard_documents[shard] = list(documents)
+        with self._documents_lock:
+            self.documents = [doc for shard_documents in list(self._shard_documents) for doc in shard_documents]
+            self._fingerprint = None
+
+    def search_with_scores(self, query: str, k: int, filter: Optional[Dict] = None,
+                           score_threshold: Optional[float] = None) -> List[Tuple[Document, float]]:
+        return self.search_with_scores_by_vectors([self.embedding_function.embed_query(query)], k, filter,
+                                                  score_threshold)[0]
+
+    def search_with_scores_by_vectors(self, query_vectors, k: int, filter: Optional[Dict] = None,
+                                      score_threshold: Optional[float] = None) -> List[List[Tuple[Document, float]]]:
+        """
+        Searches a batch of query embeddings on all shards in parallel and merges the top k of each query by score
+
+        Params:
+            query_vectors: one query embedding per query
+            k: the number of documents per query
+            filter: metadata filter
+            score_threshold: minimum relevance score
+        Returns:
+            per query the documents and their scores, most relevant first
+        """
+        vectors = np.asarray(query_vectors, dtype=np.float32)
+        if len(vectors) == 0:
+            return []
+        metadata_filter = normalize_filter(filter)
+
+        # scatter
+        for shard in self._shards:
+            shard.lock.acquire()
+        try:
+            for shard in self._shards:
+                shard.send("search", vectors, k, metadata_filter, score_threshold)
+            results = [shard.receive() for shard in self._shards]
+
+            # gather, the ids are resolved while no shard can be rebuilt
+            docs_and_scores = []
+            for query in range(len(vectors)):
+                candidates = [(score, shard, i) for shard, shard_results in enumerate(results)
+                              for i, score in shard_results[query]]
+                docs_and_scores.append([(self._shard_documents[shard][i], score)
+                                        for score, shard, i in heapq.nlargest(k, candidates)])
+        finally:
+            for shard in self._shards:
+                shard.lock.release()
+        return docs_and_scores
+
+    def close(self) -> None:
+        for shard in self._shards:
+            shard.stop()
+
+    def __str__(self) -> str:
+        return (f"ShardedDB with {len(self.documents)} documents in {len(self._shards)} shards and "
+                f"{self.embedding_function} as embedding function")
+
+
+class _ShardProcess:
+    """
+    Handle of a shard worker process
+    """
+
+    def __init__(self, context):
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=_shard_worker, args=(child_connection,), daemon=True)
+        self.process.start()
+        # only the worker keeps its end open, so a crashed worker is noticed as EOF instead of a blocking recv
+        child_connection.close()
+        self.lock = threading.Lock()
+
+    def _crashed(self, error: Exception) -> RuntimeError:
+        self.process.join(timeout=1)
+        return RuntimeError(f"Shard worker {self.process.pid} exited unexpectedly "
+                            f"with exit code {self.process.exitcode}: {error!r}")
+
+    def send(self, command: str, *args) -> None:
+        try:
+            self.connection.send((command, args))
+        except (BrokenPipeError, ConnectionResetError) as e:
+            raise self._crashed(e)
+
+    def receive(self):
+        try:
+            result = self.connection.recv()
+        except (EOFError, ConnectionResetError) as e:
+            raise self._crashed(e)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def request(self, command: str, *args):
+        with self.lock:
+            self.send(command, *args)
+            return self.receive()
+
+    def stop(self) -> None:
+        if self.process.is_alive():
+            with self.lock:
+                try:
+                    self.send("stop")
+                except RuntimeError:
+                    pass
+            self.process.join(timeout=5)
+
+
+def _shard_worker(connection) -> None:
+    """
+    Main loop of a shard worker process
+    """
+    index = ExactIndex(None, [])
+    while True:
+        command, args = connection.recv()
+        if command == "stop":
+            break
+        try:
+            if command == "build":
+                index = ExactIndex(*args)
+                result = len(index)
+            elif command == "search":
+                result = index.search(*args)
+            else:
+                raise ValueError(f"Unknown shard command {command}")
+        except Exception as e:
+            result = e
+        connection.send(result)
@@ -4,6 +4,7 @@ import boto3
 from typing import List, Dict
 from langchain_core.documents.base import Document
 from azure.storage.blob import ContainerClient
+from rag.functions.metadata_filter import get_domain, to_timestamp
 
 def _metadata_func(record: Dict, metadata: Dict) -> Dict:
     """Extracts and adds metadata to odd to documents
@@ -19,24 +20,35 @@ def _metadata_func(record: Dict, metadata: Dict) -> Dict:
     metadata["title"] = record.get("title")
     metadata["type"] = record.get("type")
     metadata["language"] = record.get("language")
+    # derived fields used for filtered retrieval
+    domain = get_domain(record.get("url"))
+    if domain is not None:
+        metadata["domain"] = domain
+    timestamp = to_timestamp(record.get("lastRetrievalTime"))
+    if timestamp is not None:
+        metadata["timestamp"] = timestamp
     return metadata
 
-def _parse_json_by_language(documents: List[Document], json_data: Dict, language: str = "en"):
-    """Converts a json to a langchain document if it's of given language 
+def _parse_json_by_language(documents: List[Document], json_data: Dict, languages: List[str] = None):
+    """Converts a json to a langchain document if it's of one of the given languages
        and appends it to the documents list
 
     Args:
         documents: the list of documents to append the converted document to
         json_data: the json data to convert
+        languages: the languages to keep, None keeps all languages
     """
     try:
-        if json_data['language'] == language:
+        if languages is None or json_data['language'] in languages:
             documents.append(Document(page_content=json_data['content'], metadata=_metadata_func(json_data, {})))
     except KeyError:
         pass
 class DataLoader:
     def __init__(self, config):
         self.config = config
+        # "all" keeps every language so that one index can serve all of them through metadata filters
+        language = config["language"].strip()
+        self.languages = None if language == "all" else [l.strip() for l in language.split(",")]
 
     """
     Loads the data from the given source into langchain documents
@@ -62,7 +74,7 @@ class DataLoader:
                 if file.endswith('.json'):
                     with open(os.path.join(root, file), 'r') as f:
                         json_data = json.load(f)
-                        _parse_json_by_language(documents, json_data, self.config["language"])
+                        _parse_json_by_language(documents, json_data, self.languages)
         print("[INFO] Data loaded.")
         return documents
 
@@ -75,7 +87,7 @@ class DataLoader:
             if blob.name.endswith('.json'):
                 blob_client = container_client.get_blob_client(blob.name)
                 json_data = json.loads(blob_client.download_blob().readall().decode('utf-8'))
-                _parse_json_by_language(documents, json_data, self.config["language"])
+                _parse_json_by_language(documents, json_data, self.languages)
         
         print("[INFO] Data loaded.")
         return documents
@@ -96,7 +108,7 @@ class DataLoader:
                 if obj['Key'].endswith('.json'):
                     obj_data = s3_client.get_object(Bucket=bucket_name, Key=obj['Key'])
                     json_data = json.loads(obj_data['Body'].read().decode('utf-8'))
-                    _parse_json_by_language(documents, json_data, self.config["language"])
+                    _parse_json_by_language(documents, json_data, self.languages)
         
         print("[INFO] Data loaded.")
         return documents
\ No newline at end of file
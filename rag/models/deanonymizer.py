@@ -0,0 +1,274 @@
+from collections import deque
+from typing import Dict, List, Optional, Tuple
+
+# characters that are ignored by the fuzzy matching, placeholders like <PERSON_1> are often written without them
+BRACKETS = "<>[]{}"
+OPENING_BRACKETS = "<[{"
+CLOSING_BRACKETS = ">]}"
+# characters that are all matched as one space by the fuzzy matching
+SEPARATORS = "_-"
+
+
+def flatten_mapping(mapping: Optional[dict]) -> Dict[str, str]:
+    """
+    Brings a de-anonymization mapping into the form {placeholder: original}
+
+    Params:
+        mapping: {placeholder: original} as returned by the LLM anonymization, or
+            {entity type: {placeholder: original}} as returned by the presidio anonymization
+    Returns:
+        the flat mapping
+    """
+    flat = {}
+    for key, value in (mapping or {}).items():
+        if isinstance(value, dict):
+            flat.update(value)
+        else:
+            flat[key] = value
+    return flat
+
+
+class Deanonymizer:
+    """
+    Replaces the placeholders of an anonymized text by the original values in one linear pass.
+
+    The placeholders are compiled into an Aho-Corasick automaton. Overlapping matches are resolved leftmost-longest
+    and only whole words are replaced, so a placeholder "Anna" does not change "Annabelle" and "<EMAIL>" does not
+    change the beginning of "<EMAIL_ADDRESS_1>". With fuzzy matching the text and the placeholders are compared
+    case-insensitively, any whitespace, "_" and "-" count as one space and brackets are ignored, so "<PERSON_1>" also
+    matches "Person 1" or "[person_1]" if the LLM mangled the placeholder.
+    Single word placeholders like "<EMAIL>" only match without brackets if the case is unchanged, so the word "email"
+    stays.
+    """
+
+    def __init__(self, mapping: Optional[dict], fuzzy: bool = True):
+        self.fuzzy = fuzzy
+        self.replacements = []
+        # bracketed placeholders swallow the brackets around a fuzzy match
+        self.bracketed = []
+        # single word placeholders like <EMAIL> are common words, without brackets they have to keep their case
+        self.words = []
+
+        self.goto: List[Dict[str, int]] = [{}]
+        self.fail: List[int] = [0]
+        self.output: List[List[int]] = [[]]
+        self.depth: List[int] = [0]
+
+        for placeholder, original in flatten_mapping(mapping).items():
+            key = "".join(self._normalize(placeholder)[0]).strip()
+            if not key:
+                continue
+            self.replacements.append((len(key), original))
+            self.bracketed.append(placeholder[:1] in BRACKETS and placeholder[-1:] in BRACKETS)
+            self.words.append(placeholder.strip(BRACKETS) if key.isalpha() else None)
+            self._add(key, len(self.replacements) - 1)
+        self._build()
+
+    def _normalize(self, text: str, previous: str = "") -> Tuple[List[str], List[int]]:
+        """
+        Returns the normalized characters of a text and for each of them its index in the text
+        """
+        if not self.fuzzy:
+            return list(text), list(range(len(text)))
+        characters, indices = [], []
+        last = " " if previous.isspace() or previous in SEPARATORS else ""
+        for i, character in enumerate(text):
+            if character in BRACKETS:
+                continue
+            if character.isspace() or character in SEPARATORS:
+                if last == " ":
+                    continue
+                character = " "
+            else:
+                character = character.lower()
+            characters.append(character)
+            indices.append(i)
+            last = character
+        return characters, indices
+
+    def _add(self, key: str, pattern: int) -> None:
+        state = 0
+        for character in key:
+            if character not in self.goto[state]:
+                self.goto.append({})
+                self.fail.append(0)
+                self.output.append([])
+                self.depth.append(self.depth[state] + 1)
+                self.goto[state][character] = len(self.goto) - 1
+            state = self.goto[state][character]
+        self.output[state].append(pattern)
+
+    def _build(self) -> None:
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for character, next_state in self.goto[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and character not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.goto[fallback].get(character, 0)
+                if self.fail[next_state] == next_state:
+                    self.fail[next_state] = 0
+                self.output[next_state] = self.output[next_state] + self.output[self.fail[next_state]]
+
+    @staticmethod
+    def _is_word_character(character: str) -> bool:
+        return character.isalnum()
+
+    def _continues_word(self, text: str, position: int) -> Optional[bool]:
+        """
+        Whether a word continues at a position after "_" and "-", like "_ADDRESS_1" after "EMAIL" in
+        "EMAIL_ADDRESS_1". None if the text ends before this is known.
+        """
+        end = position
+        while end < len(text) and text[end] in SEPARATORS:
+            end += 1
+        if end == position:
+            return False
+        if end == len(text):
+            return None
+        return self._is_word_character(text[end])
+
+    def _scan(self, text: str, previous: str = "", final: bool = True) -> Tuple[List[Tuple[int, int, int]], int]:
+        """
+        Finds the placeholders in a text
+
+        Params:
+            text: the text
+            previous: the character before the text, used for the word boundary check
+            final: whether the text is complete. Otherwise matches at its end are only accepted once the next
+                character is known.
+        Returns:
+            the selected (start, end, pattern) matches as indices in the text, and the index up to which the text is
+            final. The text after it could still be the beginning of a placeholder.
+        """
+        characters, indices = self._normalize(text, previous)
+        candidates = []
+        state = 0
+        for position, character in enumerate(characters):
+            while state and character not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(character, 0)
+            for pattern in self.output[state]:
+                length = self.replacements[pattern][0]
+                candidates.append((position - length + 1, position + 1, pattern))
+
+        # the last characters may be completed to a placeholder by the following text
+        pending = len(text) if final or self.depth[state] == 0 else indices[len(characters) - self.depth[state]]
+        if self.fuzzy and not final:
+            # brackets in front of it are swallowed by a bracketed placeholder
+            while pending > 0 and text[pending - 1] in OPENING_BRACKETS:
+                pending -= 1
+
+        matches = []
+        covered_until = 0
+        last_end = 0
+        cut = pending
+        for start, end, pattern in sorted(candidates, key=lambda match: (match[0], -match[1])):
+            if start < covered_until:
+                continue
+            text_start, text_end = indices[start], indices[end - 1] + 1
+            if text_start >= pending:
+                # a longer placeholder starting here may still follow
+                break
+            if self.fuzzy and self.bracketed[pattern]:
+                word = text[text_start:text_end]
+                while text_start > last_end and text[text_start - 1] in OPENING_BRACKETS:
+                    text_start -= 1
+                while text_end < len(text) and text[text_end] in CLOSING_BRACKETS:
+                    text_end += 1
+                if self.words[pattern] is not None and len(word) == text_end - text_start \
+                        and word != self.words[pattern]:
+                    continue
+            before = text[text_start - 1] if text_start > 0 else previous
+            after = text[text_end] if text_end < len(text) else ""
+            if (before and self._is_word_character(before) and self._is_word_character(text[text_start])) or \
+                    (after and self._is_word_character(after) and self._is_word_character(text[text_end - 1])):
+                continue
+            if self._is_word_character(text[text_end - 1]):
+                # <EMAIL> must not replace the beginning of <EMAIL_ADDRESS_1>
+                continues = self._continues_word(text, text_end)
+                if continues is None and not final:
+                    cut = text_start
+                    break
+                if continues:
+                    continue
+            matches.append((text_start, text_end, pattern))
+            covered_until = end
+            last_end = text_end
+            cut = max(cut, text_end)
+        return matches, cut
+
+    def _apply(self, text: str, matches: List[Tuple[int, int, int]]) -> str:
+        pieces = []
+        position = 0
+        for start, end, pattern in matches:
+            pieces.append(text[position:start])
+            pieces.append(self.replacements[pattern][1])
+            position = end
+        pieces.append(text[position:])
+        return "".join(pieces)
+
+    def deanonymize(self, text: str) -> str:
+        """
+        Replaces all placeholders in a text
+
+        Params:
+            text: the anonymized text
+        Returns:
+            the de-anonymized text
+        """
+        if not self.replacements:
+            return text
+        matches, _ = self._scan(text)
+        return self._apply(text, matches)
+
+    def stream(self) -> "StreamingDeanonymizer":
+        return StreamingDeanonymizer(self)
+
+
+class StreamingDeanonymizer:
+    """
+    De-anonymizes a streamed text piece by piece. Text is emitted as soon as it can no longer be part of a
+    placeholder, only a possible beginning of a placeholder at the end of the received text is held back.
+    """
+
+    def __init__(self, deanonymizer: Deanonymizer):
+        self.deanonymizer = deanonymizer
+        self.pending = ""
+        self.previous = ""
+
+    def feed(self, piece: str) -> str:
+        """
+        Adds a piece of the anonymized text
+
+        Params:
+            piece: the next piece
+        Returns:
+            the de-anonymized text that can be emitted, may be empty
+        """
+        self.pending += piece
+        if not self.deanonymizer.replacements:
+            return self.flush()
+
+        matches, cut = self.deanonymizer._scan(self.pending, self.previous, final=False)
+        if cut == 0:
+            return ""
+        emitted = self.deanonymizer._apply(self.pending[:cut], matches)
+        self.previous = self.pending[cut - 1]
+        self.pending = self.pending[cut:]
+        return emitted
+
+    def flush(self) -> str:
+        """
+        Ends the stream
+
+        Returns:
+            the de-anonymized rest of the text
+        """
+        matches, _ = self.deanonymizer._scan(self.pending, self.previous)
+        emitted = self.deanonymizer._apply(self.pending, matches)
+        self.previous = self.pending[-1:] or self.previous
+        self.pending = ""
+        return emitted
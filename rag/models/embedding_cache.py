@@ -0,0 +1,131 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import List
+
+from langchain_core.embeddings.embeddings import Embeddings
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes a query so that trivially different spellings share one cache entry
+
+    Params:
+        query: the query
+    Returns:
+        the lower cased query with collapsed whitespace
+    """
+    return " ".join(query.lower().split())
+
+
+class CachedEmbeddings(Embeddings):
+    """
+    Wraps an embedding model with an in-process LRU/TTL cache for query embeddings.
+
+    Only embed_query is cached, documents are embedded once at indexing time and are passed through.
+    The cache key is the normalized query together with the embedding model, so several wrapped models
+    can never return each other's vectors.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_name: str, max_size: int = 1024, ttl: float = 3600):
+        self.embeddings = embeddings
+        self.model_name = model_name
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _get(self, key):
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+
+            vector, created = entry
+            if self.ttl > 0 and time.monotonic() - created > self.ttl:
+                del self._cache[key]
+                self.expirations += 1
+                self.misses += 1
+                return None
+
+            self._cache.move_to_end(key)
+            self.hits += 1
+            return vector
+
+    def _put(self, key, vector: List[float]) -> None:
+        if self.max_size <= 0:
+            return
+        with self._lock:
+            self._cache[key] = (vector, time.monotonic())
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_size:
+                self._cache.popitem(last=False)
+                self.evictions += 1
+
+    def embed_query(self, text: str) -> List[float]:
+        key = (self.model_name, normalize_query(text))
+        vector = self._get(key)
+        if vector is None:
+            vector = self.embeddings.embed_query(text)
+            self._put(key, vector)
+        return vector
+
+    def embed_queries(self, texts: List[str]) -> List[List[float]]:
+        """
+        Embeds several queries. Cached queries are served from the cache, all others are embedded
+        with a single embed_documents call and added to the cache.
+
+        Params:
+            texts: the queries
+        Returns:
+            one embedding per query
+        """
+        keys = [(self.model_name, normalize_query(text)) for text in texts]
+        vectors = [self._get(key) for key in keys]
+
+        missing = {}
+        for text, key, vector in zip(texts, keys, vectors):
+            if vector is None and key not in missing:
+                missing[key] = text
+        if missing:
+            embedded = dict(zip(missing.keys(), self.embeddings.embed_documents(list(missing.values()))))
+            for key, vector in embedded.items():
+                self._put(key, vector)
+            vectors = [embedded[key] if vector is None else vector for key, vector in zip(keys, vectors)]
+        return vectors
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.embeddings.embed_documents(texts)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+    def stats(self) -> dict:
+        """
+        Returns the cache counters, used for sizing the cache
+
+        Returns:
+            hits, misses, evictions, expirations, current size and hit rate
+        """
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "expirations": self.expirations,
+                "size": len(self._cache),
+                "max_size": self.max_size,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+    def __str__(self) -> str:
+        return f"CachedEmbeddings({self.model_name})"
@@ -3,28 +3,17 @@ import datetime
 import logging
 import os
 import tempfile
-from typing import List, Tuple, Optional, Sequence, Union
-
-import matplotlib.pyplot as plt
-import mlflow
-import mlflow.data
-import pandas as pd
-import seaborn as sns
-from datasets import Dataset
+from typing import TYPE_CHECKING, List, Tuple, Optional, Sequence, Union
+
 from langchain_core.documents.base import Document
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-from matplotlib.colors import LinearSegmentedColormap
-from ragas import evaluate
-from ragas.metrics import answer_relevancy, context_precision, context_recall, faithfulness
-from ragas.testset.evolutions import simple, reasoning, multi_context
-from ragas.testset.generator import TestsetGenerator
-from reportlab.lib import colors
-from reportlab.lib.pagesizes import letter
-from reportlab.lib.styles import getSampleStyleSheet
-from reportlab.platypus import HRFlowable, Image, Paragraph, SimpleDocTemplate, Spacer, Table, TableStyle
 
 from rag.pipeline import Pipeline
 
+# The evaluation, tracking and report libraries are slow to import, they are imported when they are first used
+if TYPE_CHECKING:
+    from datasets import Dataset
+    from reportlab.platypus import Table
+
 
 class Evaluation:
 
@@ -33,7 +22,7 @@ class Evaluation:
         self.debug = debug
         self.delimiter = ';'
 
-    def generate_question_answer_pairs(self, docs: Sequence[Document]) -> Dataset:
+    def generate_question_answer_pairs(self, docs: Sequence[Document]) -> "Dataset":
         """ 
         Generate question-answer pairs for evaluation using the sequence of documents.
 
@@ -43,6 +32,10 @@ class Evaluation:
         Returns:
         Dataset: A Dataset object containing the generated question-answer pairs.
         """
+        from langchain_openai import ChatOpenAI, OpenAIEmbeddings
+        from ragas.testset.evolutions import simple, reasoning, multi_context
+        from ragas.testset.generator import TestsetGenerator
+
         generator_llm = ChatOpenAI(model="gpt-3.5-turbo-16k")
         critic_llm = ChatOpenAI(model="gpt-3.5-turbo-16k")
         embeddings = OpenAIEmbeddings()
@@ -113,7 +106,7 @@ class Evaluation:
 
         return questions, ground_truth
 
-    def generate_response(self, test_questions: list, test_answers: list, ) -> Dataset:
+    def generate_response(self, test_questions: list, test_answers: list, ) -> "Dataset":
         """
         Generate responses using the specified model and prompt.
 
@@ -126,18 +119,11 @@ class Evaluation:
         Returns:
         Dataset: A Dataset object containing the questions, contexts, answers, and ground truth answers.
         """
+        from datasets import Dataset
 
-        answers = []
-        contexts = []
-
-        for question in test_questions:
-            state = self.pipeline.retrieve(query=question, conversation=[])
-
-            answer = state["result"]
-            context = state["retrieved_documents"]
-
-            answers.append(answer)
-            contexts.append(context)
+        states, _ = self.pipeline.batch(test_questions)
+        answers = [state["result"] for state in states]
+        contexts = [state["retrieved_documents"] for state in states]
 
         contexts = [[doc.page_content for doc in sublist]
                     for sublist in contexts]
@@ -177,6 +163,10 @@ class Evaluation:
             questions, ground_truth
         )
 
+        import pandas as pd
+        from ragas import evaluate
+        from ragas.metrics import answer_relevancy, context_precision, context_recall, faithfulness
+
         metrics = [context_recall, context_precision,
                    faithfulness, answer_relevancy]
         results = evaluate(
@@ -187,7 +177,7 @@ class Evaluation:
         print("[INFO] Results are:\n", pd.DataFrame(results, index=[0]))
         return results, ds
 
-    def to_csv(self, dataset: Dataset) -> None:
+    def to_csv(self, dataset: "Dataset") -> None:
         """
         Save the retrieved dataset to a CSV file.
 
@@ -214,6 +204,8 @@ class Evaluation:
         Parameters:
         results (Dict[str, float]): A dictionary containing the evaluation results with metric names as keys and their values as values.
         """
+        import mlflow
+
         print("[INFO] Starting ML Logging.")
         mlflow.set_experiment("Capstone - RAG")
         with mlflow.start_run():  # mlflow ui --port 5000
@@ -244,6 +236,10 @@ class Evaluation:
         Returns:
         str: The file path to the saved heatmap image.
         """
+        import matplotlib.pyplot as plt
+        import seaborn as sns
+        from matplotlib.colors import LinearSegmentedColormap
+
         df = results.to_pandas()
         heatmap = df[['answer_relevancy', 'faithfulness',
                       'context_precision', 'context_recall']]
@@ -261,7 +257,7 @@ class Evaluation:
         plt.close()
         return image_filename
 
-    def generate_table(self, results: dict) -> Table:
+    def generate_table(self, results: dict) -> "Table":
         """
         Generate a pdf table from the evaluation results.
 
@@ -271,6 +267,9 @@ class Evaluation:
         Returns:
         Table: A ReportLab Table object representing the evaluation results.
         """
+        from reportlab.lib import colors
+        from reportlab.platypus import Table, TableStyle
+
         keys = list(results.keys())
         # Convert values to strings
         values = [str(value) for value in results.values()]
@@ -290,13 +289,17 @@ class Evaluation:
         ]))
         return table
 
-    def generate_report(self, results: str, ds: Dataset) -> None:
+    def generate_report(self, results: str, ds: "Dataset") -> None:
         """
         Generates a PDF report from the evaluation results.
         Parameters:
         results (Dict[str, Any]): A dictionary containing the evaluation results.
         ds (Dataset): A Dataset object containing the questions, contexts, answers and ground truth answers.
         """
+        from reportlab.lib import colors
+        from reportlab.lib.pagesizes import letter
+        from reportlab.lib.styles import getSampleStyleSheet
+        from reportlab.platypus import HRFlowable, Image, Paragraph, SimpleDocTemplate, Spacer
 
         # add the results to a csv file.
         self.to_csv(ds)
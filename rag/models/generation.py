@@ -1,10 +1,13 @@
-from typing import List
+from typing import Iterator, List
 
 from langchain_core.documents import Document
 
-from rag.models.chatbot import get_chatbot
-from rag.fixtures.prompts import system_prompt_templates
+from rag.models.chatbot import format_source, get_chatbot
+from rag.models.conversation_memory import ConversationMemory
+from rag.fixtures.prompts import guardrail_responses, system_prompt_templates
+from rag.functions.context_packing import pack_documents
 from rag.functions.logger import CustomLogger
+from rag.functions.tokens import count_tokens
 class Generation:
     """
     Class for the generation part of the pipeline
@@ -15,11 +18,30 @@ class Generation:
                                 config = config, 
                                 provider = config["generation"]["provider"], 
                                 model = config["generation"]["model"],
-                                default_system_prompt = str(system_prompt_templates["generation"]["no_rag"]))
+                                default_system_prompt = system_prompt_templates["generation"]["no_rag"].template)
         
         
         self.logger = CustomLogger("[GENERATION]", config["logging"]["filename"])
         self.logger.log("Generation initialised")
+
+        self.model = config["generation"]["model"]
+        self.max_context_tokens = int(config["generation"]["max_context_tokens"])
+
+        # the earlier turns are not anonymized, so the conversation is not sent along if pii is anonymized
+        self.memory = None
+        anonymize_pii = config["guardrails"]["anonymize_pii"].lower() == "true"
+        if config["generation"]["conversation_memory"] == "True" and not anonymize_pii:
+            self.memory = ConversationMemory(
+                self.chatbot,
+                self.model,
+                max_tokens=int(config["generation"]["conversation_max_tokens"]),
+                max_turns=int(config["generation"]["conversation_max_turns"]),
+                summary=config["generation"]["conversation_summary"] == "True",
+                summary_max_tokens=int(config["generation"]["conversation_summary_max_tokens"]),
+                background=config["generation"]["conversation_summary_background"] == "True",
+                exclude_answers=list(guardrail_responses.values()),
+                logger=self.logger
+            )
         
 
 
@@ -34,22 +56,105 @@ class Generation:
         Returns:
             the chatbot response
         """
+        system_prompt = self.conversation_prompt(self.rag_system_prompt(retrieved_documents), query, conversation)
+        result = self.chatbot.custom_prompt(system_prompt, query)
+        self.logger.log(f"[LLM RESPONSE] {result}")
+        return result
+
+    async def agenerate_rag(self, query, conversation, retrieved_documents):
+        """
+        Async version of generate_rag
+        """
+        system_prompt = self.conversation_prompt(self.rag_system_prompt(retrieved_documents), query, conversation)
+        result = await self.chatbot.acustom_prompt(system_prompt, query)
+        self.logger.log(f"[LLM RESPONSE] {result}")
+        return result
+
+    def stream_rag(self, query, conversation, retrieved_documents) -> Iterator[str]:
+        """
+        Streaming version of generate_rag
+
+        Params:
+            query: the query
+            conversation: the previous conversation
+            retrieved_documents: the documents accompanying the query
+        Returns:
+            iterator over the pieces of the chatbot response
+        """
+        result = ""
+        system_prompt = self.conversation_prompt(self.rag_system_prompt(retrieved_documents), query, conversation)
+        for token in self.chatbot.stream(system_prompt, query):
+            result += token
+            yield token
+        self.logger.log(f"[LLM RESPONSE] {result}")
+
+    def stream_no_rag(self, query, conversation) -> Iterator[str]:
+        """
+        Streaming version of generate_no_rag
+
+        Params:
+            query: the query
+            conversation: the previous conversation
+        Returns:
+            iterator over the pieces of the chatbot response
+        """
+        result = ""
+        system_prompt = self.conversation_prompt(self.chatbot.default_system_prompt, query, conversation)
+        for token in self.chatbot.stream(system_prompt, query):
+            result += token
+            yield token
+        self.logger.log(f"[LLM RESPONSE] {result}")
+
+    def uses_conversation(self, conversation):
+        """
+        Whether the response depends on the previous conversation
+
+        Params:
+            conversation: the previous conversation
+        Returns:
+            True if the conversation is sent with the query
+        """
+        return self.memory is not None and bool(self.memory.turns(conversation))
+
+    def conversation_prompt(self, system_prompt, query, conversation):
+        """
+        Adds the previous conversation to a system prompt, fitted into the token budget of the conversation memory
+
+        Params:
+            system_prompt: the system prompt
+            query: the query, only used for the token accounting
+            conversation: the previous conversation
+        Returns:
+            the system prompt with the conversation
+        """
+        if not self.uses_conversation(conversation):
+            return system_prompt
+        context = self.memory.build(conversation)
+        if context.text:
+            system_prompt = system_prompt_templates["generation"]["conversation"].substitute(
+                system_prompt=system_prompt, conversation=context.text)
+        self.logger.log(f"[CONVERSATION] {context.turns} turns: {context.verbatim_turns} verbatim, "
+                        f"{context.summarized_turns} summarized, {context.dropped_turns} dropped, "
+                        f"{context.tokens} conversation tokens ({context.summary_tokens} summary), "
+                        f"{count_tokens(system_prompt, self.model) + count_tokens(query, self.model)} prompt tokens")
+        return system_prompt
+
+    def rag_system_prompt(self, retrieved_documents):
+        """
+        Builds the system prompt of the RAG generation
+
+        Params:
+            retrieved_documents: the documents accompanying the query
+        Returns:
+            the system prompt containing the documents, or the no documents prompt
+        """
         if retrieved_documents:
             prompt_template = system_prompt_templates["generation"]["rag_with_docs"]
             documents_string = self.documents_to_string(retrieved_documents)
-            system_prompt = prompt_template.substitute(documents=documents_string)
+            return prompt_template.substitute(documents=documents_string)
+
+        return system_prompt_templates["generation"]["rag_no_docs"].substitute()
 
-            result = self.chatbot.custom_prompt(system_prompt, query)
-            self.logger.log(f"[INFO] LLM Response: {result}")
-            return result
-        
-        else:
-            system_prompt = system_prompt_templates["generation"]["rag_no_docs"].substitute()
-            
-            result = self.chatbot.custom_prompt(system_prompt, query)
-            self.logger.log(f"[LLM RESPONSE] {result}")
-            return result
-        
 
 
     def generate_no_rag(self, query, conversation):
@@ -63,13 +168,34 @@ class Generation:
         Returns:
             the chatbot response
         """
-        result = self.chatbot.answer_question(query)
+        system_prompt = self.conversation_prompt(self.chatbot.default_system_prompt, query, conversation)
+        result = self.chatbot.custom_prompt(system_prompt, query)
         self.logger.log(f"[LLM RESPONSE] {result}")
-        return result
+        return format_source(result)
+
+    async def agenerate_no_rag(self, query, conversation):
+        """
+        Async version of generate_no_rag
+        """
+        system_prompt = self.conversation_prompt(self.chatbot.default_system_prompt, query, conversation)
+        result = await self.chatbot.acustom_prompt(system_prompt, query)
+        self.logger.log(f"[LLM RESPONSE] {result}")
+        return format_source(result)
 
 
     def documents_to_string(self, documents):
-        documents_string = ""
-        for d in documents:
-            documents_string += f"{d.page_content}\nSource: {d.metadata['source']}"
+        """
+        Packs the retrieved documents into the context of the prompt, without duplicate text and within
+        max_context_tokens tokens
+
+        Params:
+            documents: the retrieved documents
+        Returns:
+            the documents string
+        """
+        documents_string, stats = pack_documents(documents, self.max_context_tokens, self.model)
+        self.logger.log(f"[CONTEXT] {stats['packed']} of {stats['documents']} documents, "
+                        f"{stats['duplicates']} duplicates, {stats['overlaps']} overlaps removed, "
+                        f"{stats['truncated']} truncated, {stats['tokens']} of {stats['original_tokens']} tokens "
+                        f"({stats['saved_tokens']} saved)")
         return documents_string
@@ -1,10 +1,14 @@
+import asyncio
+import threading
 from enum import Enum
 
-from langchain_experimental.data_anonymizer import PresidioReversibleAnonymizer
-from langchain_experimental.data_anonymizer.deanonymizer_matching_strategies import (case_insensitive_matching_strategy, combined_exact_fuzzy_matching_strategy, fuzzy_matching_strategy)
-from presidio_analyzer import Pattern, PatternRecognizer
 from rag.fixtures.prompts import system_prompt_templates, guardrail_responses, user_prompt_templates
 from rag.models.chatbot import get_chatbot
+from rag.models.classifiers import NearestCentroidClassifier, PendingDecisions, load_labeled_queries
+from rag.models.deanonymizer import Deanonymizer
+from rag.models.pii_detection import PiiDetector
+from rag.models.presidio_service import DEFAULT_ENTITIES, get_presidio_service
+from rag.functions import tracing
 from rag.functions.logger import CustomLogger
 import json
 
@@ -15,7 +19,7 @@ class GuardrailResponse(Enum):
 
 class Guardrails:
 
-    def __init__(self, config):
+    def __init__(self, config, embedding_function=None):
         self.guardrail_params = config["guardrails"]
 
         # init chatbot
@@ -29,98 +33,437 @@ class Guardrails:
         self.block_pii = config["guardrails"]["block_pii"].lower() == "true"
         self.block_not_work_related = config["guardrails"]["block_not_work_related"].lower() == "true"
 
+        # init local pii detection, llm: every check is a LLM call, local: never, hybrid: only ambiguous queries
+        self.pii_detection = config["guardrails"]["pii_detection"]
+        if self.pii_detection not in ["llm", "local", "hybrid"]:
+            print(f"[ERROR] PII detection {self.pii_detection} not available.")
+            exit()
+        self.pii_detector = None
+        if self.block_pii and self.pii_detection != "llm":
+            self.pii_detector = PiiDetector(
+                use_presidio=config["guardrails"]["pii_detection_presidio"] == "True",
+                presidio_threshold=float(config["guardrails"]["pii_detection_presidio_threshold"]),
+                presidio_entities=config["guardrails"]["pii_detection_presidio_entities"].split(","),
+                spacy_model=config["guardrails"]["presidio_spacy_model"]
+            )
+            if self.pii_detection == "local" and not self.pii_detector.use_presidio:
+                print("[WARNING] pii_detection = local without pii_detection_presidio cannot detect names.")
+                self.logger.log("[CONFIG] The local pii detection runs without Presidio and cannot detect names")
+        self.pii_stats = {"local": 0, "llm": 0}
+        self._stats_lock = threading.Lock()
+
+        # init local work relatedness classifier over the query embeddings, same modes as the pii detection
+        self.work_related_detection = config["guardrails"]["work_related_detection"]
+        if self.work_related_detection not in ["llm", "local", "hybrid"]:
+            print(f"[ERROR] Work relatedness detection {self.work_related_detection} not available.")
+            exit()
+        self.work_related_classifier = None
+        self.work_related_decision_log = config["guardrails"]["work_related_decision_log"]
+        self.work_related_pending = (PendingDecisions(self.work_related_decision_log)
+                                     if self.work_related_decision_log else None)
+        if self.block_not_work_related and self.work_related_detection != "llm":
+            if embedding_function is None:
+                print("[ERROR] The local work relatedness detection requires the embedding function of the vector database.")
+                exit()
+            self.work_related_classifier = NearestCentroidClassifier(
+                embedding_function,
+                threshold_low=float(config["guardrails"]["work_related_threshold_low"]),
+                threshold_high=float(config["guardrails"]["work_related_threshold_high"])
+            )
+            queries, labels = load_labeled_queries(config["guardrails"]["work_related_training_data"].split(","),
+                                                   self.work_related_decision_log)
+            self.work_related_classifier.fit(queries, labels)
+            self.logger.log(f"Work relatedness classifier trained on {len(queries)} queries")
+        self.work_related_stats = {"local": 0, "llm": 0}
+
         # init "anonymizers"
         self.anonymize_pii = (config["guardrails"]["anonymize_pii"].lower() == "true") and (not self.block_pii)
 
         if self.anonymize_pii:
-            self.anonymizer = PresidioReversibleAnonymizer(analyzed_fields=["PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "CREDIT_CARD"])
-            self.deanonymization_mapping = None
             self.exclude_from_anonymization = ["COMPANY_NAME"]
+            self.anonymized_fields = DEFAULT_ENTITIES
+            self.presidio = None
+            if config["guardrails"]["anonymization_method"] == "presidio":
+                # the analyzer is shared by the whole process and warmed up here instead of on the first request
+                self.presidio = get_presidio_service(config["guardrails"]["presidio_spacy_model"],
+                                                     batch_size=int(config["guardrails"]["presidio_batch_size"]))
+                self.logger.log(f"Presidio service ready: {self.presidio.stats()}")
+            self.deanonymization_fuzzy = config["guardrails"]["deanonymization_fuzzy"] == "True"
 
 
-    def guardrail_input(self, query):
+    def guardrail_input(self, query, executor=None, anonymization=None):
         """
         Apply input guardrails to the given query.
 
         This method processes the input query through various checks and transformations,
         including PII detection, work-relatedness verification, and anonymization if configured.
+        The guardrails keep no state of a request, so one instance can serve concurrent requests.
 
         Args:
             query (str): The original input query from the user.
+            executor (Executor, optional): If given, the checks and the anonymization are run concurrently on it
+                instead of one after the other.
+            anonymization (Tuple[str, dict], optional): The result of anonymize for this query if it was already
+                computed, e.g. by anonymize_batch.
 
         Returns:
-            Dict[str, Any]: A dictionary containing:
+            Tuple: A tuple containing:
                 - response_type (GuardrailResponse): Enum indicating the result of guardrail checks.
                 - query (str): The potentially modified query after applying guardrails.
                 - error_message (str, optional): Explanation if the query is rejected, None otherwise.
+                - deanonymization_mapping (dict, optional): The mapping needed by guardrail_output to restore the
+                  anonymized pii, None if the query was not anonymized.
 
         The response_type can be:
             - GuardrailResponse.OK: Query passed all checks without modification.
             - GuardrailResponse.NOT_OK: Query failed checks and should not be processed.
             - GuardrailResponse.CHANGED: Query was modified (e.g., anonymized) and can be processed.
         """
+        if executor is not None:
+            pii_future = executor.submit(tracing.wrap(self.contains_pii), query) if self.block_pii else None
+            work_future = executor.submit(tracing.wrap(self.is_work_related), query) if self.block_not_work_related else None
+            anonymize_future = (executor.submit(tracing.wrap(self.anonymize), query)
+                                if self.anonymize_pii and anonymization is None else None)
+            contains_pii = (lambda: pii_future.result()) if pii_future else None
+            is_work_related = (lambda: work_future.result()) if work_future else None
+            anonymize = (lambda: anonymize_future.result()) if anonymize_future else None
+            pending = [future for future in [pii_future, work_future, anonymize_future] if future]
+        else:
+            contains_pii = (lambda: self.contains_pii(query)) if self.block_pii else None
+            is_work_related = (lambda: self.is_work_related(query)) if self.block_not_work_related else None
+            anonymize = (lambda: self.anonymize(query)) if self.anonymize_pii else None
+            pending = []
+            work_future = None
+        if self.anonymize_pii and anonymization is not None:
+            anonymize = lambda: anonymization
+
+        if contains_pii and contains_pii():
+            for future in pending:
+                future.cancel()
+            if work_future:
+                work_future.add_done_callback(lambda _: self._log_work_related_decision(query, False))
+            return GuardrailResponse.NOT_OK, query, guardrail_responses["contains_pii"], None
+
+        if is_work_related and not is_work_related():
+            for future in pending:
+                future.cancel()
+            self._log_work_related_decision(query, not self.anonymize_pii)
+            return GuardrailResponse.NOT_OK, query, guardrail_responses["not_work_related"], None
+
+        if anonymize:
+            new_query, deanonymization_mapping = anonymize()
+            if new_query != query:
+                self.logger.log("The LLM guardrail has anonymized the user query")
+                self.logger.log(f"[NEW QUERY] {new_query}")
 
-        if self.block_pii:
-            answer = self.chatbot.custom_prompt(system_prompt_templates["guardrails"]["guardrail_pii"], user_prompt_templates["guardrails"]["pii"].substitute(query=query))
-            
-            if "true" in answer.lower():
-                self.logger.log("The LLM guardrail has decided that the question does contain pii")                    
-                return GuardrailResponse.NOT_OK, query, guardrail_responses["contains_pii"]
-            
-            else:
-                self.logger.log("The LLM guardrail has decided that the question does NOT contain pii")
+                self._log_work_related_decision(query, False)
+                return GuardrailResponse.CHANGED, new_query, None, deanonymization_mapping
 
-        if self.block_not_work_related:
-            answer = self.chatbot.custom_prompt(system_prompt_templates["guardrails"]["guardrail_work"], user_prompt_templates["guardrails"]["work_related"].substitute(query=query))
+        self._log_work_related_decision(query, True)
+        return GuardrailResponse.OK, query, None, None
 
-            if "true" in answer.lower():
-                self.logger.log("The LLM guardrail has decided that the question is work related")
-            else:
-                self.logger.log("The LLM guardrail has decided that the question is NOT work related")
-                return GuardrailResponse.NOT_OK, query, guardrail_responses["not_work_related"]
+    async def aguardrail_input(self, query, concurrent=False):
+        """
+        Async version of guardrail_input.
 
-        if self.anonymize_pii:
-            new_query = query
-
-            if self.guardrail_params["anonymization_method"] == "presidio":
-                new_query = self.anonymizer.anonymize(query)
-                self.deanonymization_mapping = self.anonymizer.deanonymizer_mapping
-                
-
-                
-            elif self.guardrail_params["anonymization_method"] == "llm":
-                anonymization_dict = self.chatbot.custom_prompt(
-                    system_prompt_templates["guardrails"]["anonymization"],
-                    user_prompt_templates["guardrails"]["anonymization"].substitute(query=query)
-                )
-                print(anonymization_dict)
-
-                
-                try:
-                    anonymization_dict = json.loads(anonymization_dict)
-                    self.deanonymization_mapping = {}
-                    for key in anonymization_dict:
-                        new_query = new_query.replace(key, anonymization_dict[key])
-                        self.deanonymization_mapping[anonymization_dict[key]] = key
-                    
-                except json.JSONDecodeError:
-                    pass
+        Args:
+            query (str): The original input query from the user.
+            concurrent (bool): Whether the checks and the anonymization are awaited concurrently
+                instead of one after the other.
 
+        Returns:
+            The same tuple as guardrail_input.
+        """
+        tasks = {}
+        if concurrent:
+            if self.block_pii:
+                tasks["contains_pii"] = asyncio.ensure_future(self.acontains_pii(query))
+            if self.block_not_work_related:
+                tasks["is_work_related"] = asyncio.ensure_future(self.ais_work_related(query))
+            if self.anonymize_pii:
+                tasks["anonymize"] = asyncio.ensure_future(self.aanonymize(query))
+
+        async def result(name, check):
+            if name in tasks:
+                return await tasks[name]
+            return await check(query)
+
+        def cancel_pending():
+            for task in tasks.values():
+                task.cancel()
+
+        if self.block_pii and await result("contains_pii", self.acontains_pii):
+            cancel_pending()
+            if "is_work_related" in tasks:
+                tasks["is_work_related"].add_done_callback(lambda _: self._log_work_related_decision(query, False))
+            return GuardrailResponse.NOT_OK, query, guardrail_responses["contains_pii"], None
+
+        if self.block_not_work_related and not await result("is_work_related", self.ais_work_related):
+            cancel_pending()
+            self._log_work_related_decision(query, not self.anonymize_pii)
+            return GuardrailResponse.NOT_OK, query, guardrail_responses["not_work_related"], None
+
+        if self.anonymize_pii:
+            new_query, deanonymization_mapping = await result("anonymize", self.aanonymize)
             if new_query != query:
                 self.logger.log("The LLM guardrail has anonymized the user query")
                 self.logger.log(f"[NEW QUERY] {new_query}")
 
-                return GuardrailResponse.CHANGED, new_query, None
+                self._log_work_related_decision(query, False)
+                return GuardrailResponse.CHANGED, new_query, None, deanonymization_mapping
+
+        self._log_work_related_decision(query, True)
+        return GuardrailResponse.OK, query, None, None
 
-        return GuardrailResponse.OK, query, None
+    def contains_pii(self, query) -> bool:
+        """
+        Checks whether the query contains personal identifiable information
+
+        Args:
+            query (str): The input query.
+
+        Returns:
+            bool: Whether the query contains pii.
+        """
+        decision = self._local_pii_decision(query)
+        if decision is not None:
+            return decision
 
-    def guardrail_output(self, guardrail_response, result):
+        answer = self.chatbot.custom_prompt(system_prompt_templates["guardrails"]["guardrail_pii"], user_prompt_templates["guardrails"]["pii"].substitute(query=query))
+        return self._pii_decision(answer)
+
+    async def acontains_pii(self, query) -> bool:
+        if self.pii_detector is not None and self.pii_detector.use_presidio:
+            decision = await asyncio.to_thread(self._local_pii_decision, query)
+        else:
+            decision = self._local_pii_decision(query)
+        if decision is not None:
+            return decision
+
+        answer = await self.chatbot.acustom_prompt(system_prompt_templates["guardrails"]["guardrail_pii"], user_prompt_templates["guardrails"]["pii"].substitute(query=query))
+        return self._pii_decision(answer)
+
+    def _local_pii_decision(self, query):
+        """
+        Checks the query with the local pii detector
+
+        Args:
+            query (str): The input query.
+
+        Returns:
+            Optional[bool]: Whether the query contains pii, None if the LLM has to decide.
+        """
+        if self.pii_detector is None:
+            return None
+
+        # without the LLM an uncertain match blocks the query
+        decision = self.pii_detector.decide(query, fail_closed=self.pii_detection == "local")
+        if decision is None and self.pii_detection == "hybrid":
+            self.logger.log("The local pii detector is not certain, asking the LLM guardrail")
+            return None
+
+        with self._stats_lock:
+            self.pii_stats["local"] += 1
+            stats = dict(self.pii_stats)
+        self.logger.log(f"The local pii detector has decided that the question does {'' if decision else 'NOT '}"
+                        f"contain pii, LLM skipped in {stats['local']} of {stats['local'] + stats['llm']} checks")
+        return bool(decision)
+
+    def _pii_decision(self, answer) -> bool:
+        with self._stats_lock:
+            self.pii_stats["llm"] += 1
+        if "true" in answer.lower():
+            self.logger.log("The LLM guardrail has decided that the question does contain pii")
+            return True
+
+        self.logger.log("The LLM guardrail has decided that the question does NOT contain pii")
+        return False
+
+    def is_work_related(self, query) -> bool:
+        """
+        Checks whether the query is work related
+
+        Args:
+            query (str): The input query.
+
+        Returns:
+            bool: Whether the query is work related.
+        """
+        decision, score = self._local_work_related_decision(query)
+        if decision is not None:
+            return decision
+
+        answer = self.chatbot.custom_prompt(system_prompt_templates["guardrails"]["guardrail_work"], user_prompt_templates["guardrails"]["work_related"].substitute(query=query))
+        return self._work_related_decision(answer, query, score)
+
+    async def ais_work_related(self, query) -> bool:
+        if self.work_related_classifier is not None:
+            # the query embedding may be a call to the embedding api
+            decision, score = await asyncio.to_thread(self._local_work_related_decision, query)
+        else:
+            decision, score = None, None
+        if decision is not None:
+            return decision
+
+        answer = await self.chatbot.acustom_prompt(system_prompt_templates["guardrails"]["guardrail_work"], user_prompt_templates["guardrails"]["work_related"].substitute(query=query))
+        return self._work_related_decision(answer, query, score)
+
+    def _local_work_related_decision(self, query):
+        """
+        Checks the query with the local work relatedness classifier. The query embedding is cached, so retrieval,
+        routing and the semantic cache reuse it.
+
+        Args:
+            query (str): The input query.
+
+        Returns:
+            Tuple[Optional[bool], Optional[float]]: Whether the query is work related, None if the LLM has to decide,
+                and the classifier score.
+        """
+        if self.work_related_classifier is None:
+            return None, None
+
+        decision, score = self.work_related_classifier.decide(query)
+        if decision is None:
+            if self.work_related_detection == "hybrid":
+                self.logger.log(f"The work relatedness classifier is not certain ({score:.3f}), asking the LLM guardrail")
+                return None, score
+            decision = score >= 0
+
+        with self._stats_lock:
+            self.work_related_stats["local"] += 1
+            stats = dict(self.work_related_stats)
+        self.logger.log(f"The work relatedness classifier has decided that the question is {'' if decision else 'NOT '}"
+                        f"work related ({score:.3f}), LLM skipped in {stats['local']} of "
+                        f"{stats['local'] + stats['llm']} checks")
+        return decision, score
+
+    def _work_related_decision(self, answer, query=None, score=None) -> bool:
+        decision = "true" in answer.lower()
+        with self._stats_lock:
+            self.work_related_stats["llm"] += 1
+        if score is not None and self.work_related_pending is not None:
+            # decisions near the boundary of the classifier are training data for the next start, they are written
+            # by guardrail_input once the query is known to contain no pii
+            self.work_related_pending.add(query, decision)
+
+        if decision:
+            self.logger.log("The LLM guardrail has decided that the question is work related")
+            return True
+
+        self.logger.log("The LLM guardrail has decided that the question is NOT work related")
+        return False
+
+    def _log_work_related_decision(self, query, no_pii) -> None:
+        """
+        Appends the LLM work relatedness decision of a query to the decision log, or drops it
+
+        Args:
+            query (str): The original input query.
+            no_pii (bool): Whether the query is known to contain no pii. Queries that contain pii or were anonymized
+                are never logged.
+        """
+        if self.work_related_pending is None:
+            return
+        if no_pii:
+            self.work_related_pending.commit(query)
+        else:
+            self.work_related_pending.discard(query)
+
+    def anonymize(self, query):
+        """
+        Anonymizes the query with the configured anonymization method
+
+        Args:
+            query (str): The input query.
+
+        Returns:
+            Tuple[str, dict]: The anonymized query and the de-anonymization mapping of this query.
+        """
+        if self.guardrail_params["anonymization_method"] == "presidio":
+            new_query, deanonymization_mapping = self.presidio.anonymize(query, self.anonymized_fields,
+                                                                         self.exclude_from_anonymization)
+            self.logger.log(f"Presidio timings: {self.presidio.stats()}")
+            return new_query, deanonymization_mapping
+
+        elif self.guardrail_params["anonymization_method"] == "llm":
+            anonymization_dict = self.chatbot.custom_prompt(
+                system_prompt_templates["guardrails"]["anonymization"],
+                user_prompt_templates["guardrails"]["anonymization"].substitute(query=query)
+            )
+            return self._apply_anonymization(query, anonymization_dict)
+
+        return query, None
+
+    async def aanonymize(self, query):
+        """
+        Async version of anonymize
+        """
+        if self.guardrail_params["anonymization_method"] == "llm":
+            anonymization_dict = await self.chatbot.acustom_prompt(
+                system_prompt_templates["guardrails"]["anonymization"],
+                user_prompt_templates["guardrails"]["anonymization"].substitute(query=query)
+            )
+            return self._apply_anonymization(query, anonymization_dict)
+
+        return await asyncio.to_thread(self.anonymize, query)
+
+    def anonymize_batch(self, queries, executor=None):
+        """
+        Anonymizes several queries. With presidio all queries are analyzed with one spaCy batch, with the llm method
+        the LLM calls are sent concurrently on the executor.
+
+        Args:
+            queries (List[str]): The input queries.
+            executor (Executor, optional): Executor for the LLM calls, None sends them one after the other.
+
+        Returns:
+            List[Tuple[str, dict]]: The anonymized query and the de-anonymization mapping per query.
+        """
+        if self.guardrail_params["anonymization_method"] == "presidio":
+            results = self.presidio.anonymize_batch(queries, self.anonymized_fields, self.exclude_from_anonymization)
+            self.logger.log(f"Presidio timings: {self.presidio.stats()}")
+            return results
+
+        if executor is not None:
+            return list(executor.map(tracing.wrap(self.anonymize), queries))
+        return [self.anonymize(query) for query in queries]
+
+    def _apply_anonymization(self, query, anonymization_dict):
+        """
+        Replaces the pii in the query according to the anonymization answer of the LLM
+
+        Args:
+            query (str): The input query.
+            anonymization_dict (str): JSON object mapping the pii to their placeholders.
+
+        Returns:
+            Tuple[str, dict]: The anonymized query and the mapping from the placeholders to the pii, or the unchanged
+                query and None if the answer is no valid JSON.
+        """
+        self.logger.log(f"[Anonymization] {anonymization_dict}")
+        new_query = query
+
+        try:
+            anonymization_dict = json.loads(anonymization_dict)
+        except json.JSONDecodeError:
+            return query, None
+
+        deanonymization_mapping = {}
+        for key in anonymization_dict:
+            new_query = new_query.replace(key, anonymization_dict[key])
+            deanonymization_mapping[anonymization_dict[key]] = key
+
+        return new_query, deanonymization_mapping
+
+    def guardrail_output(self, guardrail_response, result, deanonymization_mapping=None):
         """
         Apply output guardrails to the LLM result.
 
         Args:
             guardrail_response (GuardrailResponse): The response from the input guardrail.
             result (str): The raw output from the LLM.
+            deanonymization_mapping (dict, optional): The mapping returned by guardrail_input for this request.
 
         Returns:
             Tuple[GuardrailResponse, str]: A tuple containing:
@@ -130,26 +473,38 @@ class Guardrails:
 
         if guardrail_response == GuardrailResponse.CHANGED:
 
-            if self.guardrail_params["deanonymization_method"] == "combined_exact_fuzzy":
-                new_result = self.anonymizer.deanonymize(
-                    result,
-                    deanonymizer_matching_strategy=combined_exact_fuzzy_matching_strategy
-                )
+            if self.guardrail_params["deanonymization_method"] == "local":
+                new_result = Deanonymizer(deanonymization_mapping, self.deanonymization_fuzzy).deanonymize(result)
+
+            elif self.guardrail_params["deanonymization_method"] == "combined_exact_fuzzy":
+                from langchain_experimental.data_anonymizer.deanonymizer_matching_strategies import combined_exact_fuzzy_matching_strategy
+                new_result = combined_exact_fuzzy_matching_strategy(result, deanonymization_mapping)
 
             elif self.guardrail_params["deanonymization_method"] == "llm":
-                print(system_prompt_templates["guardrails"]["de-anonymization"])
-                print(user_prompt_templates["guardrails"]["de-anonymization"].substitute(anonymized_text=result, mappings=self.deanonymization_mapping))
-            
                 new_result = self.chatbot.custom_prompt(
                     system_prompt_templates["guardrails"]["de-anonymization"],
-                    user_prompt_templates["guardrails"]["de-anonymization"].substitute(anonymized_text=result, mappings=self.deanonymization_mapping)
+                    user_prompt_templates["guardrails"]["de-anonymization"].substitute(anonymized_text=result, mappings=deanonymization_mapping)
                 )
             else:
                 raise Exception("de-anonymization method not known")
-            
-            self.anonymizer.reset_deanonymizer_mapping()
+
             self.logger.log("The guardrail has deanonymized the response")
             self.logger.log(f"[New Response] {new_result}")
             return GuardrailResponse.OK, new_result
 
         return GuardrailResponse.OK, result
+
+    def streaming_deanonymizer(self, deanonymization_mapping):
+        """
+        Returns a de-anonymizer for streamed answers if the local de-anonymization is configured.
+
+        Args:
+            deanonymization_mapping (dict): The mapping returned by guardrail_input for this request.
+
+        Returns:
+            StreamingDeanonymizer: Restores the pii of each streamed piece as soon as it is complete, or None if the
+                answer has to be de-anonymized as a whole.
+        """
+        if not self.anonymize_pii or self.guardrail_params["deanonymization_method"] != "local":
+            return None
+        return Deanonymizer(deanonymization_mapping, self.deanonymization_fuzzy).stream()
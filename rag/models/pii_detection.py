@@ -0,0 +1,163 @@
+import re
+from dataclasses import dataclass
+from typing import Callable, List, Optional, Pattern
+
+from rag.models.presidio_service import DEFAULT_ENTITIES, get_presidio_service
+
+# only regex matches with a score of at least this value are definitive
+DEFINITIVE_SCORE = 0.9
+# presidio entities counted as pii by default, all recognizers would also report locations, dates and nationalities
+PRESIDIO_PII_ENTITIES = DEFAULT_ENTITIES + ["IBAN_CODE"]
+
+PHONE_CONTEXT = re.compile(r"\b(phone|tel|telephone|mobile|cell|call|contact|reach|handy|telefon|fax|whatsapp)\b",
+                           re.IGNORECASE)
+MATRICULATION_CONTEXT = re.compile(r"\b(matriculation|matrikel\w*|matr\.|student (id|number)|immatrikulation\w*)",
+                                   re.IGNORECASE)
+
+
+@dataclass
+class PiiMatch:
+    entity: str
+    start: int
+    end: int
+    text: str
+    score: float
+    source: str = "regex"
+
+
+def iban_checksum(candidate: str) -> bool:
+    """
+    Validates an IBAN with the ISO 13616 mod 97 checksum
+
+    Params:
+        candidate: the IBAN, spaces are ignored
+    Returns:
+        whether the checksum is valid
+    """
+    iban = candidate.replace(" ", "").upper()
+    if not 15 <= len(iban) <= 34:
+        return False
+    rearranged = iban[4:] + iban[:4]
+    digits = "".join(str(int(character, 36)) for character in rearranged)
+    return int(digits) % 97 == 1
+
+
+def luhn_checksum(candidate: str) -> bool:
+    """
+    Validates a credit card number with the Luhn checksum
+
+    Params:
+        candidate: the number, spaces and dashes are ignored
+    Returns:
+        whether the checksum is valid
+    """
+    digits = [int(character) for character in candidate if character.isdigit()]
+    if not 13 <= len(digits) <= 19:
+        return False
+    total = 0
+    for i, digit in enumerate(reversed(digits)):
+        if i % 2 == 1:
+            digit *= 2
+            if digit > 9:
+                digit -= 9
+        total += digit
+    return total % 10 == 0
+
+
+def _digit_count(candidate: str) -> int:
+    return sum(character.isdigit() for character in candidate)
+
+
+@dataclass
+class Recognizer:
+    """
+    A compiled pattern for one entity. The score is used if the validator accepts the match, or if there is no
+    validator. A context pattern found anywhere in the text raises the score to the context score.
+    """
+    entity: str
+    pattern: Pattern
+    score: float
+    validator: Optional[Callable[[str], bool]] = None
+    context: Optional[Pattern] = None
+    context_score: float = 1.0
+
+
+RECOGNIZERS = [
+    Recognizer("EMAIL_ADDRESS", re.compile(r"\b[A-Za-z0-9._%+-]+@[A-Za-z0-9.-]+\.[A-Za-z]{2,}\b"), 1.0),
+    Recognizer("IBAN_CODE", re.compile(r"\b[A-Z]{2}\d{2}(?: ?[A-Z0-9]{4}){2,7}(?: ?[A-Z0-9]{1,3})?\b"), 1.0,
+               validator=iban_checksum),
+    Recognizer("CREDIT_CARD", re.compile(r"\b\d(?:[ -]?\d){12,18}\b"), 1.0, validator=luhn_checksum),
+    # international numbers are definitive, national numbers only next to a word like "phone"
+    Recognizer("PHONE_NUMBER", re.compile(r"(?:\+|\b00)\d{1,3}[ \-/]?(?:\(0\)[ \-/]?)?\d{2,5}(?:[ \-/]?\d{2,8}){1,3}\b"),
+               1.0, validator=lambda candidate: 8 <= _digit_count(candidate) <= 15),
+    Recognizer("PHONE_NUMBER", re.compile(r"\b0\d{2,5}(?:[ \-/]\d{2,8}){1,3}\b"), 0.5,
+               validator=lambda candidate: 7 <= _digit_count(candidate) <= 13,
+               context=PHONE_CONTEXT),
+    # TUM matriculation numbers have 8 digits and start with 0
+    Recognizer("MATRICULATION_NUMBER", re.compile(r"\b0\d{7}\b"), 0.5, context=MATRICULATION_CONTEXT),
+]
+
+class PiiDetector:
+    """
+    Local PII detector using compiled regex recognizers and optionally the Presidio analyzer.
+
+    decide answers True if a definitive entity was found and False if nothing was found and Presidio was used, since
+    the regex recognizers alone cannot find names. All other cases are ambiguous and can be escalated to a LLM.
+    """
+
+    def __init__(self, use_presidio: bool = False, presidio_threshold: float = 0.7,
+                 presidio_entities: Optional[List[str]] = None, spacy_model: str = "en_core_web_sm"):
+        self.use_presidio = use_presidio
+        self.presidio_threshold = presidio_threshold
+        self.presidio_entities = [entity.strip() for entity in presidio_entities] if presidio_entities \
+            else PRESIDIO_PII_ENTITIES
+        # the shared service is loaded at startup instead of on the first request
+        self.presidio = get_presidio_service(spacy_model) if use_presidio else None
+
+    def analyze(self, text: str) -> List[PiiMatch]:
+        """
+        Finds the PII in a text
+
+        Params:
+            text: the text
+        Returns:
+            the matches of the regex recognizers and, if enabled, of Presidio
+        """
+        matches = []
+        for recognizer in RECOGNIZERS:
+            for match in recognizer.pattern.finditer(text):
+                candidate = match.group()
+                if recognizer.validator is not None and not recognizer.validator(candidate):
+                    continue
+                score = recognizer.score
+                if recognizer.context is not None and recognizer.context.search(text):
+                    score = recognizer.context_score
+                matches.append(PiiMatch(recognizer.entity, match.start(), match.end(), candidate, score))
+
+        if self.use_presidio:
+            for result in self.presidio.analyze(text, self.presidio_entities):
+                matches.append(PiiMatch(result.entity_type, result.start, result.end, text[result.start:result.end],
+                                        result.score, source="presidio"))
+        return matches
+
+    def decide(self, text: str, fail_closed: bool = False) -> Optional[bool]:
+        """
+        Decides whether a text contains PII if the local recognizers are certain
+
+        Params:
+            text: the text
+            fail_closed: whether a match below the threshold counts as PII instead of being ambiguous, used if no
+                LLM can decide the ambiguous cases
+        Returns:
+            True or False if the decision is definitive, None if it is ambiguous
+        """
+        matches = self.analyze(text)
+        for match in matches:
+            threshold = self.presidio_threshold if match.source == "presidio" else DEFINITIVE_SCORE
+            if match.score >= threshold:
+                return True
+        if matches and fail_closed:
+            return True
+        if not matches and self.use_presidio:
+            return False
+        return None
@@ -0,0 +1,177 @@
+import threading
+import time
+from typing import Dict, List, Optional, Tuple
+
+# text analyzed once after loading, so the first request does not pay for the lazy initialisation of spaCy
+WARM_UP_TEXT = "John Smith from Munich can be reached at john.smith@example.com or +49 89 12345678."
+
+DEFAULT_ENTITIES = ["PERSON", "PHONE_NUMBER", "EMAIL_ADDRESS", "CREDIT_CARD"]
+
+
+class PresidioService:
+    """
+    Presidio analyzer shared by all guardrails and pii detectors of the process.
+
+    Loading presidio and its spaCy pipeline takes seconds and hundreds of megabytes, so there is one warm analyzer
+    per spaCy model, see get_presidio_service. Several texts are analyzed with a single spaCy nlp.pipe call by the
+    batch methods. The anonymization replaces entities by numbered placeholders like <PERSON_1> and returns the
+    mapping needed to restore them in the format of the langchain deanonymizer matching strategies:
+    {entity type: {placeholder: original}}.
+    """
+
+    def __init__(self, spacy_model: str = "en_core_web_sm", language: str = "en", batch_size: int = 32):
+        start = time.perf_counter()
+        from presidio_analyzer import AnalyzerEngine, BatchAnalyzerEngine
+        from presidio_analyzer.nlp_engine import NlpEngineProvider
+
+        nlp_engine = NlpEngineProvider(nlp_configuration={
+            "nlp_engine_name": "spacy",
+            "models": [{"lang_code": language, "model_name": spacy_model}],
+        }).create_engine()
+        self.analyzer = AnalyzerEngine(nlp_engine=nlp_engine, supported_languages=[language])
+        self.batch_analyzer = BatchAnalyzerEngine(analyzer_engine=self.analyzer)
+        self.spacy_model = spacy_model
+        self.language = language
+        self.batch_size = batch_size
+
+        self.analyzer.analyze(text=WARM_UP_TEXT, language=language)
+        self.load_seconds = time.perf_counter() - start
+
+        self._metrics_lock = threading.Lock()
+        self.calls = 0
+        self.texts = 0
+        self.analyze_seconds = 0.0
+
+    def _record(self, texts: int, seconds: float) -> None:
+        with self._metrics_lock:
+            self.calls += 1
+            self.texts += texts
+            self.analyze_seconds += seconds
+
+    def analyze(self, text: str, entities: Optional[List[str]] = None) -> list:
+        """
+        Finds the entities in a text
+
+        Params:
+            text: the text
+            entities: the entity types to look for, None for all
+        Returns:
+            the presidio recognizer results
+        """
+        start = time.perf_counter()
+        results = self.analyzer.analyze(text=text, language=self.language, entities=entities)
+        self._record(1, time.perf_counter() - start)
+        return results
+
+    def analyze_batch(self, texts: List[str], entities: Optional[List[str]] = None) -> List[list]:
+        """
+        Finds the entities in several texts with one spaCy nlp.pipe call
+
+        Params:
+            texts: the texts
+            entities: the entity types to look for, None for all
+        Returns:
+            the presidio recognizer results per text
+        """
+        if not texts:
+            return []
+        start = time.perf_counter()
+        results = list(self.batch_analyzer.analyze_iterator(texts, language=self.language,
+                                                            batch_size=self.batch_size, entities=entities))
+        self._record(len(texts), time.perf_counter() - start)
+        return results
+
+    @staticmethod
+    def _replace(text: str, results: list, exclude: List[str]) -> Tuple[str, Dict[str, Dict[str, str]]]:
+        # overlapping entities are resolved in favour of the higher score and then the longer span
+        selected = []
+        for result in sorted(results, key=lambda r: (-r.score, r.start - r.end)):
+            if text[result.start:result.end] in exclude:
+                continue
+            if all(result.end <= other.start or result.start >= other.end for other in selected):
+                selected.append(result)
+
+        mapping = {}
+        placeholders = {}
+        for result in sorted(selected, key=lambda r: r.start):
+            original = text[result.start:result.end]
+            if (result.entity_type, original) not in placeholders:
+                entity_mapping = mapping.setdefault(result.entity_type, {})
+                placeholder = f"<{result.entity_type}_{len(entity_mapping) + 1}>"
+                entity_mapping[placeholder] = original
+                placeholders[(result.entity_type, original)] = placeholder
+
+        new_text = text
+        for result in sorted(selected, key=lambda r: r.start, reverse=True):
+            placeholder = placeholders[(result.entity_type, text[result.start:result.end])]
+            new_text = new_text[:result.start] + placeholder + new_text[result.end:]
+        return new_text, mapping
+
+    def anonymize(self, text: str, entities: Optional[List[str]] = None,
+                  exclude: Optional[List[str]] = None) -> Tuple[str, Dict[str, Dict[str, str]]]:
+        """
+        Replaces the entities in a text by placeholders
+
+        Params:
+            text: the text
+            entities: the entity types to anonymize
+            exclude: values that are never anonymized
+        Returns:
+            the anonymized text and the de-anonymization mapping
+        """
+        return self._replace(text, self.analyze(text, entities or DEFAULT_ENTITIES), exclude or [])
+
+    def anonymize_batch(self, texts: List[str], entities: Optional[List[str]] = None,
+                        exclude: Optional[List[str]] = None) -> List[Tuple[str, Dict[str, Dict[str, str]]]]:
+        """
+        Replaces the entities in several texts by placeholders, analyzing all texts with one spaCy nlp.pipe call
+
+        Params:
+            texts: the texts
+            entities: the entity types to anonymize
+            exclude: values that are never anonymized
+        Returns:
+            the anonymized text and the de-anonymization mapping per text
+        """
+        results = self.analyze_batch(texts, entities or DEFAULT_ENTITIES)
+        return [self._replace(text, text_results, exclude or []) for text, text_results in zip(texts, results)]
+
+    def stats(self) -> dict:
+        """
+        Returns the timing metrics of the service
+
+        Returns:
+            the model load time, the number of calls and texts and the mean analysis time per text
+        """
+        with self._metrics_lock:
+            return {
+                "spacy_model": self.spacy_model,
+                "load_seconds": self.load_seconds,
+                "calls": self.calls,
+                "texts": self.texts,
+                "analyze_seconds": self.analyze_seconds,
+                "ms_per_text": self.analyze_seconds * 1000 / self.texts if self.texts else 0.0,
+            }
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def get_presidio_service(spacy_model: str = "en_core_web_sm", language: str = "en",
+                         batch_size: int = 32) -> PresidioService:
+    """
+    Returns the presidio service of the process for a spaCy model, loading and warming it up on the first call
+
+    Params:
+        spacy_model: the spaCy model, e.g. en_core_web_sm or the larger and slower en_core_web_lg
+        language: the language of the texts
+        batch_size: the number of texts per spaCy batch
+    Returns:
+        the shared service
+    """
+    with _services_lock:
+        key = (spacy_model, language)
+        if key not in _services:
+            _services[key] = PresidioService(spacy_model, language, batch_size)
+        return _services[key]
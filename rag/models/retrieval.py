@@ -1,11 +1,13 @@
-from typing import List
+from typing import Dict, List, Optional
 
 from langchain_community.document_transformers import LongContextReorder
 from langchain_core.documents import Document
-from sentence_transformers import CrossEncoder
+from rag.functions.adaptive_k import choose_k
 from rag.functions.logger import CustomLogger
+from rag.functions.metadata_filter import filter_from_config, matches, normalize_filter
 from rag.models.chatbot import get_chatbot
-from rag.models.databases import VectorDB
+from rag.models.compressors import EmbeddingsSentenceFilter, ParallelLLMExtractor
+from rag.models.databases import SCORE_THRESHOLD, VectorDB
 
 
 class Retrieval:
@@ -13,51 +15,68 @@ class Retrieval:
         self.vector_db = vector_db
         self.chatbot = get_chatbot(config, config["retrieval"]["provider"], config["retrieval"]["model"], None)
         self.retrieval_params = config["retrieval"]
+        self.default_filter = filter_from_config(config["retrieval"])
 
         self.logger = CustomLogger("[RETRIEVAL]", config["logging"]["filename"])
+        self.compressor = self.get_compressor()
+        if self.retrieval_params["adaptive_k"] != "off" and (self.retrieval_params["method"] != "Nearest Neighbor"
+                                                             or self.retrieval_params["reranker"] in ["2", "3"]):
+            print("[WARNING] adaptive_k only has an effect with Nearest Neighbor and reranker 0 or 1.")
+            self.logger.log("[CONFIG] adaptive_k is ignored, the retrieval method or reranker retrieves k_chunks "
+                            "documents")
         self.logger.log("Retrieval initialised")
 
-    def retrieve_documents(self, query: str) -> List[Document]:
+    def retrieve_documents(self, query: str, filter: Optional[Dict] = None) -> List[Document]:
         """
         This method returns the relevant documents based on the approach specified in the config.
 
         Args:
             query (str): The query string.
+            filter (dict): Metadata filter, see rag.functions.metadata_filter. Defaults to the filter_* config options.
 
         Returns:
             List[Document]: A list of Document objects.
         """
         k = int(self.retrieval_params["k_chunks"])
+        filter = self.default_filter if filter is None else normalize_filter(filter)
+        if filter is not None:
+            self.logger.log(f"[CONFIG] Metadata filter {filter}")
 
         if self.retrieval_params["method"] == "Nearest Neighbor":
             retrieved_documents = self.get_top_k_relevant_documents_nearest_neighbor(
                 query=query,
-                k=k
+                k=k,
+                filter=filter
             )
         elif self.retrieval_params["method"] == "Contextual Compression":
             retrieved_documents = self.get_top_k_relevant_documents_contextual_compression(
                 query=query,
-                k=k
+                k=k,
+                filter=filter
             )
         elif self.retrieval_params["method"] == "Parent Document":
             retrieved_documents = self.get_top_k_relevant_documents_parent_document(
                 query=query,
-                k=k
+                k=k,
+                filter=filter
             )
         elif self.retrieval_params["method"] == "SVM":
             retrieved_documents = self.get_top_k_relevant_documents_svm(
                 query=query,
-                k=k
+                k=k,
+                filter=filter
             )
         elif self.retrieval_params["method"] == "Multi-Query":
             retrieved_documents = self.get_top_k_relevant_documents_multi_query(
                 query=query,
-                k=k
+                k=k,
+                filter=filter
             )
         elif self.retrieval_params["method"] == "Ensemble":
             retrieved_documents = self.get_top_k_relevant_documents_emsemble(
                 query=query,
-                k=k
+                k=k,
+                filter=filter
             )
         else:
             self.logger.log(f"[ERROR] Retrieval Method {self.retrieval_params['method']} not available.")
@@ -71,99 +90,223 @@ class Retrieval:
             retrieved_documents = self.long_context_reorder(documents=retrieved_documents)
         elif self.retrieval_params["reranker"] == "2":
             self.logger.log(f"[CONFIG] Reranking documents with cohere")
-            retrieved_documents = self.cohere_reranking(query=query, k=k)
+            retrieved_documents = self.cohere_reranking(query=query, k=k, filter=filter)
         elif self.retrieval_params["reranker"] == "3":
             self.logger.log(f"[CONFIG] Reranking documents with cross encoder")
-            retrieved_documents = self.crossencoder_reranking(query=query, k=k)
+            retrieved_documents = self.crossencoder_reranking(query=query, k=k, filter=filter)
         else:
             self.logger.log(f"[ERROR] Reranking Method {self.retrieval_params['reranker']} not available.")
             exit()
 
+        self.log_cache_stats()
         return retrieved_documents
 
-    def get_top_k_relevant_documents_nearest_neighbor(self, query: str, k=5) -> List[Document]:
+    def retrieve_documents_batch(self, queries: List[str], filter: Optional[Dict] = None) -> List[List[Document]]:
+        """
+        Batched version of retrieve_documents for offline and evaluation workloads. All queries are embedded in one
+        provider call. For Nearest Neighbor they are also searched in one batched vector search and reranked by the
+        cross encoder in one batch, the other retrieval methods run per query with the embeddings already cached.
+
+        Args:
+            queries (List[str]): The query strings.
+            filter (dict): Metadata filter, applied to all queries. Defaults to the filter_* config options.
+
+        Returns:
+            List[List[Document]]: The retrieved documents per query, in the order of the queries.
+        """
+        if not queries:
+            return []
+        k = int(self.retrieval_params["k_chunks"])
+        filter = self.default_filter if filter is None else normalize_filter(filter)
+        method = self.retrieval_params["method"]
+        reranker = self.retrieval_params["reranker"]
+
+        if method != "Nearest Neighbor" or reranker == "2":
+            self.logger.log(f"[BATCH] Retrieving {len(queries)} queries one by one with {method}")
+            self.vector_db.embed_queries(queries)
+            return [self.retrieve_documents(query, filter) for query in queries]
+
+        self.logger.log(f"[BATCH] Retrieving {len(queries)} queries in one batch")
+        if self.retrieval_params["adaptive_k"] != "off" and reranker != "3":
+            pools = self.vector_db.search_with_scores_batch(queries, k=int(self.retrieval_params["adaptive_k_max"]),
+                                                            filter=filter, score_threshold=SCORE_THRESHOLD)
+            retrieved_documents = [self._cut_adaptive_k(docs_and_scores) for docs_and_scores in pools]
+        else:
+            results = self.vector_db.search_with_scores_batch(queries, k=k, filter=filter,
+                                                              score_threshold=SCORE_THRESHOLD)
+            retrieved_documents = [[doc for doc, _ in docs_and_scores] for docs_and_scores in results]
+
+        if reranker == "1":
+            retrieved_documents = [self.long_context_reorder(documents=documents) for documents in retrieved_documents]
+        elif reranker == "3":
+            retrieved_documents = self.crossencoder_reranking_batch(queries, retrieved_documents)
+        elif reranker != "0":
+            self.logger.log(f"[ERROR] Reranking Method {reranker} not available.")
+            exit()
+
+        self.log_cache_stats()
+        return retrieved_documents
+
+    def log_cache_stats(self) -> None:
+        cache_stats = self.vector_db.embedding_cache_stats()
+        if cache_stats:
+            self.logger.log(f"[CACHE] Query embeddings: {cache_stats['hits']} hits, {cache_stats['misses']} misses, "
+                            f"{cache_stats['size']}/{cache_stats['max_size']} entries, "
+                            f"hit rate {cache_stats['hit_rate']:.2f}")
+
+    def get_top_k_relevant_documents_nearest_neighbor(self, query: str, k=5, filter=None) -> List[Document]:
         """
         This method returns the top k relevant documents based on the nearest neighbor search.
 
         Args:
             query (str): The query string.
             k (int): The number of relevant documents to return.
+            filter (dict): Metadata filter.
 
         Returns:
             List[Document]: A list of Document objects representing the top k relevant documents.
         """
-        retriever = self.vector_db.get_base_retriever(k=k)
+        if self.retrieval_params["adaptive_k"] != "off":
+            return self.get_adaptive_k_relevant_documents(query=query, filter=filter)
+        retriever = self.vector_db.get_base_retriever(k=k, filter=filter)
         docs = retriever.invoke(query)
         return docs
 
-    def get_top_k_relevant_documents_contextual_compression(self, query: str, k=5) -> List[Document]:
+    def get_adaptive_k_relevant_documents(self, query: str, filter=None) -> List[Document]:
+        """
+        This method retrieves a candidate pool of adaptive_k_max documents and cuts it where the relevance scores
+        drop (gap) or once the kept documents cover most of the relevance (cumulative).
+
+        Args:
+            query (str): The query string.
+            filter (dict): Metadata filter.
+        Returns:
+            List[Document]: A list of Document objects representing the relevant documents.
+        """
+        max_k = int(self.retrieval_params["adaptive_k_max"])
+        docs_and_scores = self.vector_db.search_with_scores(query, k=max_k, filter=filter,
+                                                            score_threshold=SCORE_THRESHOLD)
+        return self._cut_adaptive_k(docs_and_scores)
+
+    def _cut_adaptive_k(self, docs_and_scores) -> List[Document]:
+        """
+        Cuts a candidate pool of documents and scores according to the adaptive k config
+        """
+        scores = [score for _, score in docs_and_scores]
+        k = choose_k(scores,
+                     mode=self.retrieval_params["adaptive_k"],
+                     min_k=int(self.retrieval_params["adaptive_k_min"]),
+                     max_k=int(self.retrieval_params["adaptive_k_max"]),
+                     min_gap=float(self.retrieval_params["adaptive_k_min_gap"]),
+                     cumulative_threshold=float(self.retrieval_params["adaptive_k_cumulative_threshold"]),
+                     score_floor=SCORE_THRESHOLD)
+        self.logger.log(f"[ADAPTIVE K] Chose k={k} of {len(docs_and_scores)} candidates, "
+                        f"scores: {', '.join(f'{score:.3f}' for score in scores)}")
+        return [doc for doc, _ in docs_and_scores[:k]]
+
+    def get_top_k_relevant_documents_contextual_compression(self, query: str, k=5, filter=None) -> List[Document]:
         """
         This method returns the top k relevant documents based on the contextual compression of the query.
 
         Args:
             query (str): The query string.
             k (int): The number of relevant documents to return.
+            filter (dict): Metadata filter.
 
         Returns:
             List[Document]: A list of Document objects representing the top k relevant documents.
         """
-        retriever = self.vector_db.get_compression_retriever(llm=self.chatbot, k=k)
+        retriever = self.vector_db.get_compression_retriever(llm=self.chatbot, k=k, filter=filter,
+                                                             compressor=self.compressor)
         docs = retriever.invoke(query)
+        if self.compressor is not None:
+            stats = self.compressor.stats()
+            self.logger.log(f"[LATENCY] Compression took {stats['last_seconds']:.3f}s "
+                            f"(mean {stats['mean_seconds']:.3f}s over {stats['calls']} calls)")
         return docs
 
-    def get_top_k_relevant_documents_parent_document(self, query: str, k=5) -> List[Document]:
+    def get_compressor(self):
+        """
+        Returns the document compressor for contextual compression configured in the config.
+
+        Returns:
+            the compressor, or None to use the langchain LLMChainExtractor
+        """
+        compressor = self.retrieval_params["compressor"]
+        if compressor == "llm":
+            return None
+        elif compressor == "embeddings":
+            return EmbeddingsSentenceFilter(
+                embeddings=self.vector_db.embedding_function,
+                similarity_threshold=float(self.retrieval_params["compression_similarity_threshold"])
+            )
+        elif compressor == "parallel_llm":
+            return ParallelLLMExtractor(
+                chatbot=self.chatbot,
+                max_concurrency=int(self.retrieval_params["compression_max_concurrency"])
+            )
+        else:
+            print(f"[ERROR] Compressor {compressor} not available.")
+            self.logger.log(f"[ERROR] Compressor {compressor} not available.")
+            exit()
+
+    def get_top_k_relevant_documents_parent_document(self, query: str, k=5, filter=None) -> List[Document]:
         """
         This method returns the top k relevant documents based on the parent document retriever.
 
         Args:
             query (str): The query string.
             k (int): The number of relevant documents to return.
+            filter (dict): Metadata filter.
         Returns:
             List[Document]: A list of Document objects representing the top k relevant documents.
         """
-        retriever = self.vector_db.get_parent_document_retriever(chunk_size=400, chunk_overlap=20)
+        retriever = self.vector_db.get_parent_document_retriever(chunk_size=400, chunk_overlap=20, filter=filter)
         docs = retriever.get_relevant_documents(query)[:k]
         return docs
 
-    def get_top_k_relevant_documents_svm(self, query: str, k=5) -> List[Document]:
+    def get_top_k_relevant_documents_svm(self, query: str, k=5, filter=None) -> List[Document]:
         """
         This method returns the top k relevant documents based on the SVM classifier.
 
         Args:
             query (str): The query string.
             k (int): The number of relevant documents to return.
+            filter (dict): Metadata filter.
         Returns:
             List[Document]: A list of Document objects representing the top k relevant documents.
         """
-        retriever = self.vector_db.get_svm_retriever()
-        docs = retriever.invoke(query)[:k]
+        retriever = self.vector_db.get_svm_retriever(filter=filter)
+        docs = [doc for doc in retriever.invoke(query) if matches(doc.metadata, filter)][:k]
         return docs
 
-    def get_top_k_relevant_documents_multi_query(self, query: str, k=5) -> List[Document]:
+    def get_top_k_relevant_documents_multi_query(self, query: str, k=5, filter=None) -> List[Document]:
         """
         This method returns the top k relevant documents based on the multi query retriever.
 
         Args:
             query (str): The query string.
             k (int): The number of relevant documents to return.
+            filter (dict): Metadata filter.
         Returns:
             List[Document]: A list of Document objects representing the top k relevant documents.
         """
-        retriever = self.vector_db.get_multi_query_retriever(llm=self.chatbot, k=k)
+        retriever = self.vector_db.get_multi_query_retriever(llm=self.chatbot, k=k, filter=filter)
         docs = retriever.invoke(query)
         return docs
 
-    def get_top_k_relevant_documents_emsemble(self, query: str, k=5) -> List[Document]:
+    def get_top_k_relevant_documents_emsemble(self, query: str, k=5, filter=None) -> List[Document]:
         """
         This method returns the top k relevant documents based on the ensemble retriever.
 
         Args:
             query (str): The query string.
             k (int): The number of relevant documents to return.
+            filter (dict): Metadata filter.
         Returns:
             List[Document]: A list of Document objects representing the top k relevant documents.
         """
-        retriever = self.vector_db.get_ensemble_retriever(weights=[0.5, 0.5], k=k)
+        retriever = self.vector_db.get_ensemble_retriever(weights=[0.5, 0.5], k=k, filter=filter)
         docs = retriever.invoke(query)
         return docs
 
@@ -179,15 +322,46 @@ class Retrieval:
         Returns:
             List[Document]: A list of reordered documents
         """
+        # the rank is kept, so the context packing still drops the least relevant documents first
+        documents = [Document(page_content=document.page_content,
+                              metadata={**document.metadata, "retrieval_rank": rank})
+                     for rank, document in enumerate(documents)]
         reordering = LongContextReorder()
         reordered_docs = reordering.transform_documents(documents)
         return reordered_docs
 
     #reranking documents using Cohere
-    def cohere_reranking(self, query:str , k=5) -> List[Document]:
-        retriever= self.vector_db.cohere_compression(k=k)
+    def cohere_reranking(self, query:str , k=5, filter=None) -> List[Document]:
+        retriever= self.vector_db.cohere_compression(k=k, filter=filter)
         return retriever.invoke(query)
     
-    def crossencoder_reranking(self, query:str , k=5) -> List[Document]:
-        retriever= self.vector_db.cross_encoder_compression(k=k)
+    def crossencoder_reranking(self, query:str , k=5, filter=None) -> List[Document]:
+        retriever= self.vector_db.cross_encoder_compression(k=k, filter=filter)
         return retriever.invoke(query)
+
+    def crossencoder_reranking_batch(self, queries: List[str], documents: List[List[Document]],
+                                     top_n: int = 3) -> List[List[Document]]:
+        """
+        Reranks the documents of several queries with the cross encoder, scoring all query-document pairs in batches.
+
+        Args:
+            queries (List[str]): The query strings.
+            documents (List[List[Document]]): The candidate documents per query.
+            top_n (int): The number of documents to keep per query, as in CrossEncoderReranker.
+
+        Returns:
+            List[List[Document]]: The reranked documents per query.
+        """
+        pairs = [(query, doc.page_content) for query, docs in zip(queries, documents) for doc in docs]
+        if not pairs:
+            return [[] for _ in queries]
+        scores = self.vector_db.get_cross_encoder().score(pairs)
+
+        reranked = []
+        offset = 0
+        for docs in documents:
+            doc_scores = scores[offset:offset + len(docs)]
+            offset += len(docs)
+            ranked = sorted(zip(docs, doc_scores), key=lambda pair: pair[1], reverse=True)
+            reranked.append([doc for doc, _ in ranked[:top_n]])
+        return reranked
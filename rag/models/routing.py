@@ -1,20 +1,45 @@
-from typing import List
+import threading
+from typing import List, Optional
 
 from langchain_core.documents import Document
+from langchain_core.embeddings.embeddings import Embeddings
 
 from rag.fixtures.prompts import system_prompt_templates, user_prompt_templates
 from rag.models.chatbot import get_chatbot
+from rag.models.classifiers import EmbeddingClassifier, PendingDecisions, load_labeled_queries
 from rag.functions.logger import CustomLogger
 
+# queries containing one of these keywords always need retrieval
+RAG_KEYWORDS = ["COMPANY_NAME"]
+
+
 class Routing:
     """
     Class containing routers for  the pipeline
     """
 
-    def __init__(self, config):
+    def __init__(self, config, embedding_function: Optional[Embeddings] = None):
         self.routing_prams = config["routing"]
         self.chatbot = get_chatbot(config, config["routing"]["provider"], config["routing"]["model"], None)
         self.logger = CustomLogger("[ROUTING]", config["logging"]["filename"])
+
+        # Local classifier that decides confident queries without calling the LLM
+        self.classifier = None
+        self.decision_log = config["routing"]["decision_log"]
+        self.pending_decisions = PendingDecisions(self.decision_log) if self.decision_log else None
+        self.classifier_stats = {"keyword": 0, "classifier": 0, "llm": 0, "compared": 0, "agreements": 0}
+        self._stats_lock = threading.Lock()
+        if config["routing"]["classifier"] == "True":
+            if embedding_function is None:
+                print("[ERROR] The routing classifier requires the embedding function of the vector database.")
+                exit()
+            self.classifier = EmbeddingClassifier(embedding_function,
+                                                  uncertainty_low=float(config["routing"]["classifier_uncertainty_low"]),
+                                                  uncertainty_high=float(config["routing"]["classifier_uncertainty_high"]))
+            queries, labels = load_labeled_queries(config["routing"]["classifier_training_data"].split(","),
+                                                   self.decision_log)
+            self.classifier.fit(queries, labels)
+            self.logger.log(f"Routing classifier trained on {len(queries)} queries")
         self.logger.log("Routing initialised")
 
     def rag_relevance(self, query: str) -> str:
@@ -26,12 +51,133 @@ class Routing:
         Returns:
             "rag" or "no_rag" based on whether rag is needed
         """
-        if "COMPANY_NAME" in query.lower():
-            self.logger.log("Retrieval is needed based on keyword analysis")
-            return "rag"
+        decision, probability = self._local_rag_relevance(query)
+        if decision is not None:
+            return decision
 
         answer = self.chatbot.custom_prompt(system_prompt_templates["routing"]["rag_relevance"], query)
+        return self._llm_rag_relevance(query, answer, probability)
+
+    async def arag_relevance(self, query: str) -> str:
+        """
+        Async version of rag_relevance
+
+        Params:
+            query: the query
+        Returns:
+            "rag" or "no_rag" based on whether rag is needed
+        """
+        decision, probability = self._local_rag_relevance(query)
+        if decision is not None:
+            return decision
+
+        answer = await self.chatbot.acustom_prompt(system_prompt_templates["routing"]["rag_relevance"], query)
+        return self._llm_rag_relevance(query, answer, probability)
+
+    def _local_rag_relevance(self, query: str):
+        """
+        Decides the rag relevance by keywords and by the local classifier
+
+        Params:
+            query: the query
+        Returns:
+            "rag", "no_rag" or None if the LLM has to decide, and the classifier probability or None
+        """
+        if any(keyword.lower() in query.lower() for keyword in RAG_KEYWORDS):
+            self._count("keyword")
+            self.logger.log("Retrieval is needed based on keyword analysis")
+            return "rag", None
+
+        if self.classifier is None:
+            return None, None
+
+        needs_rag, probability = self.classifier.decide(query)
+        if needs_rag is None:
+            self.logger.log(f"Routing classifier is uncertain ({probability:.2f}), asking the Routing LLM")
+            return None, probability
+
+        self._count("classifier")
+        self.logger.log(f"Retrieval is {'needed' if needs_rag else 'Skipped'} based on the Routing classifier "
+                        f"({probability:.2f})")
+        return ("rag" if needs_rag else "no_rag"), probability
+
+    def _llm_rag_relevance(self, query: str, answer: str, probability: Optional[float]) -> str:
+        decision = self._rag_relevance_decision(answer)
+        self._count("llm")
+        if probability is not None:
+            # the LLM decisions inside the uncertainty band measure the classifier accuracy and are logged as
+            # training data for the next start
+            with self._stats_lock:
+                self.classifier_stats["compared"] += 1
+                self.classifier_stats["agreements"] += int((probability >= 0.5) == (decision == "rag"))
+            if self.pending_decisions is not None:
+                # written by log_decision once the pipeline knows that the query passed the guardrails unchanged
+                self.pending_decisions.add(query, decision == "rag")
+            self.logger.log(f"Routing classifier stats: {self.routing_stats()}")
+        return decision
+
+    def log_decision(self, query: str, passed_guardrails: bool) -> None:
+        """
+        Appends the LLM decision of a query to the decision log, or drops it
+
+        Params:
+            query: the query the decision was made on
+            passed_guardrails: whether the query passed the input guardrails unchanged, blocked and anonymized
+                queries are never logged
+        """
+        if self.pending_decisions is None:
+            return
+        if passed_guardrails:
+            self.pending_decisions.commit(query)
+        else:
+            self.pending_decisions.discard(query)
+
+    def _count(self, source: str) -> None:
+        with self._stats_lock:
+            self.classifier_stats[source] += 1
+
+    def routing_stats(self) -> dict:
+        """
+        Returns how the rag relevance decisions were made
+
+        Returns:
+            decisions by keyword, classifier and LLM, the share of LLM calls saved and the agreement of the
+            classifier with the LLM on the queries it deferred
+        """
+        with self._stats_lock:
+            stats = dict(self.classifier_stats)
+        decisions = stats["keyword"] + stats["classifier"] + stats["llm"]
+        stats["llm_calls_saved"] = (stats["keyword"] + stats["classifier"]) / decisions if decisions else 0.0
+        stats["llm_agreement"] = stats["agreements"] / stats["compared"] if stats["compared"] else None
+        return stats
+
+    def evaluate_classifier(self, queries: List[str]) -> dict:
+        """
+        Compares the classifier with the Routing LLM on the given queries. Every query is sent to the LLM.
+
+        Params:
+            queries: the queries
+        Returns:
+            the accuracy of the confident classifier decisions against the LLM, the accuracy of all classifier
+            decisions and the share of LLM calls the classifier would have saved
+        """
+        confident, confident_correct, correct = 0, 0, 0
+        for query in queries:
+            needs_rag, probability = self.classifier.decide(query)
+            answer = self.chatbot.custom_prompt(system_prompt_templates["routing"]["rag_relevance"], query)
+            llm_needs_rag = self._rag_relevance_decision(answer) == "rag"
+            correct += int((probability >= 0.5) == llm_needs_rag)
+            if needs_rag is not None:
+                confident += 1
+                confident_correct += int(needs_rag == llm_needs_rag)
+        return {
+            "queries": len(queries),
+            "confident_accuracy": confident_correct / confident if confident else None,
+            "accuracy": correct / len(queries) if queries else None,
+            "llm_calls_saved": confident / len(queries) if queries else 0.0,
+        }
 
+    def _rag_relevance_decision(self, answer: str) -> str:
         if "true" in answer.lower():
             self.logger.log("Retrieval is needed based on Routing LLM")
             return "rag"
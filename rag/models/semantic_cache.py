@@ -0,0 +1,155 @@
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings.embeddings import Embeddings
+
+
+@dataclass
+class CacheEntry:
+    query: str
+    vector: np.ndarray
+    answer: str
+    documents: List[Document]
+    latency: float
+    created: float = field(default_factory=time.monotonic)
+
+
+@dataclass
+class CacheHit:
+    query: str
+    answer: str
+    documents: List[Document]
+    similarity: float
+    latency: float
+
+
+class SemanticCache:
+    """
+    Answer cache that returns a previous answer if a new query is a near-duplicate of an already answered one.
+
+    The cached queries are kept in a small dedicated index of normalized embeddings, a lookup is a single
+    matrix-vector product. Entries are evicted by LRU and TTL and the whole cache is dropped as soon as the
+    fingerprint of the vector database changes, so answers never outlive the documents they were based on.
+    """
+
+    def __init__(self, embedding_function: Embeddings, similarity_threshold: float = 0.95, max_size: int = 512,
+                 ttl: float = 86400):
+        self.embedding_function = embedding_function
+        self.similarity_threshold = similarity_threshold
+        self.max_size = max_size
+        self.ttl = ttl
+
+        self._entries = OrderedDict()
+        self._next_id = 0
+        self._matrix = None
+        self._matrix_ids = []
+        self._fingerprint = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def _embed(self, query: str) -> np.ndarray:
+        vector = np.asarray(self.embedding_function.embed_query(query), dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _check_fingerprint(self, fingerprint: str) -> None:
+        if fingerprint != self._fingerprint:
+            self._entries.clear()
+            self._matrix = None
+            self._fingerprint = fingerprint
+
+    def _expire(self) -> None:
+        if self.ttl <= 0:
+            return
+        now = time.monotonic()
+        expired = [key for key, entry in self._entries.items() if now - entry.created > self.ttl]
+        for key in expired:
+            del self._entries[key]
+        if expired:
+            self._matrix = None
+
+    def _index(self):
+        if self._matrix is None:
+            self._matrix_ids = list(self._entries.keys())
+            if self._matrix_ids:
+                self._matrix = np.vstack([self._entries[key].vector for key in self._matrix_ids])
+            else:
+                self._matrix = np.empty((0, 0), dtype=np.float32)
+        return self._matrix, self._matrix_ids
+
+    def lookup(self, query: str, fingerprint: str) -> Optional[CacheHit]:
+        """
+        Looks up the closest cached query
+
+        Params:
+            query: the query
+            fingerprint: the fingerprint of the current vector database
+        Returns:
+            the cached answer if a cached query is above the similarity threshold, None otherwise
+        """
+        vector = self._embed(query)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._expire()
+            matrix, ids = self._index()
+            if not ids:
+                self.misses += 1
+                return None
+
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            similarity = float(similarities[best])
+            if similarity < self.similarity_threshold:
+                self.misses += 1
+                return None
+
+            key = ids[best]
+            entry = self._entries[key]
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return CacheHit(entry.query, entry.answer, entry.documents, similarity, entry.latency)
+
+    def store(self, query: str, answer: str, documents: List[Document], latency: float, fingerprint: str) -> None:
+        """
+        Stores an answer in the cache
+
+        Params:
+            query: the query the answer belongs to
+            answer: the answer
+            documents: the documents used for the answer
+            latency: seconds it took to compute the answer, used to report the latency savings
+            fingerprint: the fingerprint of the current vector database
+        """
+        if self.max_size <= 0:
+            return
+        vector = self._embed(query)
+        with self._lock:
+            self._check_fingerprint(fingerprint)
+            self._entries[self._next_id] = CacheEntry(query, vector, answer, documents, latency)
+            self._next_id += 1
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+            self._matrix = None
+
+    def record_saving(self, seconds: float) -> None:
+        with self._lock:
+            self.saved_seconds += max(seconds, 0.0)
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "size": len(self._entries),
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+                "saved_seconds": self.saved_seconds,
+            }
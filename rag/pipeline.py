@@ -1,11 +1,18 @@
-from typing import TypedDict, List
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterator, TypedDict, Dict, List, Optional, Tuple
 from langchain_core.documents import Document
 from langgraph.graph import StateGraph, END
+from rag.models.chatbot import aclose_clients, format_source
 from rag.models.databases import VectorDB
 from rag.models.guardrails import GuardrailResponse, Guardrails
 from rag.models.generation import Generation
 from rag.models.retrieval import Retrieval
 from rag.models.routing import Routing
+from rag.models.semantic_cache import CacheHit, SemanticCache
+from rag.functions import tracing
 from rag.functions.logger import CustomLogger
 
  
@@ -16,15 +23,35 @@ class PipelineState(TypedDict):
     Attributes:
         query: question query
         conversation: full llm conversation
+        retrieval_filter: metadata filter for the retrieval, None uses the configured default
         retrieved_documents: output of retrieval
 
+        rag_decision: "rag" or "no_rag", None until the routing has been decided
+        documents_retrieved: whether retrieved_documents was already filled by a speculative retrieval
+        deanonymization_mapping: placeholders of the anonymized query and the pii they replace, kept per request so
+            concurrent requests can share one pipeline
+
         result: output of generation
+        cacheable: whether the request may be answered from and stored in the semantic cache
+        cache_hit: the semantic cache entry the request was answered with
+        trace: spans of the request with their durations and token usage, attached after the run if tracing is enabled
     """
     query: str
     guardrail_response: GuardrailResponse
     conversation: List[str]
+    retrieval_filter: Optional[Dict]
     retrieved_documents: List[Document]
+    rag_decision: Optional[str]
+    documents_retrieved: bool
+    deanonymization_mapping: Optional[dict]
     result: str
+    cacheable: bool
+    cache_hit: Optional[CacheHit]
+    trace: Optional[dict]
+
+
+def skip_node(state: PipelineState) -> PipelineState:
+    return state
 
 
 class Pipeline:
@@ -34,37 +61,133 @@ class Pipeline:
 
     def __init__(self, vectordb: VectorDB, config):
         # Initialize Modules
-        self.guardrails = Guardrails(config)
+        self.guardrails = Guardrails(config, vectordb.embedding_function)
         self.retrieval = Retrieval(config, vectordb)
         self.generation = Generation(config)
-        self.routing = Routing(config)
+        self.routing = Routing(config, vectordb.embedding_function)
+        self.vector_db = vectordb
         self.logger = CustomLogger("[PIPELINE]", config["logging"]["filename"])
 
+        # Worker threads for the LLM calls that run concurrently within one request
+        self.concurrent_preprocessing = config["pipeline"]["concurrent_preprocessing"] == "True"
+        self.executor = ThreadPoolExecutor(max_workers=int(config["pipeline"]["max_workers"]))
+
+        # Speculative retrieval runs the retrieval concurrently with the routing decision
+        self.speculative_retrieval = config["pipeline"]["speculative_retrieval"] == "True"
+        self.speculation_stats = {"speculations": 0, "hits": 0, "saved_seconds": 0.0, "wasted_seconds": 0.0}
+        self._speculation_lock = threading.Lock()
+        if self.speculative_retrieval and self.concurrent_preprocessing:
+            print("[WARNING] speculative_retrieval has no effect with concurrent_preprocessing, except for anonymized "
+                  "queries.")
+            self.logger.log("[CONFIG] speculative_retrieval only runs for anonymized queries with "
+                            "concurrent_preprocessing")
+
+        self.batch_max_concurrency = int(config["pipeline"]["batch_max_concurrency"])
+
+        self.tracing_enabled = config["tracing"]["enabled"] == "True"
+        self.trace_exporter = tracing.get_exporter(config["tracing"]) if self.tracing_enabled else None
+
+        self.semantic_cache = None
+        if config["semantic_cache"]["enabled"] == "True":
+            self.semantic_cache = SemanticCache(
+                embedding_function=vectordb.embedding_function,
+                similarity_threshold=float(config["semantic_cache"]["similarity_threshold"]),
+                max_size=int(config["semantic_cache"]["max_entries"]),
+                ttl=float(config["semantic_cache"]["ttl"])
+            )
+
         # Set Up Workflow
+        self.app = self.build_workflow({
+            "guardrail_input_check": (self.concurrent_preprocessing_forward if self.concurrent_preprocessing
+                                      else self.guardrail_input_check),
+            "semantic_cache": self.semantic_cache_lookup,
+            "routing": self.routing_forward,
+            "retrieval": self.retrieval_forward,
+            "generation_rag": self.generate_rag_forward,
+            "generation_no_rag": self.generate_no_rag_forward,
+            "guardrail_output_check": self.guardrail_output_check
+        })
+        # The workflow up to the generation, used by stream which streams the generation itself
+        self.prepare_app = self.build_workflow({
+            "guardrail_input_check": (self.concurrent_preprocessing_forward if self.concurrent_preprocessing
+                                      else self.guardrail_input_check),
+            "semantic_cache": self.semantic_cache_lookup,
+            "routing": self.routing_forward,
+            "retrieval": self.retrieval_forward,
+            "generation_rag": skip_node,
+            "generation_no_rag": skip_node,
+            "guardrail_output_check": skip_node
+        })
+        # The same workflow with async nodes, used by ainvoke
+        self.async_app = self.build_workflow({
+            "guardrail_input_check": (self.aconcurrent_preprocessing_forward if self.concurrent_preprocessing
+                                      else self.aguardrail_input_check),
+            "semantic_cache": self.asemantic_cache_lookup,
+            "routing": self.arouting_forward,
+            "retrieval": self.aretrieval_forward,
+            "generation_rag": self.agenerate_rag_forward,
+            "generation_no_rag": self.agenerate_no_rag_forward,
+            "guardrail_output_check": self.aguardrail_output_check
+        })
+
+        ######## END of Set Up ########
+        self.logger.log("Pipeline Initialized")
+
+    def build_workflow(self, nodes: Dict[str, Callable]):
+        """
+        Builds and compiles the pipeline graph
+
+        Params:
+            nodes: the node functions by node name, either all sync or all async. Every node is recorded as a span
+                of the request trace, except skip_node.
+        Returns:
+            the compiled graph
+        """
+        nodes = {name: node if node is skip_node else tracing.traced(name, node) for name, node in nodes.items()}
+
         workflow = StateGraph(PipelineState)
-        workflow.add_node("routing", lambda state: state)
+        workflow.add_node("routing", nodes["routing"])
         #workflow.add_node("hallucination_detection", lambda state: state)
         #workflow.add_node("guardrail_output_routing", lambda state: state)
         #workflow.add_node("translate_query", self.translate_query_forward)
-        workflow.add_node("retrieval", self.retrieval_forward)
+        workflow.add_node("retrieval", nodes["retrieval"])
         # workflow.add_node("document_relevance", self.document_relevance_forward)
         #workflow.add_node("transform_query", self.transform_query_forward)
-        workflow.add_node("generation_rag", self.generate_rag_forward)
-        workflow.add_node("generation_no_rag", self.generate_no_rag_forward)
-        workflow.add_node("guardrail_input_check", self.guardrail_input_check)
-        workflow.add_node("guardrail_output_check", self.guardrail_output_check)
+        workflow.add_node("generation_rag", nodes["generation_rag"])
+        workflow.add_node("generation_no_rag", nodes["generation_no_rag"])
+        workflow.add_node("guardrail_input_check", nodes["guardrail_input_check"])
+        workflow.add_node("guardrail_output_check", nodes["guardrail_output_check"])
 
         # Build graph
         workflow.set_entry_point("guardrail_input_check")
 
-        workflow.add_conditional_edges(
-            "guardrail_input_check",
-            self.guardrail_input_routing,
-            {
-                "ok": "routing",
-                "not_ok": END
-            }
-        )
+        if self.semantic_cache is not None:
+            workflow.add_node("semantic_cache", nodes["semantic_cache"])
+            workflow.add_conditional_edges(
+                "guardrail_input_check",
+                self.guardrail_input_routing,
+                {
+                    "ok": "semantic_cache",
+                    "not_ok": END
+                }
+            )
+            workflow.add_conditional_edges(
+                "semantic_cache",
+                self.semantic_cache_routing,
+                {
+                    "hit": "guardrail_output_check",
+                    "miss": "routing"
+                }
+            )
+        else:
+            workflow.add_conditional_edges(
+                "guardrail_input_check",
+                self.guardrail_input_routing,
+                {
+                    "ok": "routing",
+                    "not_ok": END
+                }
+            )
 
         workflow.add_conditional_edges(
             "routing",
@@ -82,26 +205,23 @@ class Pipeline:
         # workflow.add_edge("document_relevance", "generation_rag")
         workflow.add_edge("retrieval", "generation_rag")
         workflow.add_edge("generation_rag", "guardrail_output_check")
-        
+
         # Output Guardrail
         workflow.add_edge("guardrail_output_check", END)
-        self.app = workflow.compile()
-
-
-        ######## END of Set Up ########
-        self.logger.log("Pipeline Initialized")
+        return workflow.compile()
 
     """
     Build Pipeline Nodes
     """
 
-    def invoke(self, query: str, conversation: List[str]):
+    def invoke(self, query: str, conversation: List[str], filter: Optional[Dict] = None):
         """
         Invokes the pipeline with a query and returns the resulting response and used documents
 
         Params:
             query: the query
             conversation: the previous conversation
+            filter: metadata filter for the retrieval, e.g. {"language": "de", "type": "pdf"}
         Returns:
             the response and used documents
         """
@@ -109,50 +229,380 @@ class Pipeline:
         self.logger.log("---------- New Request ----------")
         self.logger.log(f"[USER QUERY] {query}")
 
-        last_state = self.app.invoke(
-            {"query": query,
-             "conversation": conversation,
-             "retrieved_documents": [],
-             "result": "",
-             "guardrail_response": None
-             }
-        )
+        last_state = self._run(query, conversation, filter)
         return last_state['result'], last_state["retrieved_documents"]
 
-    def retrieve(self, query: str, conversation: List[str]) -> dict:
+    def retrieve(self, query: str, conversation: List[str], filter: Optional[Dict] = None) -> dict:
         """
         Invokes the pipeline with a query and returns the full end state
 
         Params:
             query: the query
             conversation: the previous conversation
+            filter: metadata filter for the retrieval
         Returns:
             the end state of the pipeline
         """
-        last_state = self.app.invoke(
-            {"query": query,
-             "conversation": conversation,
-             "retrieved_documents": [],
-             "result": "",
-             }
-        )
+        return self._run(query, conversation, filter)
+
+    async def ainvoke(self, query: str, conversation: List[str], filter: Optional[Dict] = None):
+        """
+        Async version of invoke. The LLM calls of the request are awaited on the running event loop,
+        so many requests can be served concurrently by one event loop.
+
+        Params:
+            query: the query
+            conversation: the previous conversation
+            filter: metadata filter for the retrieval
+        Returns:
+            the response and used documents
+        """
+        self.logger.log("---------- New Request ----------")
+        self.logger.log(f"[USER QUERY] {query}")
+
+        last_state = await self._arun(query, conversation, filter)
+        return last_state['result'], last_state["retrieved_documents"]
+
+    async def aretrieve(self, query: str, conversation: List[str], filter: Optional[Dict] = None) -> dict:
+        """
+        Async version of retrieve
+
+        Params:
+            query: the query
+            conversation: the previous conversation
+            filter: metadata filter for the retrieval
+        Returns:
+            the end state of the pipeline
+        """
+        return await self._arun(query, conversation, filter)
+
+    async def aclose(self) -> None:
+        """
+        Closes the async HTTP clients that ainvoke and aretrieve opened on the running event loop. Awaited before
+        the event loop ends, otherwise their connections are left open.
+        """
+        await aclose_clients()
+
+    def stream(self, query: str, conversation: List[str], filter: Optional[Dict] = None) -> Iterator[dict]:
+        """
+        Invokes the pipeline with a query and streams the response. The retrieved documents are sent before the
+        generation starts, the response is then sent in pieces as the chatbot generates it.
+
+        Params:
+            query: the query
+            conversation: the previous conversation
+            filter: metadata filter for the retrieval
+        Returns:
+            iterator over the events {"event": "sources", "documents": [...]}, {"event": "token", "content": "..."}
+            and finally {"event": "done", "result": "..."} with the complete response
+        """
+        self.logger.log("---------- New Request ----------")
+        self.logger.log(f"[USER QUERY] {query}")
+
+        start = time.perf_counter()
+        trace = tracing.Trace("stream") if self.tracing_enabled else None
+        # the generator is resumed by the caller, all work is run in a context with the trace of this request
+        context = tracing.context_with_trace(trace)
+        state = context.run(self.prepare_app.invoke, self._initial_state(query, conversation, filter))
+        yield {"event": "sources", "documents": state["retrieved_documents"]}
+
+        if state["guardrail_response"] == GuardrailResponse.NOT_OK:
+            self._finish_trace(state, trace)
+            yield {"event": "token", "content": state["result"]}
+            yield {"event": "done", "result": state["result"]}
+            return
+
+        # anonymized responses contain placeholders, they are de-anonymized piece by piece by the local
+        # de-anonymizer and otherwise only sent once the whole response is de-anonymized
+        deanonymizer = None
+        if state["guardrail_response"] == GuardrailResponse.CHANGED:
+            deanonymizer = self.guardrails.streaming_deanonymizer(state["deanonymization_mapping"])
+        buffered = state["cache_hit"] is not None or (state["guardrail_response"] == GuardrailResponse.CHANGED
+                                                       and deanonymizer is None)
+        if state["cache_hit"] is None:
+            new_state = state.copy()
+            new_state["result"] = ""
+            span = context.run(tracing.start_span, "generation_stream")
+            tokens = context.run(self.generate_stream_forward, state)
+            while (token := context.run(next, tokens, None)) is not None:
+                if not new_state["result"]:
+                    self.logger.log(f"[STREAMING] First token after {time.perf_counter() - start:.3f}s")
+                new_state["result"] += token
+                if deanonymizer is not None:
+                    token = deanonymizer.feed(token)
+                if not buffered and token:
+                    yield {"event": "token", "content": token}
+            if deanonymizer is not None and (rest := deanonymizer.flush()):
+                yield {"event": "token", "content": rest}
+            if state["rag_decision"] != "rag":
+                # like generate_no_rag, the sources are formatted in the complete response of the done event
+                new_state["result"] = format_source(new_state["result"])
+            context.run(tracing.end_span, span)
+            state = new_state
+
+        state = context.run(tracing.traced("guardrail_output_check", self.guardrail_output_check), state)
+        if buffered:
+            yield {"event": "token", "content": state["result"]}
+        self._update_semantic_cache(state, time.perf_counter() - start)
+        self._finish_trace(state, trace)
+        yield {"event": "done", "result": state["result"]}
+
+    def batch(self, queries: List[str], max_concurrency: Optional[int] = None,
+              conversations: Optional[List[List[str]]] = None,
+              filter: Optional[Dict] = None) -> Tuple[List[dict], dict]:
+        """
+        Answers many queries at once. Instead of running the workflow per query, every stage is run for all
+        queries before the next one: the guardrail, routing, generation and output guardrail LLM calls are sent with
+        at most max_concurrency concurrent calls, and the retrieval of all RAG queries is done with one batched
+        embedding call and one batched vector search.
+
+        Params:
+            queries: the queries
+            max_concurrency: maximum number of concurrent LLM calls, defaults to [pipeline] batch_max_concurrency
+            conversations: the previous conversation per query, defaults to empty conversations
+            filter: metadata filter for the retrieval, applied to all queries
+        Returns:
+            the end state per query in the order of the queries, and throughput statistics
+        """
+        max_concurrency = max_concurrency or self.batch_max_concurrency
+        conversations = conversations or [[] for _ in queries]
+        trace = tracing.Trace("batch") if self.tracing_enabled else None
+        with tracing.activate(trace):
+            states, stats = self._batch(queries, max_concurrency, conversations, filter)
+        if trace is not None:
+            stats["trace"] = trace.to_dict()
+            self.trace_exporter.export(trace)
+        return states, stats
+
+    def _batch(self, queries: List[str], max_concurrency: int, conversations: List[List[str]],
+               filter: Optional[Dict]) -> Tuple[List[dict], dict]:
+        start = time.perf_counter()
+        stage_seconds = {}
+
+        states = [self._initial_state(query, conversation, filter)
+                  for query, conversation in zip(queries, conversations)]
+
+        with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+            def run_stage(name: str, node: Callable, indices: List[int], *arguments: List) -> None:
+                stage_start = time.perf_counter()
+                with tracing.span(f"batch:{name}", queries=len(indices)):
+                    node = tracing.wrap(tracing.traced(name, node))
+                    for i, new_state in zip(indices, executor.map(node, [states[i] for i in indices], *arguments)):
+                        states[i] = new_state
+                stage_seconds[name] = time.perf_counter() - stage_start
+
+            anonymizations = [None] * len(states)
+            if self.guardrails.anonymize_pii:
+                # all queries are anonymized at once, the guardrail stage then only runs the remaining checks
+                stage_start = time.perf_counter()
+                with tracing.span("batch:anonymization", queries=len(states)):
+                    anonymizations = self.guardrails.anonymize_batch(queries, executor)
+                stage_seconds["anonymization"] = time.perf_counter() - stage_start
+            run_stage("guardrail_input", self.guardrail_input_check, list(range(len(states))), anonymizations)
+            active = [i for i, state in enumerate(states) if self.guardrail_input_routing(state) == "ok"]
+
+            if self.semantic_cache is not None:
+                # embeds all queries in one call, the cache lookups then hit the query embedding cache
+                self.vector_db.embed_queries([states[i]["query"] for i in active])
+                run_stage("semantic_cache", self.semantic_cache_lookup, active)
+                active = [i for i in active if self.semantic_cache_routing(states[i]) == "miss"]
+
+            run_stage("routing", self._decide_routing, active)
+            rag = [i for i in active if self.rag_relevance_decision(states[i]) == "rag"]
+            no_rag = [i for i in active if self.rag_relevance_decision(states[i]) == "no_rag"]
+
+            stage_start = time.perf_counter()
+            with tracing.span("batch:retrieval", queries=len(rag)):
+                retrieved_documents = self.retrieval.retrieve_documents_batch([states[i]["query"] for i in rag],
+                                                                              filter)
+            for i, documents in zip(rag, retrieved_documents):
+                states[i] = {**states[i], "retrieved_documents": documents, "documents_retrieved": True}
+            stage_seconds["retrieval"] = time.perf_counter() - stage_start
+
+            run_stage("generation_rag", self.generate_rag_forward, rag)
+            run_stage("generation_no_rag", self.generate_no_rag_forward, no_rag)
+            answered = [i for i, state in enumerate(states) if state["guardrail_response"] != GuardrailResponse.NOT_OK]
+            run_stage("guardrail_output", self.guardrail_output_check, answered)
+
+        # the per query latency is not known, the cache is given the mean latency of the batch
+        mean_seconds = (time.perf_counter() - start) / len(states) if states else 0.0
+        for state in states:
+            self._update_semantic_cache(state, mean_seconds)
+
+        return states, self._batch_stats(states, start, stage_seconds)
+
+    def _decide_routing(self, state: PipelineState) -> PipelineState:
+        new_state = state.copy()
+        new_state["rag_decision"] = self.routing.rag_relevance(state["query"])
+        self._log_routing_decision(state)
+        return new_state
+
+    def _batch_stats(self, states: List[dict], start: float, stage_seconds: Dict[str, float]) -> dict:
+        """
+        Computes and logs the throughput statistics of a batch
+
+        Params:
+            states: the end states of the batch
+            start: the perf_counter value at the start of the batch
+            stage_seconds: the seconds spent per stage
+        Returns:
+            the statistics
+        """
+        seconds = time.perf_counter() - start
+        stats = {
+            "queries": len(states),
+            "seconds": seconds,
+            "queries_per_second": len(states) / seconds if seconds > 0 else 0.0,
+            "blocked": sum(state["guardrail_response"] == GuardrailResponse.NOT_OK for state in states),
+            "cache_hits": sum(state["cache_hit"] is not None for state in states),
+            "rag": sum(state["rag_decision"] == "rag" for state in states),
+            "no_rag": sum(state["rag_decision"] == "no_rag" for state in states),
+            "stage_seconds": stage_seconds,
+        }
+        self.logger.log(f"[BATCH] {stats['queries']} queries in {seconds:.1f}s "
+                        f"({stats['queries_per_second']:.2f} queries/s), {stats['blocked']} blocked, "
+                        f"{stats['cache_hits']} cache hits, {stats['rag']} rag, {stats['no_rag']} no rag")
+        self.logger.log("[BATCH] Stage seconds: " + ", ".join(f"{name} {value:.1f}s"
+                                                              for name, value in stage_seconds.items()))
+        return stats
+
+    def _initial_state(self, query: str, conversation: List[str], filter: Optional[Dict] = None) -> PipelineState:
+        return {"query": query,
+                "conversation": conversation,
+                "retrieval_filter": filter,
+                "retrieved_documents": [],
+                "rag_decision": None,
+                "documents_retrieved": False,
+                "deanonymization_mapping": None,
+                "result": "",
+                "guardrail_response": None,
+                "cacheable": False,
+                "cache_hit": None,
+                "trace": None
+                }
+
+    def _run(self, query: str, conversation: List[str], filter: Optional[Dict] = None) -> dict:
+        """
+        Runs the graph and maintains the semantic cache
+
+        Params:
+            query: the query
+            conversation: the previous conversation
+            filter: metadata filter for the retrieval
+        Returns:
+            the end state of the pipeline
+        """
+        start = time.perf_counter()
+        trace = tracing.Trace("invoke") if self.tracing_enabled else None
+        with tracing.activate(trace):
+            last_state = self.app.invoke(self._initial_state(query, conversation, filter))
+        self._update_semantic_cache(last_state, time.perf_counter() - start)
+        self._finish_trace(last_state, trace)
         return last_state
 
+    async def _arun(self, query: str, conversation: List[str], filter: Optional[Dict] = None) -> dict:
+        """
+        Async version of _run
+        """
+        start = time.perf_counter()
+        trace = tracing.Trace("ainvoke") if self.tracing_enabled else None
+        with tracing.activate(trace):
+            last_state = await self.async_app.ainvoke(self._initial_state(query, conversation, filter))
+        # storing an answer embeds the query
+        await asyncio.to_thread(self._update_semantic_cache, last_state, time.perf_counter() - start)
+        self._finish_trace(last_state, trace)
+        return last_state
+
+    def _finish_trace(self, last_state: dict, trace: Optional[tracing.Trace]) -> None:
+        """
+        Attaches the trace to the end state, exports it and logs the duration of the nodes
+
+        Params:
+            last_state: the end state of the pipeline
+            trace: the trace of the request, None if tracing is disabled
+        """
+        if trace is None:
+            return
+        last_state["trace"] = trace.to_dict()
+        self.trace_exporter.export(trace)
+        nodes = [span for span in last_state["trace"]["spans"] if span["parent_id"] is None]
+        self.logger.log("[TRACE] " + ", ".join(f"{span['name']} {span['duration']:.3f}s" for span in nodes))
+
+    def _update_semantic_cache(self, last_state: dict, elapsed: float) -> None:
+        """
+        Stores the answer of a finished request in the semantic cache, or records the time saved by a cache hit
+
+        Params:
+            last_state: the end state of the pipeline
+            elapsed: the seconds the request took
+        """
+        if self.semantic_cache is not None and last_state["cacheable"]:
+            if last_state["cache_hit"] is not None:
+                self.semantic_cache.record_saving(last_state["cache_hit"].latency - elapsed)
+                self.logger.log(f"[SEMANTIC CACHE] Answered in {elapsed:.3f}s instead of "
+                                f"{last_state['cache_hit'].latency:.3f}s")
+            else:
+                self.semantic_cache.store(last_state["query"], last_state["result"],
+                                          last_state["retrieved_documents"], elapsed, self.vector_db.fingerprint())
+            stats = self.semantic_cache.stats()
+            self.logger.log(f"[SEMANTIC CACHE] {stats['hits']} hits, {stats['misses']} misses, "
+                            f"hit rate {stats['hit_rate']:.2f}, {stats['saved_seconds']:.1f}s saved in total")
+
     """
     GUARDRAILS
     """
 
-    def guardrail_input_check(self, state: PipelineState) -> PipelineState:
+    def guardrail_input_check(self, state: PipelineState,
+                              anonymization: Optional[Tuple[str, dict]] = None) -> PipelineState:
         query = state['query']
-        guardrail_response, new_query, error_message = self.guardrails.guardrail_input(query)
+        guardrail_response, new_query, error_message, mapping = self.guardrails.guardrail_input(
+            query, anonymization=anonymization)
         new_state = state.copy()
 
         new_state["guardrail_response"] = guardrail_response
         new_state["query"] = new_query
         new_state["result"] = error_message
+        new_state["deanonymization_mapping"] = mapping
 
         return new_state
 
+    def concurrent_preprocessing_forward(self, state: PipelineState) -> PipelineState:
+        """
+        Input guardrail node that decides the routing at the same time. The guardrail checks and the rag relevance
+        decision are sent concurrently, so the LLM round trips before the retrieval overlap instead of adding up.
+
+        Params:
+            state: current state
+        Returns:
+            new state
+        """
+        query = state['query']
+        start = time.perf_counter()
+        routing_future = self.executor.submit(tracing.wrap(self.routing.rag_relevance), query)
+        guardrail_response, new_query, error_message, mapping = self.guardrails.guardrail_input(query, self.executor)
+        new_state = state.copy()
+
+        new_state["guardrail_response"] = guardrail_response
+        new_state["query"] = new_query
+        new_state["result"] = error_message
+        new_state["deanonymization_mapping"] = mapping
+
+        if guardrail_response == GuardrailResponse.NOT_OK:
+            routing_future.cancel()
+            self.logger.log("[PREPROCESSING] Query blocked, the routing decision is discarded")
+        elif guardrail_response == GuardrailResponse.CHANGED:
+            # the decision was made on the original query, the routing node decides again on the anonymized one
+            routing_future.cancel()
+            self.logger.log("[PREPROCESSING] Query anonymized, the routing decision is discarded")
+        else:
+            new_state["rag_decision"] = routing_future.result()
+        # a running routing call cannot be cancelled, its decision is dropped once it is done
+        routing_future.add_done_callback(
+            lambda _: self.routing.log_decision(query, guardrail_response == GuardrailResponse.OK))
+
+        self.logger.log(f"[PREPROCESSING] Guardrails and routing took {time.perf_counter() - start:.3f}s")
+        return new_state
+
     def guardrail_input_routing(self, state: PipelineState) -> str:
         if (state["guardrail_response"] == GuardrailResponse.OK
                 or state["guardrail_response"] == GuardrailResponse.CHANGED):
@@ -163,7 +613,8 @@ class Pipeline:
             raise Exception("The guardrail routing cannot be called without setting the guardrail_response")
 
     def guardrail_output_check(self, state: PipelineState) -> PipelineState:
-        guardrail_response, result = self.guardrails.guardrail_output(state["guardrail_response"], state['result'])
+        guardrail_response, result = self.guardrails.guardrail_output(state["guardrail_response"], state['result'],
+                                                                      state["deanonymization_mapping"])
         new_state = state.copy()
 
         new_state["guardrail_response"] = guardrail_response
@@ -171,6 +622,36 @@ class Pipeline:
 
         return new_state
 
+    def semantic_cache_lookup(self, state: PipelineState) -> PipelineState:
+        """
+        Semantic cache node. Answers the query with a cached answer of a near-duplicate query.
+
+        Params:
+            state: current state
+        Returns:
+            new state
+        """
+        new_state = state.copy()
+        # anonymized queries contain placeholders that are only valid for this request, cached answers were
+        # retrieved with the default filter and do not depend on a previous conversation
+        new_state["cacheable"] = (state["guardrail_response"] == GuardrailResponse.OK
+                                  and state["retrieval_filter"] is None
+                                  and not self.generation.uses_conversation(state["conversation"]))
+        if not new_state["cacheable"]:
+            return new_state
+
+        cache_hit = self.semantic_cache.lookup(state["query"], self.vector_db.fingerprint())
+        if cache_hit is not None:
+            self.logger.log(f"[SEMANTIC CACHE] Hit with similarity {cache_hit.similarity:.3f} "
+                            f"for cached query: {cache_hit.query}")
+            new_state["cache_hit"] = cache_hit
+            new_state["result"] = cache_hit.answer
+            new_state["retrieved_documents"] = cache_hit.documents
+        return new_state
+
+    def semantic_cache_routing(self, state: PipelineState) -> str:
+        return "hit" if state["cache_hit"] is not None else "miss"
+
     def guardrail_output_routing(self, state):
         if (state["guardrail_response"] == GuardrailResponse.OK
                 or state["guardrail_response"] == GuardrailResponse.CHANGED):
@@ -249,18 +730,124 @@ class Pipeline:
         Returns:
             new state
         """
+        if state["documents_retrieved"]:
+            return state
         query = state['query']
-        retrieved_documents = self.retrieval.retrieve_documents(query)
+        retrieved_documents = self.retrieval.retrieve_documents(query, state["retrieval_filter"])
         new_state = state.copy()
         new_state['retrieved_documents'] = retrieved_documents
         return new_state
 
+    def generate_stream_forward(self, state: PipelineState) -> Iterator[str]:
+        """
+        Streaming generation node. Generates the response on the branch chosen by the routing.
+
+        Params:
+            state: current state
+        Returns:
+            iterator over the pieces of the response
+        """
+        if state["rag_decision"] == "rag":
+            return self.generation.stream_rag(state['query'], state['conversation'], state['retrieved_documents'])
+        return self.generation.stream_no_rag(state['query'], state['conversation'])
+
     def generate_no_rag_forward(self, state: PipelineState) -> PipelineState:
         result = self.generation.generate_no_rag(state['query'], state['conversation'])
         new_state = state.copy()
         new_state['result'] = result
         return new_state
 
+    def routing_forward(self, state: PipelineState) -> PipelineState:
+        """
+        Routing node. Decides whether RAG is needed for the query, unless the decision was already made
+        during the pre-processing.
+
+        Params:
+            state: current state
+        Returns:
+            new state
+        """
+        if state["rag_decision"] is not None:
+            return state
+        if self.speculative_retrieval:
+            return self.speculative_routing_forward(state)
+        new_state = state.copy()
+        new_state["rag_decision"] = self.routing.rag_relevance(state['query'])
+        self._log_routing_decision(state)
+        return new_state
+
+    def _log_routing_decision(self, state: PipelineState) -> None:
+        # the routing decision log is training data on disk, only queries that passed the guardrails unchanged are
+        # written to it
+        self.routing.log_decision(state['query'], state["guardrail_response"] == GuardrailResponse.OK)
+
+    def speculative_routing_forward(self, state: PipelineState) -> PipelineState:
+        """
+        Routing node with speculative retrieval. The retrieval is started before the routing decision is made and
+        its result is used if RAG is needed, otherwise it is discarded.
+
+        Params:
+            state: current state
+        Returns:
+            new state
+        """
+        retrieval_future = self.executor.submit(tracing.wrap(self._timed_retrieval), state)
+        start = time.perf_counter()
+        rag_decision = self.routing.rag_relevance(state['query'])
+        routing_seconds = time.perf_counter() - start
+        self._log_routing_decision(state)
+
+        new_state = state.copy()
+        new_state["rag_decision"] = rag_decision
+        if rag_decision == "rag":
+            new_state["retrieved_documents"], retrieval_seconds = retrieval_future.result()
+            new_state["documents_retrieved"] = True
+            # the shorter of both steps no longer adds to the latency
+            self._record_speculation(hit=True, seconds=min(routing_seconds, retrieval_seconds))
+        else:
+            self._discard_speculation(retrieval_future)
+        return new_state
+
+    def _timed_retrieval(self, state: PipelineState):
+        start = time.perf_counter()
+        documents = self.retrieval.retrieve_documents(state['query'], state["retrieval_filter"])
+        return documents, time.perf_counter() - start
+
+    def _discard_speculation(self, retrieval_future) -> None:
+        """
+        Cancels a speculative retrieval that is not needed, or records its duration as wasted once it finished
+
+        Params:
+            retrieval_future: the future of the speculative retrieval
+        """
+        if retrieval_future.cancel():
+            self._record_speculation(hit=False, seconds=0.0)
+        else:
+            retrieval_future.add_done_callback(
+                lambda future: self._record_speculation(hit=False, seconds=future.result()[1]
+                                                        if future.exception() is None else 0.0))
+
+    def _record_speculation(self, hit: bool, seconds: float) -> None:
+        """
+        Records the outcome of a speculative retrieval and logs the speculation statistics
+
+        Params:
+            hit: whether the retrieved documents were used
+            seconds: latency saved by a hit or retrieval time wasted by a miss
+        """
+        with self._speculation_lock:
+            stats = self.speculation_stats
+            stats["speculations"] += 1
+            if hit:
+                stats["hits"] += 1
+                stats["saved_seconds"] += seconds
+            else:
+                stats["wasted_seconds"] += seconds
+            hit_rate = stats["hits"] / stats["speculations"]
+            self.logger.log(f"[SPECULATIVE RETRIEVAL] {'Hit' if hit else 'Miss'}, hit rate {hit_rate:.2f} "
+                            f"over {stats['speculations']} requests, {stats['saved_seconds']:.1f}s saved, "
+                            f"{stats['wasted_seconds']:.1f}s of retrieval wasted")
+
     def rag_relevance_decision(self, state: PipelineState) -> str:
         """
         Returns a decision whether RAG is needed for the query or not
@@ -268,9 +855,9 @@ class Pipeline:
         Params:
             state: current state
         Returns:
-            new state
+            "rag" or "no_rag"
         """
-        return self.routing.rag_relevance(state['query'])
+        return state["rag_decision"]
 
 
     def hallucination_detection_decision(self, state: PipelineState) -> str:
@@ -283,3 +870,107 @@ class Pipeline:
             new state
         """
         return self.routing.hallucination_detection(state['query'], state['retrieved_documents'], state['result'])
+
+    """
+    ASYNC WORKFLOW NODES
+    """
+
+    async def aguardrail_input_check(self, state: PipelineState) -> PipelineState:
+        guardrail_response, new_query, error_message, mapping = await self.guardrails.aguardrail_input(state['query'])
+        new_state = state.copy()
+
+        new_state["guardrail_response"] = guardrail_response
+        new_state["query"] = new_query
+        new_state["result"] = error_message
+        new_state["deanonymization_mapping"] = mapping
+
+        return new_state
+
+    async def aconcurrent_preprocessing_forward(self, state: PipelineState) -> PipelineState:
+        """
+        Async version of concurrent_preprocessing_forward
+
+        Params:
+            state: current state
+        Returns:
+            new state
+        """
+        query = state['query']
+        start = time.perf_counter()
+        routing_task = asyncio.ensure_future(self.routing.arag_relevance(query))
+        guardrail_response, new_query, error_message, mapping = await self.guardrails.aguardrail_input(query,
+                                                                                                    concurrent=True)
+        new_state = state.copy()
+
+        new_state["guardrail_response"] = guardrail_response
+        new_state["query"] = new_query
+        new_state["result"] = error_message
+        new_state["deanonymization_mapping"] = mapping
+
+        if guardrail_response == GuardrailResponse.NOT_OK:
+            routing_task.cancel()
+            self.logger.log("[PREPROCESSING] Query blocked, the routing decision is discarded")
+        elif guardrail_response == GuardrailResponse.CHANGED:
+            routing_task.cancel()
+            self.logger.log("[PREPROCESSING] Query anonymized, the routing decision is discarded")
+        else:
+            new_state["rag_decision"] = await routing_task
+        routing_task.add_done_callback(
+            lambda _: self.routing.log_decision(query, guardrail_response == GuardrailResponse.OK))
+
+        self.logger.log(f"[PREPROCESSING] Guardrails and routing took {time.perf_counter() - start:.3f}s")
+        return new_state
+
+    async def aguardrail_output_check(self, state: PipelineState) -> PipelineState:
+        return await asyncio.to_thread(self.guardrail_output_check, state)
+
+    async def asemantic_cache_lookup(self, state: PipelineState) -> PipelineState:
+        return await asyncio.to_thread(self.semantic_cache_lookup, state)
+
+    async def arouting_forward(self, state: PipelineState) -> PipelineState:
+        """
+        Async version of routing_forward
+
+        Params:
+            state: current state
+        Returns:
+            new state
+        """
+        if state["rag_decision"] is not None:
+            return state
+        new_state = state.copy()
+        if not self.speculative_retrieval:
+            new_state["rag_decision"] = await self.routing.arag_relevance(state['query'])
+            self._log_routing_decision(state)
+            return new_state
+
+        retrieval_future = self.executor.submit(tracing.wrap(self._timed_retrieval), state)
+        start = time.perf_counter()
+        new_state["rag_decision"] = await self.routing.arag_relevance(state['query'])
+        routing_seconds = time.perf_counter() - start
+        self._log_routing_decision(state)
+
+        if new_state["rag_decision"] == "rag":
+            new_state["retrieved_documents"], retrieval_seconds = await asyncio.wrap_future(retrieval_future)
+            new_state["documents_retrieved"] = True
+            self._record_speculation(hit=True, seconds=min(routing_seconds, retrieval_seconds))
+        else:
+            self._discard_speculation(retrieval_future)
+        return new_state
+
+    async def aretrieval_forward(self, state: PipelineState) -> PipelineState:
+        # the vector search is blocking, it runs in a worker thread
+        return await asyncio.to_thread(self.retrieval_forward, state)
+
+    async def agenerate_rag_forward(self, state: PipelineState) -> PipelineState:
+        result = await self.generation.agenerate_rag(state['query'], state['conversation'],
+                                                     state['retrieved_documents'])
+        new_state = state.copy()
+        new_state['result'] = result
+        return new_state
+
+    async def agenerate_no_rag_forward(self, state: PipelineState) -> PipelineState:
+        result = await self.generation.agenerate_no_rag(state['query'], state['conversation'])
+        new_state = state.copy()
+        new_state['result'] = result
+        return new_state